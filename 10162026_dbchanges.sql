@@ -0,0 +1,86 @@
+CREATE INDEX ccgj_state_bulk_job_idx ON canvas_course_generation_job (workflow_state, bulk_job_id);
+CREATE INDEX ccgj_sis_course_bulk_job_idx ON canvas_course_generation_job (sis_course_id, bulk_job_id);
+-- rows with no bulk_job_id have an all-null key, which Oracle leaves out of the index
+CREATE UNIQUE INDEX ccgj_bulk_job_sis_course_uniq ON canvas_course_generation_job (
+  CASE WHEN bulk_job_id IS NOT NULL THEN bulk_job_id END,
+  CASE WHEN bulk_job_id IS NOT NULL THEN sis_course_id END
+);
+ALTER TABLE canvas_course_generation_job ADD (lease_owner VARCHAR2(100));
+ALTER TABLE canvas_course_generation_job ADD (lease_expires_at TIMESTAMP);
+
+CREATE TABLE canvas_wizard_email_outbox
+  (
+    id NUMBER(11,0) NOT NULL ENABLE,
+    subject NVARCHAR2(255),
+    message NCLOB,
+    from_address NVARCHAR2(254),
+    to_addresses NCLOB,
+    status NVARCHAR2(10),
+    attempts NUMBER(11,0) NOT NULL ENABLE,
+    last_error NCLOB,
+    next_attempt_at TIMESTAMP (6) NOT NULL ENABLE,
+    claimed_by NVARCHAR2(100),
+    created_at TIMESTAMP (6) NOT NULL ENABLE,
+    sent_at TIMESTAMP (6),
+
+    PRIMARY KEY (id) ENABLE
+  );
+
+CREATE INDEX cw_email_outbox_due_idx ON canvas_wizard_email_outbox (status, next_attempt_at);
+
+CREATE SEQUENCE cw_email_outbox_sq MINVALUE 1 MAXVALUE 9999999999999999
+INCREMENT BY 1 START WITH 1 NOCACHE NOORDER NOCYCLE ;
+
+CREATE OR REPLACE TRIGGER cw_email_outbox_tr
+BEFORE INSERT ON canvas_wizard_email_outbox
+FOR EACH ROW WHEN (new.id IS NULL)
+BEGIN
+  SELECT cw_email_outbox_sq.nextval INTO :new.id FROM dual;
+END;
+
+ALTER TRIGGER cw_email_outbox_tr ENABLE;
+
+ALTER TABLE bulk_canvas_course_crtn_job ADD (subjobs_total NUMBER(11,0) DEFAULT 0 NOT NULL);
+ALTER TABLE bulk_canvas_course_crtn_job ADD (subjobs_setup NUMBER(11,0) DEFAULT 0 NOT NULL);
+ALTER TABLE bulk_canvas_course_crtn_job ADD (subjobs_in_flight NUMBER(11,0) DEFAULT 0 NOT NULL);
+ALTER TABLE bulk_canvas_course_crtn_job ADD (subjobs_finalized NUMBER(11,0) DEFAULT 0 NOT NULL);
+ALTER TABLE bulk_canvas_course_crtn_job ADD (subjobs_failed NUMBER(11,0) DEFAULT 0 NOT NULL);
+-- then fill in the counters of the existing bulk jobs with "python manage.py rebuild_bulk_job_counters"
+
+CREATE TABLE canvas_wizard_job_transition
+  (
+    id NUMBER(11,0) NOT NULL ENABLE,
+    job_id NUMBER(11,0) NOT NULL ENABLE,
+    bulk_job_id NUMBER(11,0),
+    from_state NVARCHAR2(20),
+    to_state NVARCHAR2(20),
+    created_at TIMESTAMP (6) NOT NULL ENABLE,
+    worker NVARCHAR2(100),
+    duration_seconds DOUBLE PRECISION,
+
+    PRIMARY KEY (id) ENABLE
+  );
+
+CREATE INDEX cw_job_trans_time_idx ON canvas_wizard_job_transition (created_at);
+CREATE INDEX cw_job_trans_job_idx ON canvas_wizard_job_transition (job_id, created_at);
+CREATE INDEX cw_job_trans_bulk_job_idx ON canvas_wizard_job_transition (bulk_job_id, created_at);
+
+CREATE SEQUENCE cw_job_trans_sq MINVALUE 1 MAXVALUE 9999999999999999
+INCREMENT BY 1 START WITH 1 NOCACHE NOORDER NOCYCLE ;
+
+CREATE OR REPLACE TRIGGER cw_job_trans_tr
+BEFORE INSERT ON canvas_wizard_job_transition
+FOR EACH ROW WHEN (new.id IS NULL)
+BEGIN
+  SELECT cw_job_trans_sq.nextval INTO :new.id FROM dual;
+END;
+
+ALTER TRIGGER cw_job_trans_tr ENABLE;
+
+ALTER TABLE canvas_course_generation_job ADD (setup_started_at TIMESTAMP (6));
+ALTER TABLE canvas_course_generation_job ADD (canvas_course_created_at TIMESTAMP (6));
+ALTER TABLE canvas_course_generation_job ADD (migration_queued_at TIMESTAMP (6));
+ALTER TABLE canvas_course_generation_job ADD (migration_completed_at TIMESTAMP (6));
+ALTER TABLE canvas_course_generation_job ADD (finalized_at TIMESTAMP (6));
+
+CREATE INDEX ccgj_state_updated_idx ON canvas_course_generation_job (workflow_state, updated_at);
@@ -0,0 +1,150 @@
+"""
+Benchmark for the canvas_course_generation_job lookup indexes added in migration 0010.
+
+Builds a canvas_course_generation_job table of a million rows in an in-memory sqlite database, then shows the
+query plan and timing of each hot lookup path before and after the indexes are created. Only the standard library
+is needed:
+
+    python benchmarks/canvas_course_generation_job_indexes.py [--rows 1000000] [--repeat 20]
+
+The production database is Oracle, so absolute timings will differ; the plans show which access path is used.
+"""
+import argparse
+import random
+import sqlite3
+import time
+
+INTERMEDIATE_STATES = ('setup', 'queued', 'running', 'completed', 'pending_finalize')
+TERMINAL_STATES = ('finalized', 'failed', 'setup_failed', 'finalize_failed')
+COURSES_PER_BULK_JOB = 500
+
+CREATE_TABLE = """
+CREATE TABLE canvas_course_generation_job (
+    id INTEGER PRIMARY KEY,
+    canvas_course_id INTEGER,
+    sis_course_id VARCHAR(20) NOT NULL,
+    content_migration_id INTEGER,
+    created_at DATETIME NOT NULL,
+    updated_at DATETIME NOT NULL,
+    status_url VARCHAR(200),
+    workflow_state VARCHAR(20) NOT NULL,
+    created_by_user_id VARCHAR(20) NOT NULL,
+    bulk_job_id INTEGER
+)
+"""
+
+# the indexes which exist before migration 0010
+BASELINE_INDEXES = (
+    "CREATE INDEX ccgj_canvas_course_id ON canvas_course_generation_job (canvas_course_id)",
+    "CREATE INDEX ccgj_sis_course_id ON canvas_course_generation_job (sis_course_id)",
+)
+
+# the indexes added by migration 0010
+NEW_INDEXES = (
+    "CREATE INDEX ccgj_state_bulk_job_idx ON canvas_course_generation_job (workflow_state, bulk_job_id)",
+    "CREATE INDEX ccgj_sis_course_bulk_job_idx ON canvas_course_generation_job (sis_course_id, bulk_job_id)",
+    "CREATE UNIQUE INDEX ccgj_bulk_job_sis_course_uniq ON canvas_course_generation_job (bulk_job_id, sis_course_id) "
+    "WHERE bulk_job_id IS NOT NULL",
+)
+
+# (description, sql, params) for the lookups made by the management commands and views
+QUERIES = (
+    ('process_async_jobs: jobs with migrations in progress',
+     "SELECT * FROM canvas_course_generation_job WHERE workflow_state IN ('queued', 'running', 'completed')",
+     ()),
+    ('finalize_bulk_create_jobs: bulk subjobs in setup (filter_setup_for_bulkjobs)',
+     "SELECT * FROM canvas_course_generation_job WHERE workflow_state = 'setup' AND bulk_job_id IS NOT NULL",
+     ()),
+    ('get_course_generation_data_for_sis_course_id: subjob of a bulk job',
+     "SELECT * FROM canvas_course_generation_job WHERE sis_course_id = ? AND bulk_job_id = ?",
+     ('123456', 246)),
+    ('get_course_generation_data_for_sis_course_id: single course job',
+     "SELECT * FROM canvas_course_generation_job WHERE sis_course_id = ? AND bulk_job_id IS NULL",
+     ('123456',)),
+    ('get_jobs_ready_to_finalize: intermediate subjobs of a bulk job',
+     "SELECT 1 FROM canvas_course_generation_job WHERE bulk_job_id = ? AND workflow_state IN "
+     "('setup', 'queued', 'running', 'completed', 'pending_finalize') LIMIT 1",
+     (246,)),
+)
+
+
+def populate(connection, rows):
+    """
+    Fills the table with bulk subjobs, mostly in terminal states as they would be in production, plus a tenth as
+    many single course jobs
+    """
+    rng = random.Random(0)
+    single_course_jobs = rows // 10
+
+    def generate():
+        for row_id in range(1, rows + 1):
+            if row_id <= single_course_jobs:
+                bulk_job_id = None
+                sis_course_id = str(rng.randrange(1, 400000))
+            else:
+                bulk_job_id = row_id // COURSES_PER_BULK_JOB
+                sis_course_id = str(row_id)
+            if rng.random() < 0.02:
+                workflow_state = rng.choice(INTERMEDIATE_STATES)
+            else:
+                workflow_state = rng.choice(TERMINAL_STATES)
+            yield (row_id, row_id, sis_course_id, row_id, '2015-07-02 13:17:00', '2015-07-02 13:17:00',
+                   'https://canvas.example.edu/api/v1/progress/%d' % row_id, workflow_state, '10564158',
+                   bulk_job_id)
+
+    connection.executemany(
+        'INSERT INTO canvas_course_generation_job VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', generate())
+    connection.commit()
+
+
+def explain(connection, sql, params):
+    return [row[-1] for row in connection.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+
+def time_query(connection, sql, params, repeat):
+    """ Returns the best of `repeat` runs in milliseconds """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        connection.execute(sql, params).fetchall()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def run_queries(connection, repeat):
+    results = []
+    for description, sql, params in QUERIES:
+        results.append((explain(connection, sql, params), time_query(connection, sql, params, repeat)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(':memory:')
+    connection.execute(CREATE_TABLE)
+    for statement in BASELINE_INDEXES:
+        connection.execute(statement)
+    start = time.perf_counter()
+    populate(connection, args.rows)
+    print('Populated %d rows in %.1fs' % (args.rows, time.perf_counter() - start))
+    connection.execute('ANALYZE')
+
+    before = run_queries(connection, args.repeat)
+    for statement in NEW_INDEXES:
+        connection.execute(statement)
+    connection.execute('ANALYZE')
+    after = run_queries(connection, args.repeat)
+
+    for (description, sql, params), (plan_before, ms_before), (plan_after, ms_after) in zip(QUERIES, before, after):
+        print()
+        print(description)
+        print('  before: %9.3f ms  %s' % (ms_before, '; '.join(plan_before)))
+        print('  after:  %9.3f ms  %s' % (ms_after, '; '.join(plan_after)))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ from canvas_sdk.methods.users import get_user_profile
 from canvas_sdk.methods import content_migrations
 from canvas_sdk.exceptions import CanvasAPIError
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 from django.core.mail import send_mail
 from django.utils import timezone
@@ -40,6 +41,7 @@ from .exceptions import (
     CanvasCourseCreateError,
     CanvasEnrollmentError,
     CanvasSectionCreateError,
+    CanvasUserProfileNotFound,
     CopySISEnrollmentsError,
     CourseGenerationJobCreationError,
     CourseGenerationJobNotFoundError,
@@ -50,18 +52,30 @@ from .exceptions import (
     SaveCanvasCourseIdToCourseGenerationJobError,
     SaveCanvasCourseIdToCourseInstanceError,
 )
-from icommons_common.canvas_utils import SessionInactivityExpirationRC
+from .email_outbox import queue_email
+from .throttling import ThrottledRequestContext
 
 
 # Set up the request context that will be used for canvas API calls
-SDK_CONTEXT = SessionInactivityExpirationRC(**settings.CANVAS_SDK_SETTINGS)
+SDK_CONTEXT = ThrottledRequestContext(**settings.CANVAS_SDK_SETTINGS)
 logger = logging.getLogger(__name__)
 
+# Default number of seconds template course settings are cached for (see get_template_course_settings)
+TEMPLATE_COURSE_SETTINGS_CACHE_TIMEOUT = 60 * 60
+# Default number of seconds a Canvas account is remembered as existing for (see get_or_create_account)
+CANVAS_ACCOUNT_EXISTS_CACHE_TIMEOUT = 60 * 60
+# Default number of seconds Canvas user profiles, and users found not to have one, are cached for
+# (see get_canvas_user_profile)
+CANVAS_USER_PROFILE_CACHE_TIMEOUT = 60 * 60
+CANVAS_USER_PROFILE_NOT_FOUND_CACHE_TIMEOUT = 5 * 60
 
-def create_canvas_course(sis_course_id, sis_user_id, bulk_job=None):
+
+def create_canvas_course(sis_course_id, sis_user_id, bulk_job=None, course_data=None):
     """
     This method creates a canvas course for the sis_course_id provided, initiated by the sis_user_id. The bulk_job_id
-    would be passed in if it's invoked from a bulk feed process.
+    would be passed in if it's invoked from a bulk feed process. If the SISCourseData for the course has already
+    been loaded (e.g. in bulk by get_course_data_for_sis_course_ids) it can be passed in as course_data to save
+    looking it up again.
     """
 
     # instantiate any variables required for method return or logger calls
@@ -94,6 +108,7 @@ def create_canvas_course(sis_course_id, sis_user_id, bulk_job=None):
                 sis_course_id=sis_course_id,
                 created_by_user_id=sis_user_id,
                 workflow_state=CanvasCourseGenerationJob.STATUS_SETUP,
+                setup_started_at=timezone.now(),
             )
             course_job_id = course_generation_job.pk
             logger.debug('Job row created: %s' % course_generation_job)
@@ -107,8 +122,9 @@ def create_canvas_course(sis_course_id, sis_user_id, bulk_job=None):
             raise ex
 
     try:
-        # 2. fetch the course instance info
-        course_data = get_course_data(sis_course_id)
+        # 2. fetch the course instance info, if it wasn't passed in
+        if course_data is None:
+            course_data = get_course_data(sis_course_id)
         logger.info("\n obtained course info for ci=%s, acct_id=%s, course_name=%s, code=%s, term=%s, section_name=%s\n"
                     % (course_data, course_data.sis_account_id, course_data.course_name, course_data.course_code,
                        course_data.sis_term_id, course_data.primary_section_name()))
@@ -152,11 +168,11 @@ def create_canvas_course(sis_course_id, sis_user_id, bulk_job=None):
     # can be copied over to the new course
     if template_id:
         try:
-            template_course = get_single_course_courses(SDK_CONTEXT, template_id, 'all_courses').json()
+            template_settings = get_template_course_settings(template_id)
             # Update create course request parameters
             request_parameters.update({
-                'course_is_public': template_course['is_public'],
-                'course_public_syllabus': template_course['public_syllabus'],
+                'course_is_public': template_settings['is_public'],
+                'course_public_syllabus': template_settings['public_syllabus'],
             })
         except CanvasAPIError:
             logger.exception(
@@ -269,17 +285,62 @@ def create_canvas_course(sis_course_id, sis_user_id, bulk_job=None):
     return new_course
 
 
-def get_or_create_account(course_data, sis_course_id, course_job_id, bulk_job_id):
+def get_template_course_settings(template_id):
+    """
+    Returns the visibility settings of a Canvas template course which are copied over to the courses created from
+    it. The settings are cached (keyed by template id) for TEMPLATE_COURSE_SETTINGS_CACHE_TIMEOUT seconds, so a
+    bulk job only looks its template up in Canvas once; use invalidate_template_course_settings() to drop them
+    sooner, e.g. after the template course has been changed.
+
+        :param template_id: The Canvas course id of the template course
+        :type template_id: int
+        :return: dict with the template course's 'is_public' and 'public_syllabus' values
+        :raises: CanvasAPIError if the template course could not be retrieved
+    """
+    cache_key = _template_course_settings_cache_key(template_id)
+    template_settings = cache.get(cache_key)
+    if template_settings is None:
+        template_course = get_single_course_courses(SDK_CONTEXT, template_id, 'all_courses').json()
+        template_settings = {
+            'is_public': template_course['is_public'],
+            'public_syllabus': template_course['public_syllabus'],
+        }
+        cache.set(cache_key, template_settings,
+                  getattr(settings, 'TEMPLATE_COURSE_SETTINGS_CACHE_TIMEOUT', TEMPLATE_COURSE_SETTINGS_CACHE_TIMEOUT))
+    return template_settings
+
+
+def invalidate_template_course_settings(template_id):
+    """
+    Drops the cached visibility settings for the given template course (see get_template_course_settings)
+    """
+    cache.delete(_template_course_settings_cache_key(template_id))
+
+
+def _template_course_settings_cache_key(template_id):
+    return 'canvas_course_site_wizard:template_course_settings:%s' % template_id
+
+
+def get_or_create_account(course_data, sis_course_id, course_job_id, bulk_job_id, raise_exception=False):
     """
     Check if department or course group exists if not create it.
     See TLT-3689 and TLT-3878
+    Accounts which have been found in (or created in) Canvas are remembered in the cache for
+    CANVAS_ACCOUNT_EXISTS_CACHE_TIMEOUT seconds, so courses sharing an account only check it once.
+    If the account can't be created the course's job is marked as STATUS_SETUP_FAILED, unless raise_exception
+    is True, in which case the error is re-raised and the caller deals with the jobs of the account's courses.
     """
     account_id = None
     account = None
 
+    cache_key = _account_exists_cache_key(course_data.sis_account_id)
+    if cache.get(cache_key):
+        return account
+
     try:
         get_single_account(request_ctx=SDK_CONTEXT,
                            id='sis_account_id:%s' % course_data.sis_account_id)
+        _set_account_exists(cache_key)
     except CanvasAPIError:
         logger.info(f'Account does not exist for {course_data.sis_account_id}, creating one now')
 
@@ -298,8 +359,11 @@ def get_or_create_account(course_data, sis_course_id, course_job_id, bulk_job_id
                                        account_id=parent_account_id,
                                        account_name=account.name,
                                        sis_account_id=course_data.sis_account_id)
+                _set_account_exists(cache_key)
             except Exception:
                 logger.exception(f'Error creating account for {course_data.sis_account_id}.')
+                if raise_exception:
+                    raise
 
                 # Update the status to STATUS_SETUP_FAILED on any failures
                 update_course_generation_workflow_state(sis_course_id,
@@ -310,6 +374,15 @@ def get_or_create_account(course_data, sis_course_id, course_job_id, bulk_job_id
     return account
 
 
+def _account_exists_cache_key(sis_account_id):
+    return 'canvas_course_site_wizard:account_exists:%s' % sis_account_id
+
+
+def _set_account_exists(cache_key):
+    cache.set(cache_key, True, getattr(settings, 'CANVAS_ACCOUNT_EXISTS_CACHE_TIMEOUT',
+                                       CANVAS_ACCOUNT_EXISTS_CACHE_TIMEOUT))
+
+
 def start_course_template_copy(sis_course, canvas_course_id, user_id, course_job_id=None,
                                bulk_job_id=None, template_id=None):
     """
@@ -351,14 +424,20 @@ def start_course_template_copy(sis_course, canvas_course_id, user_id, course_job
     #  Update the status of   course generation job  with metadata (canvas id, workflow_state, progress url, etc)
     logger.debug('Update course generation job tracking row...')
 
-    course_generation_job.canvas_course_id = canvas_course_id
-    course_generation_job.content_migration_id = content_migration['id']
-    course_generation_job.workflow_state = CanvasCourseGenerationJob.STATUS_QUEUED
-    course_generation_job.status_url = content_migration['progress_url']
-    course_generation_job.created_by_user_id = user_id
-
-    course_generation_job.save(update_fields=['canvas_course_id', 'content_migration_id', 'status_url', 'workflow_state',
-                                      'created_by_user_id'])
+    # The migration is only recorded if the job is still in setup, so that two workers can't both start one
+    queued = course_generation_job.transition_workflow_state(
+        CanvasCourseGenerationJob.STATUS_SETUP,
+        CanvasCourseGenerationJob.STATUS_QUEUED,
+        canvas_course_id=canvas_course_id,
+        content_migration_id=content_migration['id'],
+        status_url=content_migration['progress_url'],
+        created_by_user_id=user_id
+    )
+    if not queued:
+        logger.warning('Content migration %s for canvas_course_id=%s was not recorded, as course generation job %s '
+                       'was no longer in setup (another worker may have started its migration)',
+                       content_migration['id'], canvas_course_id, course_generation_job.pk)
+        return course_generation_job
 
     logger.debug('Job row updated: %s' % course_generation_job)
 
@@ -501,14 +580,47 @@ def enroll_creator_in_new_course(sis_course_id, user_id):
 def get_canvas_user_profile(sis_user_id):
     """
     This method will fetch the canvas user profile , given the sis_user_id
+    Profiles are cached (keyed by sis_user_id) for CANVAS_USER_PROFILE_CACHE_TIMEOUT seconds, so a creator's profile
+    is only fetched once for all of their jobs. Users Canvas doesn't know are remembered for the (shorter)
+    CANVAS_USER_PROFILE_NOT_FOUND_CACHE_TIMEOUT; other errors are not cached. Use invalidate_canvas_user_profile()
+    to drop a cached profile sooner.
     :param sis_user_id: The sis_user_id of the user, without the sis_user_id: prefix
     :type sis_user_id: string
     return: Returns json representing the canvas user profile fetched by the canvas_sdk
+    :raises: CanvasUserProfileNotFound if Canvas has no user with the sis_user_id
     """
-    response = get_user_profile(request_ctx=SDK_CONTEXT, user_id='sis_user_id:%s' % sis_user_id)
+    cache_key = _canvas_user_profile_cache_key(sis_user_id)
+    canvas_user_profile = cache.get(cache_key)
+    if canvas_user_profile is False:
+        raise CanvasUserProfileNotFound(msg_details=sis_user_id)
+    if canvas_user_profile is not None:
+        return canvas_user_profile
+
+    try:
+        response = get_user_profile(request_ctx=SDK_CONTEXT, user_id='sis_user_id:%s' % sis_user_id)
+    except CanvasAPIError as e:
+        if e.status_code != 404:
+            raise
+        cache.set(cache_key, False, getattr(settings, 'CANVAS_USER_PROFILE_NOT_FOUND_CACHE_TIMEOUT',
+                                            CANVAS_USER_PROFILE_NOT_FOUND_CACHE_TIMEOUT))
+        raise CanvasUserProfileNotFound(msg_details=sis_user_id)
     canvas_user_profile = response.json()
+    cache.set(cache_key, canvas_user_profile, getattr(settings, 'CANVAS_USER_PROFILE_CACHE_TIMEOUT',
+                                                      CANVAS_USER_PROFILE_CACHE_TIMEOUT))
     return canvas_user_profile
 
+
+def invalidate_canvas_user_profile(sis_user_id):
+    """
+    Drops the cached Canvas user profile (or record of its absence) for the given user (see get_canvas_user_profile)
+    """
+    cache.delete(_canvas_user_profile_cache_key(sis_user_id))
+
+
+def _canvas_user_profile_cache_key(sis_user_id):
+    return 'canvas_course_site_wizard:canvas_user_profile:%s' % sis_user_id
+
+
 def send_email_helper(subject, message, to_address):
     """
     This is a helper method to send email using django's mail module. The mail
@@ -527,7 +639,8 @@ def send_email_helper(subject, message, to_address):
 
 def send_failure_email(initiator_email, sis_course_id):
     """
-    This is a utility to send an email on failure of course migration . It appemds the support email
+    This is a utility to send an email on failure of course migration . The email is queued in the outbox and sent
+    by the next email_outbox.dispatch_email_outbox(). It appemds the support email
     to the to_address list and also retrives the necessary subject and body from the settings file.
     Note: It is used  in multiple places and abstracts the details of building the email list and body from the
     calling method
@@ -546,11 +659,12 @@ def send_failure_email(initiator_email, sis_course_id):
 
     logger.debug(" notifying  failure via email:  to_addr=%s and message=%s"
                  % (to_address, settings.CANVAS_EMAIL_NOTIFICATION['course_migration_failure_body']))
-    send_email_helper(settings.CANVAS_EMAIL_NOTIFICATION['course_migration_failure_subject'], complete_msg, to_address)
+    queue_email(settings.CANVAS_EMAIL_NOTIFICATION['course_migration_failure_subject'], complete_msg, to_address)
 
 def send_failure_msg_to_support(sis_course_id, sis_user_id, error_detail):
     """
-    This is a utility to send an email to the support group when there is a  failure in course creation . 
+    This is a utility to send an email to the support group when there is a  failure in course creation . The
+    email is queued in the outbox and sent by the next email_outbox.dispatch_email_outbox().
 
     :param sis_course_id: The sis_course_id, so it can be appended to the email details, a String
     :param sis_user_id: The sis_user_id of user  initiating the course creation, a String
@@ -565,7 +679,7 @@ def send_failure_msg_to_support(sis_course_id, sis_user_id, error_detail):
                               settings.CANVAS_EMAIL_NOTIFICATION['environment'])
     logger.debug(" send_failure_msg_to_support: sis_course_id=%s, user=%s, complete_msg=%s",
                  sis_course_id, sis_user_id, complete_msg)
-    send_email_helper(settings.CANVAS_EMAIL_NOTIFICATION['support_email_subject_on_failure'], complete_msg, to_address)
+    queue_email(settings.CANVAS_EMAIL_NOTIFICATION['support_email_subject_on_failure'], complete_msg, to_address)
 
 def get_canvas_course_url(canvas_course_id=None, sis_course_id=None, override_base_url=None):
     """
@@ -603,14 +717,16 @@ def get_canvas_course_url(canvas_course_id=None, sis_course_id=None, override_ba
 
 def update_course_generation_workflow_state(sis_course_id, workflow_state, course_job_id=None, bulk_job_id=None):
     """
-    Update the CanvasCourseGenerationJob record of the sis_course_id with the workflow_state passed in
+    Update the CanvasCourseGenerationJob record of the sis_course_id with the workflow_state passed in, if it is
+    still in the workflow_state it was read in (see CanvasCourseGenerationJob.transition_workflow_state). Returns
+    True if the job was updated.
     :param term_id: The term_id of the term
     :param workflow_state: One of the states from the CanvasCourseGenerationJob's  WORKFLOW_STATUS_CHOICES
     """
     course_job = get_course_generation_data_for_sis_course_id(sis_course_id, course_job_id=course_job_id, bulk_job_id=bulk_job_id)
     if course_job:
-        course_job.workflow_state = workflow_state
-        course_job.save(update_fields=['workflow_state'])
+        return course_job.transition_workflow_state(course_job.workflow_state, workflow_state)
+    return False
 
 
 def check_and_update_xlist_last_updated(course_instance_id):
@@ -0,0 +1,114 @@
+"""
+Queues email notifications in the EmailOutbox table, and sends them in batches over one reused mail server
+connection.
+"""
+import logging
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import F
+from django.utils import timezone
+
+from .models import EmailOutbox, get_job_lease_owner
+
+logger = logging.getLogger(__name__)
+
+# Defaults for the EMAIL_OUTBOX_* settings
+EMAIL_OUTBOX_BATCH_SIZE = 50
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+# Seconds before the first retry of a message which couldn't be sent; doubled for each further attempt
+EMAIL_OUTBOX_RETRY_DELAY = 60
+# Seconds a dispatcher holds the messages it is sending before other dispatchers may pick them up
+EMAIL_OUTBOX_CLAIM_SECONDS = 5 * 60
+
+
+def queue_email(subject, message, to_address):
+    """
+    Adds an email to the outbox; it is sent by the next dispatch_email_outbox(). Takes the same arguments as
+    controller.send_email_helper.
+    :param subject: The subject for the email, a String
+    :param message: The body of the email, a String
+    :param to_address: The list of recepients, a list of Strings
+    """
+    from_address = settings.CANVAS_EMAIL_NOTIFICATION['from_email_address']
+    logger.info("==>Queueing email: from_addr=%s, to_addr=%s, subject=%s" % (from_address, to_address, subject))
+    return EmailOutbox.objects.queue(subject, message, from_address, to_address)
+
+
+def dispatch_email_outbox(batch_size=None):
+    """
+    Sends the messages in the outbox which are due, a batch at a time, over a single mail server connection
+    (opened only if there is something to send). A message which can't be sent is retried on a later dispatch,
+    after a delay which doubles with each attempt, until EMAIL_OUTBOX_MAX_ATTEMPTS attempts have failed. Several
+    dispatchers may run at once; each claims its own messages.
+    Returns a tuple of the numbers of messages sent and failed.
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'EMAIL_OUTBOX_BATCH_SIZE', EMAIL_OUTBOX_BATCH_SIZE)
+    claim_seconds = getattr(settings, 'EMAIL_OUTBOX_CLAIM_SECONDS', EMAIL_OUTBOX_CLAIM_SECONDS)
+    claimed_by = '%s:%s' % (get_job_lease_owner(), uuid.uuid4().hex[:8])
+
+    sent = failed = 0
+    connection = None
+    try:
+        while True:
+            messages = EmailOutbox.objects.claim_due_messages(claimed_by, batch_size, claim_seconds)
+            if not messages:
+                break
+            if connection is None:
+                connection = get_connection(fail_silently=False)
+            batch_sent, batch_failed = _send_batch(connection, messages)
+            sent += batch_sent
+            failed += batch_failed
+    finally:
+        if connection is not None:
+            connection.close()
+
+    if sent or failed:
+        logger.info('Email outbox: %d messages sent, %d failed', sent, failed)
+    return sent, failed
+
+
+def _send_batch(connection, messages):
+    """
+    sends the messages over the connection, and records the outcome of each as soon as it is known, so that the
+    messages already delivered aren't sent again if the dispatcher dies part way through; returns (sent, failed)
+    counts
+    """
+    sent = failed = 0
+    for message in messages:
+        try:
+            # opens the connection the first time, and again after a failure closed it; the backend's
+            # send_messages() would otherwise open and close a connection for every message
+            connection.open()
+            EmailMessage(message.subject, message.message, message.from_address, message.get_to_addresses(),
+                         connection=connection).send()
+        except Exception as e:
+            logger.exception('Email outbox: problem sending message %s (attempt %d)', message.pk,
+                             message.attempts + 1)
+            _record_failure(message, e)
+            failed += 1
+            # the connection may be unusable now; it will be reopened for the next message
+            connection.close()
+            continue
+        EmailOutbox.objects.filter(pk=message.pk).update(status=EmailOutbox.STATUS_SENT, sent_at=timezone.now(),
+                                                         attempts=F('attempts') + 1, claimed_by=None)
+        sent += 1
+    return sent, failed
+
+
+def _record_failure(message, error):
+    max_attempts = getattr(settings, 'EMAIL_OUTBOX_MAX_ATTEMPTS', EMAIL_OUTBOX_MAX_ATTEMPTS)
+    retry_delay = getattr(settings, 'EMAIL_OUTBOX_RETRY_DELAY', EMAIL_OUTBOX_RETRY_DELAY)
+
+    message.attempts += 1
+    message.last_error = str(error)
+    message.claimed_by = None
+    if message.attempts >= max_attempts:
+        logger.error('Email outbox: giving up on message %s after %d attempts', message.pk, message.attempts)
+        message.status = EmailOutbox.STATUS_FAILED
+    else:
+        message.next_attempt_at = timezone.now() + timedelta(seconds=retry_delay * 2 ** (message.attempts - 1))
+    message.save(update_fields=['attempts', 'last_error', 'claimed_by', 'status', 'next_attempt_at'])
@@ -27,6 +27,19 @@ class MultipleDefaultTemplatesExistForSchool(Exception):
         return 'Multiple default templates exist for school_id=%s' % self.school_id
 
 
+class InvalidWorkflowStateTransition(Exception):
+    def __init__(self, model_name, from_state, to_state):
+        self.model_name = model_name
+        self.from_state = from_state
+        self.to_state = to_state
+
+    def __unicode__(self):
+        return '%s can not move from %s to %s' % (self.model_name, self.from_state, self.to_state)
+
+    def __str__(self):
+        return '%s can not move from %s to %s' % (self.model_name, self.from_state, self.to_state)
+
+
 class RenderableExceptionWithDetails(RenderableException):
     # The parameter msg_details can be used to format the message (i.e. it can be substituted into the
     # display text)
@@ -46,6 +59,11 @@ class NoCanvasUserToEnroll(RenderableExceptionWithDetails):
     status_code = 404  # Canvas user not found
 
 
+class CanvasUserProfileNotFound(RenderableExceptionWithDetails):
+    display_text = 'Error: Canvas user profile not found for user {0}'
+    status_code = 404  # Canvas user not found
+
+
 class CanvasEnrollmentError(RenderableExceptionWithDetails):
     display_text = 'Error: Site creator not added for CID {0}'
 
@@ -97,3 +115,8 @@ class SaveCanvasCourseIdToCourseGenerationJobError(RenderableExceptionWithDetail
 
 class SaveCanvasCourseIdToCourseInstanceError(RenderableExceptionWithDetails):
     display_text = 'Unable to save Canvas course id {0} to course instance {1}'
+
+
+class CanvasSISImportError(Exception):
+    """ Raised when a Canvas SIS import could not be submitted or did not finish successfully """
+    pass
@@ -0,0 +1,28 @@
+"""
+Send the email notifications waiting in the EmailOutbox table.
+    To invoke this Command type "python manage.py dispatch_email_outbox"
+"""
+import logging
+
+from django.core.management.base import BaseCommand
+
+from canvas_course_site_wizard.email_outbox import dispatch_email_outbox
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Sends the queued email notifications which are due. The process_async_jobs and finalize_bulk_create_jobs
+    commands already do this at the end of each run; this command can be scheduled to catch up on retries between
+    runs.
+    """
+    help = "Send the email notifications waiting in the EmailOutbox table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Messages sent per batch (default: EMAIL_OUTBOX_BATCH_SIZE setting)')
+
+    def handle(self, **options):
+        sent, failed = dispatch_email_outbox(batch_size=options.get('batch_size'))
+        logger.info('dispatch_email_outbox: %d messages sent, %d failed', sent, failed)
@@ -1,31 +1,53 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime
 import fcntl
+import functools
 import logging
+import time
+import uuid
+from urllib.parse import urlparse
 
 from django.core.management.base import BaseCommand
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections
 
+from canvas_sdk.methods.courses import update_course
 from canvas_course_site_wizard.controller import (get_canvas_user_profile,
-                                                  send_email_helper,
                                                   create_canvas_course,
                                                   get_course_data,
+                                                  get_or_create_account,
+                                                  get_template_course_settings,
                                                   start_course_template_copy)
+from canvas_course_site_wizard.models_api import get_course_data_for_sis_course_ids
 from canvas_course_site_wizard.models import (BulkCanvasCourseCreationJob as BulkJob,
-                                              CanvasCourseGenerationJob)
+                                              CanvasCourseGenerationJob,
+                                              CanvasCourseGenerationJobUpdateBuffer,
+                                              SISCourseData,
+                                              get_job_lease_owner,
+                                              job_leasing_enabled)
 from canvas_course_site_wizard.exceptions import (NoTemplateExistsForSchool,
                                                   CanvasCourseAlreadyExistsError,
                                                   CourseGenerationJobCreationError,
                                                   CanvasCourseCreateError,
                                                   CanvasSectionCreateError)
-from icommons_common.canvas_utils import SessionInactivityExpirationRC
+from canvas_course_site_wizard.email_outbox import dispatch_email_outbox, queue_email
+from canvas_course_site_wizard.sis_import import create_canvas_courses_with_sis_import
+from canvas_course_site_wizard.throttling import ThrottledRequestContext
 from icommons_common.models import Term, School
 
-SDK_CONTEXT = SessionInactivityExpirationRC(**settings.CANVAS_SDK_SETTINGS)
+SDK_CONTEXT = ThrottledRequestContext(**settings.CANVAS_SDK_SETTINGS)
 
 logger = logging.getLogger(__name__)
 tech_logger = logging.getLogger('tech_mail')
 
+# Seconds a course setup slot (see _setup_slot) is held at most (if its holder dies), and how often a worker waiting
+# for a slot checks for a free one
+SETUP_SLOT_TIMEOUT = 5 * 60
+SETUP_SLOT_RETRY_INTERVAL = 0.5
+
 
 class Command(BaseCommand):
     """
@@ -37,15 +59,19 @@ class Command(BaseCommand):
 
     def handle(self, **options):
 
-        # open and lock the file used for determining if another process is running
-        _pid_file = getattr(settings, 'FINALIZE_BULK_CREATE_JOBS_PID_FILE', 'finalize_bulk_create_jobs.pid')
-        _pid_file_handle = open(_pid_file, 'w')
-        try:
-            fcntl.lockf(_pid_file_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except IOError as e:
-            # another instance is running
-            logger.warning(f"another instance of the command is already running: {e}")
-            return
+        # open and lock the file used for determining if another process is running; not needed when the jobs
+        # are leased, as any number of instances can then run at once
+        leasing = job_leasing_enabled()
+        _pid_file_handle = None
+        if not leasing:
+            _pid_file = getattr(settings, 'FINALIZE_BULK_CREATE_JOBS_PID_FILE', 'finalize_bulk_create_jobs.pid')
+            _pid_file_handle = open(_pid_file, 'w')
+            try:
+                fcntl.lockf(_pid_file_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                # another instance is running
+                logger.warning(f"another instance of the command is already running: {e}")
+                return
 
         start_time = datetime.now()
 
@@ -58,23 +84,24 @@ class Command(BaseCommand):
         # Process to finalize the bulk job
         ###
 
-        jobs = BulkJob.objects.get_jobs_by_status(BulkJob.STATUS_PENDING)
+        # pending bulk jobs whose subjobs are all finished, along with their subjob success and failure counts
+        jobs = BulkJob.objects.get_jobs_ready_to_finalize()
 
         jobs_count = len(jobs)
         if not jobs_count:
-            logger.info('No pending bulk create jobs found.')
+            logger.info('No pending bulk create jobs ready to be finalized found.')
         else:
-            logger.info('Found %d pending bulk create jobs.', jobs_count)
+            logger.info('Found %d pending bulk create jobs ready to be finalized.', jobs_count)
 
         for job in jobs:
-            logger.debug('Checking if all subjobs are finished for pending bulk create job %s ', job.id)
-            if not job.ready_to_finalize():
-                logger.debug('Job %s is not ready to be finalized, leaving pending.', job.id)
-                continue
-
             logger.info('Finalizing job %s...', job.id)
 
-            if not job.update_status(BulkJob.STATUS_FINALIZING):
+            if leasing:
+                # other instances may be finalizing the same jobs; only one of them gets to move it out of PENDING
+                if not job.start_finalizing():
+                    logger.info('Job %s is already being finalized by another worker', job.id)
+                    continue
+            elif not job.update_status(BulkJob.STATUS_FINALIZING):
                 logger.exception("Job %s: problem saving finalization status", job.id)
                 continue
 
@@ -94,9 +121,18 @@ class Command(BaseCommand):
 
         _log_bulk_job_statistics()
 
+        # send the notifications queued above
+        try:
+            dispatch_email_outbox()
+        except Exception:
+            # the messages stay in the outbox, and are sent on a later run
+            logger.exception('error sending queued email notifications')
+
         logger.info('command took %s seconds to run', str(datetime.now() - start_time))
 
         # unlock and close the file used for determining if another process is running
+        if _pid_file_handle is None:
+            return
         try:
             fcntl.lockf(_pid_file_handle, fcntl.LOCK_UN)
             _pid_file_handle.close()
@@ -108,81 +144,362 @@ def _init_courses_with_status_setup():
     """
     get all records in the canvas course generation job table that have the status 'setup'.
     These are courses that have not been created, they only have a CanvasCourseGenerationJob with a 'setup' status.
-    This method will create the course and update the status to QUEUED
+    This method will create the course and update the status to QUEUED.
+    If BULK_COURSE_CREATION['setup_engine'] is 'sis_import' the courses are all created in Canvas with a single
+    SIS import (see _setup_courses_with_sis_import). Otherwise they are created through the course API: concurrently
+    in a thread or process pool (see _setup_courses_concurrently) if BULK_COURSE_CREATION['setup_workers'] is
+    greater than 1, or one at a time.
+    With job leasing enabled the jobs are claimed (see CanvasCourseGenerationJobManager.claim_jobs) a batch at a
+    time, so that several workers can share them. With the sis_import engine each claimed batch is created with one
+    SIS import, and the leases on the batch are renewed each time the import is polled, as the import can take much
+    longer than a lease. Otherwise each claimed batch is set up in sub-batches of
+    BULK_COURSE_CREATION['setup_lease_renewal_batch_size'] jobs, and the leases on the jobs still to be set up are
+    renewed before each sub-batch, so that they don't run out while the batch is being worked on; jobs whose leases
+    have been taken over by another worker are dropped.
     """
 
-    create_jobs = CanvasCourseGenerationJob.objects.filter_setup_for_bulkjobs()
+    if not job_leasing_enabled():
+        _setup_courses(CanvasCourseGenerationJob.objects.filter_setup_for_bulkjobs())
+        return
+
+    # claim and set up a batch of jobs at a time, so that other workers can set up the rest
+    lease_owner = get_job_lease_owner()
+    batch_size = _get_bulk_setting('setup_lease_batch_size', 100)
+    renewal_batch_size = _get_bulk_setting('setup_lease_renewal_batch_size', 10)
+    last_pk = None
+    while True:
+        create_jobs = CanvasCourseGenerationJob.objects.claim_jobs(
+            lease_owner, batch_size, after_pk=last_pk,
+            workflow_state=CanvasCourseGenerationJob.STATUS_SETUP, bulk_job_id__isnull=False)
+        if not create_jobs:
+            return
+        last_pk = create_jobs[-1].pk
+        try:
+            if _get_bulk_setting('setup_engine', 'api') == 'sis_import':
+                _setup_courses(create_jobs,
+                               renew_leases=functools.partial(CanvasCourseGenerationJob.objects.renew_leases,
+                                                              lease_owner, create_jobs))
+                continue
+            remaining = create_jobs
+            while remaining:
+                remaining = CanvasCourseGenerationJob.objects.renew_leases(lease_owner, remaining)
+                if not remaining:
+                    break
+                _setup_courses(remaining[:renewal_batch_size])
+                remaining = remaining[renewal_batch_size:]
+        finally:
+            CanvasCourseGenerationJob.objects.release_jobs(lease_owner, create_jobs)
+
+
+def _setup_courses(create_jobs, renew_leases=None):
+    """
+    Sets up the Canvas courses for the given CanvasCourseGenerationJobs (see _init_courses_with_status_setup).
+    renew_leases, if given, is called while waiting on an SIS import to keep the jobs' leases from running out.
+    If BULK_COURSE_CREATION['max_concurrent_setup_jobs'] is set, no more than that many courses are created through
+    the course API at once against the Canvas host, across all of the workers and runs sharing the cache (see
+    _setup_slot).
+    """
+    create_jobs = list(create_jobs)
+    CanvasCourseGenerationJob.objects.mark_setup_started(create_jobs)
     # Get the bulk job parent for each course job and map by id for later use
     bulk_jobs = {b.id: b for b in BulkJob.objects.filter(id__in=[j.bulk_job_id for j in create_jobs])}
+    # Load the SIS course data for all of the courses up front rather than one course at a time
+    course_data = get_course_data_for_sis_course_ids([j.sis_course_id for j in create_jobs if j.sis_course_id])
+
+    # workflow state changes made here are buffered and written in batches; the buffer is flushed on the way out
+    with CanvasCourseGenerationJobUpdateBuffer() as job_updates:
+        if _get_bulk_setting('setup_engine', 'api') == 'sis_import':
+            _setup_courses_with_sis_import(create_jobs, bulk_jobs, course_data, job_updates, renew_leases)
+            return
+
+        max_concurrent = _get_bulk_setting('max_concurrent_setup_jobs', None)
+        workers = _get_bulk_setting('setup_workers', 1)
+        if workers > 1:
+            _setup_courses_concurrently(create_jobs, bulk_jobs, course_data, workers, job_updates, max_concurrent)
+            return
 
-    # for each or the records above, create the course and update the status
+        # for each or the records above, create the course and update the status
+        for create_job in create_jobs:
+            _setup_course_in_slot(create_job, bulk_jobs.get(create_job.bulk_job_id),
+                                  course_data.get(str(create_job.sis_course_id)), job_updates, max_concurrent)
+
+
+def _setup_courses_with_sis_import(create_jobs, bulk_jobs, course_data, job_updates, renew_leases=None):
+    """
+    Creates the Canvas courses (and primary sections) for all of the create_jobs with one Canvas SIS import, then
+    saves the new Canvas course ids to the jobs and course instances and starts the template copies, as
+    _setup_course does for a single course. Jobs whose courses could not be created are marked as
+    STATUS_SETUP_FAILED. renew_leases, if given, is called each time the import is polled.
+    """
+    jobs_to_import = []
     for create_job in create_jobs:
-        # for each job we need to get the bulk_job_id, user, and course id, these are
-        # needed by the calls to create the course below. If any of these break, mark the course as failed
-        # and continue to the next course.
         bulk_job = bulk_jobs.get(create_job.bulk_job_id)
-        if not bulk_job:
-            create_job.update_workflow_state(CanvasCourseGenerationJob.STATUS_SETUP_FAILED)
+        sis_course_data = course_data.get(str(create_job.sis_course_id))
+        if not (bulk_job and create_job.created_by_user_id and sis_course_data):
+            _update_workflow_state(create_job, CanvasCourseGenerationJob.STATUS_SETUP_FAILED, job_updates)
             continue
-        bulk_job_id = bulk_job.id
-
-        sis_user_id = create_job.created_by_user_id
-        if not sis_user_id:
-            create_job.update_workflow_state(CanvasCourseGenerationJob.STATUS_SETUP_FAILED)
+        if sis_course_data.canvas_course_id:
+            # the import would update the existing course rather than failing, as create_canvas_course does
+            logger.error(CanvasCourseAlreadyExistsError(msg_details=create_job.sis_course_id).display_text)
+            _update_workflow_state(create_job, CanvasCourseGenerationJob.STATUS_SETUP_FAILED, job_updates)
             continue
+        jobs_to_import.append((create_job, bulk_job, sis_course_data))
 
-        sis_course_id = create_job.sis_course_id
-        if not sis_course_id:
-            create_job.update_workflow_state(CanvasCourseGenerationJob.STATUS_SETUP_FAILED)
-            continue
+    if not jobs_to_import:
+        return
 
-        # try to create the canvas course - create_canvas_course has been modified so it will not
-        # try to create a new CanvasCourseGenerationJob record if a bulk_job is present
+    # the import needs the courses' accounts to exist already; only check each account once, and leave all of the
+    # courses in an account which can't be found or created out of the import
+    courses_by_account = {data.sis_account_id: (job, data) for job, _, data in jobs_to_import}
+    failed_accounts = set()
+    for sis_account_id, (create_job, sis_course_data) in courses_by_account.items():
         try:
-            logger.info(
-                'calling create_canvas_course(%s, %s, bulk_job_id=%s)',
-                sis_course_id, sis_user_id,
-                bulk_job_id
-            )
-            course = create_canvas_course(
-                sis_course_id,
-                sis_user_id,
-                bulk_job=bulk_job,
-            )
-        except (CanvasCourseAlreadyExistsError, CourseGenerationJobCreationError, CanvasCourseCreateError,
-                CanvasSectionCreateError):
-            message = 'content migration error for course with id %s' % sis_course_id
-            logger.exception(message)
-            create_job.update_workflow_state(CanvasCourseGenerationJob.STATUS_SETUP_FAILED)
+            get_or_create_account(sis_course_data, create_job.sis_course_id, None, create_job.bulk_job_id,
+                                  raise_exception=True)
+        except Exception:
+            logger.exception('Could not find or create account %s, failing the setup of its courses', sis_account_id)
+            failed_accounts.add(sis_account_id)
+    if failed_accounts:
+        for create_job, _, sis_course_data in jobs_to_import:
+            if sis_course_data.sis_account_id in failed_accounts:
+                _update_workflow_state(create_job, CanvasCourseGenerationJob.STATUS_SETUP_FAILED, job_updates)
+        jobs_to_import = [(create_job, bulk_job, sis_course_data)
+                          for create_job, bulk_job, sis_course_data in jobs_to_import
+                          if sis_course_data.sis_account_id not in failed_accounts]
+        if not jobs_to_import:
+            return
+
+    logger.info('Creating %d courses with an SIS import', len(jobs_to_import))
+    try:
+        canvas_course_ids = create_canvas_courses_with_sis_import([data for _, _, data in jobs_to_import],
+                                                                  on_poll=renew_leases)
+    except Exception:
+        logger.exception('SIS import failed for %d courses', len(jobs_to_import))
+        for create_job, _, _ in jobs_to_import:
+            _update_workflow_state(create_job, CanvasCourseGenerationJob.STATUS_SETUP_FAILED, job_updates)
+        return
+
+    # save the new Canvas course ids to the jobs and course instances
+    created = []
+    for create_job, bulk_job, sis_course_data in jobs_to_import:
+        canvas_course_id = canvas_course_ids.get(str(create_job.sis_course_id))
+        if not canvas_course_id:
+            logger.error('SIS import did not create a Canvas course for course instance id %s',
+                         create_job.sis_course_id)
+            _update_workflow_state(create_job, CanvasCourseGenerationJob.STATUS_SETUP_FAILED, job_updates)
             continue
+        job_updates.update(create_job, canvas_course_id=canvas_course_id)
+        sis_course_data.canvas_course_id = canvas_course_id
+        created.append((create_job, bulk_job, sis_course_data))
+    SISCourseData.objects.bulk_update([data for _, _, data in created], ['canvas_course_id'], batch_size=1000)
+    job_updates.flush()
 
-        # get the course data - this is needed for the start_course_template_copy method
+    for create_job, bulk_job, sis_course_data in created:
         try:
-            sis_course_data = get_course_data(sis_course_id)
-        except ObjectDoesNotExist:
-            message = 'Course id %s does not exist, skipping....' % sis_course_id
-            logger.exception(message)
-            create_job.update_workflow_state(CanvasCourseGenerationJob.STATUS_SETUP_FAILED)
+            _apply_template_course_settings(sis_course_data.canvas_course_id, bulk_job.template_canvas_course_id)
+        except Exception:
+            logger.exception('Failed to apply template course settings to course instance id %s',
+                             create_job.sis_course_id)
+            _update_workflow_state(create_job, CanvasCourseGenerationJob.STATUS_SETUP_FAILED, job_updates)
             continue
+        _start_template_copy(create_job, bulk_job, sis_course_data, sis_course_data.canvas_course_id, job_updates)
+
+
+def _apply_template_course_settings(canvas_course_id, template_id):
+    """
+    SIS imports can't set the visibility settings which create_canvas_course copies over from the template
+    course, so update the course with them; only needed if they differ from the Canvas defaults (off)
+    """
+    if not template_id:
+        return
+    template_settings = get_template_course_settings(template_id)
+    if template_settings['is_public'] or template_settings['public_syllabus']:
+        update_course(SDK_CONTEXT, canvas_course_id,
+                      course_is_public=template_settings['is_public'],
+                      course_public_syllabus=template_settings['public_syllabus'])
+
 
-        # Initiate the async job to copy the course template, if a template was selected for the bulk job
-        if bulk_job.template_canvas_course_id:
+def _setup_courses_concurrently(create_jobs, bulk_jobs, course_data, workers, job_updates, max_concurrent=None):
+    """
+    Runs _setup_course for each of the create_jobs in a pool of `workers` threads (or processes, if
+    BULK_COURSE_CREATION['setup_pool'] is 'process'), each course in one of the max_concurrent setup slots for the
+    Canvas host if max_concurrent is given (see _setup_slot). Thread workers share the job_updates buffer; process
+    workers can't, so they write their job updates directly.
+    """
+    pool_type = _get_bulk_setting('setup_pool', 'thread')
+
+    if pool_type == 'process':
+        executor_class = ProcessPoolExecutor
+        job_updates = None
+        # forked workers must not inherit (and share) the parent's open DB connections
+        connections.close_all()
+    else:
+        executor_class = ThreadPoolExecutor
+
+    logger.info('Setting up %d courses with %d %s workers (max %s at once against the Canvas host)',
+                len(create_jobs), workers, pool_type, max_concurrent or workers)
+
+    with executor_class(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_setup_course_in_worker, create_job, bulk_jobs.get(create_job.bulk_job_id),
+                            course_data.get(str(create_job.sis_course_id)), job_updates, max_concurrent): create_job
+            for create_job in create_jobs
+        }
+        for future in as_completed(futures):
             try:
-                start_course_template_copy(
-                    sis_course_data,
-                    course['id'],
-                    sis_user_id,
-                    course_job_id=create_job.pk,
-                    bulk_job_id=bulk_job_id,
-                    template_id=bulk_job.template_canvas_course_id
-                )
+                future.result()
             except Exception:
-                logger.exception('template migration failed for course instance id %s' % sis_course_id)
-                create_job.update_workflow_state(CanvasCourseGenerationJob.STATUS_SETUP_FAILED)
+                # failures expected for individual courses are handled (and the job marked as STATUS_SETUP_FAILED)
+                # by _setup_course, so this is something unexpected; log it and let the other workers carry on
+                logger.exception('Unexpected error setting up course for job %s', futures[future].pk)
+
+
+def _setup_course_in_worker(create_job, bulk_job, sis_course_data, job_updates, max_concurrent=None):
+    """
+    Runs _setup_course (see _setup_course_in_slot) from a pool worker. Django hands each worker thread (or process)
+    its own DB connection; it is closed once the course has been set up so that connections don't outlive the pool.
+    """
+    try:
+        _setup_course_in_slot(create_job, bulk_job, sis_course_data, job_updates, max_concurrent)
+    finally:
+        connections.close_all()
+
+
+def _setup_course_in_slot(create_job, bulk_job, sis_course_data, job_updates, max_concurrent=None):
+    """ runs _setup_course, in one of the max_concurrent setup slots for the Canvas host if max_concurrent is given """
+    if not max_concurrent:
+        _setup_course(create_job, bulk_job, sis_course_data, job_updates)
+        return
+    with _setup_slot(max_concurrent):
+        _setup_course(create_job, bulk_job, sis_course_data, job_updates)
+
+
+@contextmanager
+def _setup_slot(max_concurrent):
+    """
+    Waits for, and holds, one of the max_concurrent course setup slots for the Canvas host in CANVAS_SDK_SETTINGS.
+    Each slot is a cache key taken with cache.add() (which only succeeds if the key isn't set), so the limit is
+    shared by every worker and run using the same cache (as for the Canvas rate limit bucket, the cache needs to be
+    one shared between processes, e.g. memcached, for process pools or several hosts). A slot expires after
+    SETUP_SLOT_TIMEOUT seconds, so that one whose holder has died is freed.
+    """
+    token = uuid.uuid4().hex
+    slot_key = None
+    while slot_key is None:
+        for slot in range(max_concurrent):
+            if cache.add(_setup_slot_key(slot), token, SETUP_SLOT_TIMEOUT):
+                slot_key = _setup_slot_key(slot)
+                break
         else:
-            logger.info('no template selected for  %s' % sis_course_id)
-            # When there's no template, it doesn't need any migration and the job is ready to be finalized
-            create_job.update_workflow_state(CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE)
+            time.sleep(SETUP_SLOT_RETRY_INTERVAL)
+    try:
+        yield
+    finally:
+        # leave the slot alone if it expired and was taken by another worker
+        if cache.get(slot_key) == token:
+            cache.delete(slot_key)
+
+
+def _setup_slot_key(slot):
+    return 'canvas_course_site_wizard:setup_slot:%s:%d' % (urlparse(SDK_CONTEXT.base_api_url).netloc, slot)
+
+
+def _setup_course(create_job, bulk_job, sis_course_data=None, job_updates=None):
+    """
+    Creates the Canvas course for a single CanvasCourseGenerationJob in the 'setup' state and starts the template
+    copy for it (or marks it as ready to be finalized if the bulk job has no template). Any failure marks the job
+    as STATUS_SETUP_FAILED. sis_course_data is the course's preloaded SISCourseData, if available; workflow state
+    changes go through the job_updates buffer, if one is given.
+    """
+    # for each job we need to get the bulk_job_id, user, and course id, these are
+    # needed by the calls to create the course below. If any of these break, mark the course as failed
+    # and continue to the next course.
+    if not bulk_job:
+        _update_workflow_state(create_job, CanvasCourseGenerationJob.STATUS_SETUP_FAILED, job_updates)
+        return
+    bulk_job_id = bulk_job.id
+
+    sis_user_id = create_job.created_by_user_id
+    if not sis_user_id:
+        _update_workflow_state(create_job, CanvasCourseGenerationJob.STATUS_SETUP_FAILED, job_updates)
+        return
+
+    sis_course_id = create_job.sis_course_id
+    if not sis_course_id:
+        _update_workflow_state(create_job, CanvasCourseGenerationJob.STATUS_SETUP_FAILED, job_updates)
+        return
+
+    # try to create the canvas course - create_canvas_course has been modified so it will not
+    # try to create a new CanvasCourseGenerationJob record if a bulk_job is present
+    try:
+        logger.info(
+            'calling create_canvas_course(%s, %s, bulk_job_id=%s)',
+            sis_course_id, sis_user_id,
+            bulk_job_id
+        )
+        course = create_canvas_course(
+            sis_course_id,
+            sis_user_id,
+            bulk_job=bulk_job,
+            course_data=sis_course_data,
+        )
+    except (CanvasCourseAlreadyExistsError, CourseGenerationJobCreationError, CanvasCourseCreateError,
+            CanvasSectionCreateError):
+        message = 'content migration error for course with id %s' % sis_course_id
+        logger.exception(message)
+        _update_workflow_state(create_job, CanvasCourseGenerationJob.STATUS_SETUP_FAILED, job_updates)
+        return
+
+    # get the course data (if it wasn't preloaded) - this is needed for the start_course_template_copy method
+    try:
+        if sis_course_data is None:
+            sis_course_data = get_course_data(sis_course_id)
+    except ObjectDoesNotExist:
+        message = 'Course id %s does not exist, skipping....' % sis_course_id
+        logger.exception(message)
+        _update_workflow_state(create_job, CanvasCourseGenerationJob.STATUS_SETUP_FAILED, job_updates)
+        return
+
+    _start_template_copy(create_job, bulk_job, sis_course_data, course['id'], job_updates)
+
+
+def _start_template_copy(create_job, bulk_job, sis_course_data, canvas_course_id, job_updates=None):
+    """
+    Starts the async job copying the bulk job's template into the newly created Canvas course, or marks the job
+    as ready to be finalized if the bulk job has no template
+    """
+    sis_course_id = create_job.sis_course_id
+    # Initiate the async job to copy the course template, if a template was selected for the bulk job
+    if bulk_job.template_canvas_course_id:
+        try:
+            start_course_template_copy(
+                sis_course_data,
+                canvas_course_id,
+                create_job.created_by_user_id,
+                course_job_id=create_job.pk,
+                bulk_job_id=bulk_job.id,
+                template_id=bulk_job.template_canvas_course_id
+            )
+        except Exception:
+            logger.exception('template migration failed for course instance id %s' % sis_course_id)
+            _update_workflow_state(create_job, CanvasCourseGenerationJob.STATUS_SETUP_FAILED, job_updates)
+    else:
+        logger.info('no template selected for  %s' % sis_course_id)
+        # When there's no template, it doesn't need any migration and the job is ready to be finalized
+        _update_workflow_state(create_job, CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE, job_updates)
+
+
+def _update_workflow_state(create_job, workflow_state, job_updates=None):
+    """ updates the job's workflow state, through the job_updates buffer if there is one """
+    if job_updates is None:
+        create_job.update_workflow_state(workflow_state)
+    else:
+        job_updates.update_workflow_state(create_job, workflow_state)
+
+
+def _get_bulk_setting(name, default):
+    """ helper to read an optional value from the BULK_COURSE_CREATION settings dict """
+    return getattr(settings, 'BULK_COURSE_CREATION', {}).get(name, default)
 
 
 def _send_notification(job):
@@ -211,8 +528,13 @@ def _send_notification(job):
 
     logger.debug("Building notification email...")
 
-    completed_subjobs = job.get_completed_subjobs_count()
-    failed_subjobs = job.get_failed_subjobs_count()
+    # use the counts annotated by get_jobs_ready_to_finalize(), if available
+    completed_subjobs = getattr(job, 'completed_subjobs_count', None)
+    if completed_subjobs is None:
+        completed_subjobs = job.get_completed_subjobs_count()
+    failed_subjobs = getattr(job, 'failed_subjobs_count', None)
+    if failed_subjobs is None:
+        failed_subjobs = job.get_failed_subjobs_count()
 
     try:
         term = Term.objects.get(term_id=int(job.sis_term_id))
@@ -239,17 +561,17 @@ def _send_notification(job):
         failed_subjobs
     )
 
-    logger.debug("Sending notification email to %s...", notification_to_address_list)
+    logger.debug("Queueing notification email to %s...", notification_to_address_list)
 
     try:
-        send_email_helper(subject, body, notification_to_address_list)
+        queue_email(subject, body, notification_to_address_list)
     except Exception:
         # todo: do we need all these multilayered logs?
-        logger.exception("Job %s: problem sending notification", job.id)
+        logger.exception("Job %s: problem queueing notification", job.id)
         _log_notification_failure(job)
         return False
 
-    logger.debug("Notification email sent!")
+    logger.debug("Notification email queued!")
     return True
 
 
@@ -310,6 +632,10 @@ def _log_bulk_job_statistics():
     """ helper method to log metrics and statistics at the end of the bulk job process """
     if settings.BULK_COURSE_CREATION['log_long_running_jobs']:
         job_age = settings.BULK_COURSE_CREATION['long_running_age_in_minutes']
-        job_count = BulkJob.objects.get_long_running_jobs(older_than_minutes=job_age)
+        job_count = BulkJob.objects.get_long_running_jobs(older_than_minutes=job_age).count()
         if job_count:
             logger.warn("Found %s long-running bulk create jobs (older than %s minutes).", job_count, job_age)
+        # the subjobs which are holding bulk jobs up; see the sweep_stalled_jobs command
+        stalled_count = CanvasCourseGenerationJob.objects.get_stalled_jobs(bulk_job_id__isnull=False).count()
+        if stalled_count:
+            logger.warn("Found %s stalled bulk create subjobs.", stalled_count)
@@ -2,186 +2,458 @@
 Process the Content Migration jobs in the CanvasContentMigrationJob table.
     To invoke this Command type "python manage.py process_async_jobs"
 """
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from django.core.management.base import BaseCommand
 from django.conf import settings
+from django.db import close_old_connections, transaction
 from django.db.models import Q
 from canvas_course_site_wizard.controller import (
     get_canvas_user_profile,
-    send_email_helper,
     send_failure_email,
     finalize_new_canvas_course,
     update_syllabus_body
 )
-from canvas_course_site_wizard.models import CanvasCourseGenerationJob
+from canvas_course_site_wizard.models import (CanvasCourseGenerationJob,
+                                              get_job_lease_owner,
+                                              job_leasing_enabled,
+                                              record_workflow_state_transitions)
 from canvas_sdk import client
-from icommons_common.canvas_utils import SessionInactivityExpirationRC
+from canvas_course_site_wizard.email_outbox import dispatch_email_outbox, queue_email
+from canvas_course_site_wizard.throttling import ThrottledRequestContext
 from icommons_ui.exceptions import RenderableException
+import asyncio
 import logging
 import fcntl
+import signal
+import threading
 
-SDK_CONTEXT = SessionInactivityExpirationRC(**settings.CANVAS_SDK_SETTINGS)
+SDK_CONTEXT = ThrottledRequestContext(**settings.CANVAS_SDK_SETTINGS)
 
 logger = logging.getLogger(__name__)
 tech_logger = logging.getLogger('tech_mail')
 
+# States of the jobs processed by the command
+_ACTIVE_WORKFLOW_STATES = (
+    CanvasCourseGenerationJob.STATUS_QUEUED,
+    CanvasCourseGenerationJob.STATUS_RUNNING,
+    CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE,
+)
+
+# Default number of seconds between runs in --daemon mode
+DEFAULT_DAEMON_TICK = 5
+
+# Content migration progress states reported by Canvas which are saved back to the job table by the poller
+_POLLED_WORKFLOW_STATES = (
+    CanvasCourseGenerationJob.STATUS_QUEUED,
+    CanvasCourseGenerationJob.STATUS_RUNNING,
+    CanvasCourseGenerationJob.STATUS_COMPLETED,
+    CanvasCourseGenerationJob.STATUS_FAILED,
+)
+
 
 class Command(BaseCommand):
     """
     Process the Canvas course generation jobs in the CanvasCourseGenerationJob table.
     To invoke this Command type "python manage.py process_async_jobs"
+    To keep it running, checking the jobs every few seconds, type "python manage.py process_async_jobs --daemon"
     """
     help = "Process the Canvas course generation jobs in the CanvasCourseGenerationJob table"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--daemon', action='store_true', default=False,
+                            help='Keep running, processing the jobs every --tick seconds until sent SIGTERM or SIGINT')
+        parser.add_argument('--tick', type=float, default=None,
+                            help='Seconds between runs in daemon mode (default: PROCESS_ASYNC_JOBS_DAEMON_TICK '
+                                 'setting, or %s)' % DEFAULT_DAEMON_TICK)
+
     def handle(self, **options):
         """
         select all the active job in the CanvasCourseGenerationJob table and check
         the status using the canvas_sdk.progress method
         """
 
-        # open and lock the file used for determining if another process is running
-        _pid_file = getattr(settings, 'PROCESS_ASYNC_JOBS_PID_FILE', 'process_async_jobs.pid')
-        _pid_file_handle = open(_pid_file, 'w')
+        # open and lock the file used for determining if another process is running; not needed when the jobs
+        # are leased, as any number of instances can then run at once
+        _pid_file_handle = None
+        if not job_leasing_enabled():
+            _pid_file = getattr(settings, 'PROCESS_ASYNC_JOBS_PID_FILE', 'process_async_jobs.pid')
+            _pid_file_handle = open(_pid_file, 'w')
+            try:
+                fcntl.lockf(_pid_file_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                # another instance is running
+                logger.warning(f"another instance of the command is already running: {e}")
+                return
+
+        if options.get('daemon'):
+            tick = options.get('tick')
+            if tick is None:
+                tick = getattr(settings, 'PROCESS_ASYNC_JOBS_DAEMON_TICK', DEFAULT_DAEMON_TICK)
+            self._run_daemon(tick)
+        else:
+            _process_jobs()
+
+        # unlock and close the file used for determining if another process is running
+        if _pid_file_handle is None:
+            return
+        try:
+            fcntl.lockf(_pid_file_handle, fcntl.LOCK_UN)
+            _pid_file_handle.close()
+        except IOError:
+            logger.error("could not release lock on pid file or close pid file properly")
+
+    def _run_daemon(self, tick):
+        """
+        Processes the jobs every `tick` seconds until SIGTERM (or SIGINT) is received. The SDK request context and
+        its HTTP session live for the whole run, as do DB connections if CONN_MAX_AGE allows it; connections which
+        have gone stale are closed before each run. On shutdown the jobs already being processed are finished, but
+        no new ones are started.
+        """
+        shutdown = threading.Event()
+
+        def request_shutdown(signum, frame):
+            logger.info('received signal %s, shutting down once in-flight jobs are finished', signum)
+            shutdown.set()
+
+        previous_handlers = {signum: signal.signal(signum, request_shutdown)
+                             for signum in (signal.SIGTERM, signal.SIGINT)}
+        logger.info('running in daemon mode, checking jobs every %s seconds', tick)
         try:
-            fcntl.lockf(_pid_file_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except IOError as e:
-            # another instance is running
-            logger.warning(f"another instance of the command is already running: {e}")
+            while not shutdown.is_set():
+                close_old_connections()
+                try:
+                    _process_jobs(should_stop=shutdown.is_set)
+                except Exception:
+                    # keep the daemon running; the jobs will be picked up again on the next tick
+                    logger.exception('error processing jobs')
+                close_old_connections()
+                shutdown.wait(tick)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+        logger.info('daemon stopped')
+
+
+def _process_jobs(should_stop=None):
+    """
+    Checks and processes all of the active CanvasCourseGenerationJobs. If should_stop is given it is checked
+    before each job (or batch of jobs) is started, and once it returns True the remaining jobs are left for the
+    next run. With job leasing enabled the jobs are claimed a batch at a time (see
+    CanvasCourseGenerationJobManager.claim_jobs), so that several workers can share them.
+    """
+    start_time = datetime.now()
+
+    if should_stop is None:
+        should_stop = lambda: False
+    lease_owner = get_job_lease_owner() if job_leasing_enabled() else None
+    batch_size = getattr(settings, 'PROCESS_ASYNC_JOBS_POLL_BATCH_SIZE', 100)
+    max_concurrent_polls = getattr(settings, 'PROCESS_ASYNC_JOBS_MAX_CONCURRENT_POLLS', 1)
+
+    for batch in _get_job_batches(batch_size, lease_owner):
+        if should_stop():
+            break
+        try:
+            if max_concurrent_polls > 1:
+                # Check the migration progress of the batch of jobs concurrently, then process each job in
+                # the batch using the progress that was fetched for it
+                progress = asyncio.run(_poll_migration_progress(batch, max_concurrent_polls))
+                moved_pks = _save_polled_workflow_states(batch, progress)
+                for job in _iter_leased_jobs(batch, lease_owner):
+                    if should_stop():
+                        # the polled states have been saved; the rest of the jobs' processing is left for next run
+                        break
+                    if _is_polled_change(job, progress.get(job.pk)) and job.pk not in moved_pks:
+                        # another worker moved the job on first, and handles the rest of its processing
+                        logger.info('Skipping job %s, which was moved on by another worker', job.pk)
+                        continue
+                    _process_job(job, progress.get(job.pk), lease_owner)
+            else:
+                for job in _iter_leased_jobs(batch, lease_owner):
+                    if should_stop():
+                        break
+                    _process_job(job, lease_owner=lease_owner)
+        finally:
+            if lease_owner:
+                CanvasCourseGenerationJob.objects.release_jobs(lease_owner, batch)
+
+    # send the notifications queued while processing the jobs
+    try:
+        dispatch_email_outbox()
+    except Exception:
+        # the messages stay in the outbox, and are sent on a later run
+        logger.exception('error sending queued email notifications')
+
+    logger.info('command took %s seconds to run', str(datetime.now() - start_time))
+
+
+def _get_job_batches(batch_size, lease_owner=None):
+    """
+    Yields the active CanvasCourseGenerationJobs in batches of up to batch_size. If lease_owner is given each batch
+    is claimed for it, working through the jobs in pk order; otherwise all of the jobs are read up front.
+    """
+    if lease_owner is None:
+        jobs = list(CanvasCourseGenerationJob.objects.filter(
+            Q(workflow_state=CanvasCourseGenerationJob.STATUS_QUEUED) |
+            Q(workflow_state=CanvasCourseGenerationJob.STATUS_RUNNING) |
+            Q(workflow_state=CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE)))
+        for i in range(0, len(jobs), batch_size):
+            yield jobs[i:i + batch_size]
+        return
+
+    last_pk = None
+    while True:
+        batch = CanvasCourseGenerationJob.objects.claim_jobs(lease_owner, batch_size, after_pk=last_pk,
+                                                             workflow_state__in=_ACTIVE_WORKFLOW_STATES)
+        if not batch:
             return
+        last_pk = batch[-1].pk
+        yield batch
 
-        start_time = datetime.now()
 
-        jobs = CanvasCourseGenerationJob.objects.filter(Q(workflow_state=CanvasCourseGenerationJob.STATUS_QUEUED) |
-                                                        Q(workflow_state=CanvasCourseGenerationJob.STATUS_RUNNING) |
-                                                        Q(workflow_state=CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE))
+def _iter_leased_jobs(batch, lease_owner=None):
+    """
+    Yields the jobs of a batch in turn. If lease_owner is given, the leases on the jobs still to be processed are
+    renewed before each job is yielded (see CanvasCourseGenerationJobManager.renew_leases), so that they don't run
+    out however long the batch takes, and jobs whose leases have been taken over by another worker are skipped.
+    """
+    if lease_owner is None:
+        yield from batch
+        return
+    remaining = list(batch)
+    while remaining:
+        remaining = CanvasCourseGenerationJob.objects.renew_leases(lease_owner, remaining)
+        if remaining:
+            yield remaining.pop(0)
 
-        for job in jobs:
-            try:
-                """
-                TODO - it turns out we only really need the job_id of the content migration
-                no the whole url since we are using the canvas_sdk to check the value. We should
-                update this in the database and the setting method. In the meantime just parse out
-                the job_id from the url.
-                """
-
-                job_start_message = '\nProcessing course with sis_course_id %s' % (job.sis_course_id)
-                logger.info(job_start_message)
-                user_profile = None
-
-                # Check if the job is flagged for migration or is running the migration
-                workflow_state = job.workflow_state
-
-                if workflow_state in (CanvasCourseGenerationJob.STATUS_QUEUED,
-                                      CanvasCourseGenerationJob.STATUS_RUNNING):
-                    response = client.get(SDK_CONTEXT, job.status_url)
-                    progress_response = response.json()
-                    workflow_state = progress_response['workflow_state']
-
-                    if workflow_state == CanvasCourseGenerationJob.STATUS_COMPLETED:
-                        logger.info('content migration complete for course with sis_course_id %s' % job.sis_course_id)
-                        # Update the Job table with the completed state immediately to indicate that the template
-                        # migration was successful
-                        job.workflow_state = CanvasCourseGenerationJob.STATUS_COMPLETED
-                        job.save(update_fields=['workflow_state'])
-
-                if workflow_state in (CanvasCourseGenerationJob.STATUS_COMPLETED,
-                                      CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE):
-
-                    logger.debug('Workflow state updated, starting finalization process...')
-                    try:
-                        update_syllabus_body(job)
-                        canvas_course_url = finalize_new_canvas_course(
-                            job.canvas_course_id,
-                            job.sis_course_id,
-                            'sis_user_id:%s' % job.created_by_user_id,
-                            job.bulk_job_id
-                        )
-                    except Exception:
-                        # Catch exceptions from finalize method to set the workflow_state to STATUS_FINALIZE_FAILED
-                        # and then re raise it so that generic tasks like tech logger, email generation will continue
-                        # to be handled in the larger try block
-                        logger.exception('Exception during finalize method, '
-                                         'setting state to STATUS_FINALIZE_FAILED '
-                                         'for sis_course_id id %s' % job.sis_course_id)
-                        job.workflow_state = CanvasCourseGenerationJob.STATUS_FINALIZE_FAILED
-                        job.save(update_fields=['workflow_state'])
-
-                        raise
-
-                    # Update the Job table with the STATUS_FINALIZED state if finalize is successful
-                    job.workflow_state = CanvasCourseGenerationJob.STATUS_FINALIZED
-                    job.save(update_fields=['workflow_state'])
-
-                    # if this is not a bulk_job then proceed with email generation to user
-                    if not job.bulk_job_id:
-                        # Once finalized successfully, only the initiator needs to be emailed
-                        user_profile = get_canvas_user_profile(job.created_by_user_id)
-                        to_address = [user_profile['primary_email']]
-                        success_msg = settings.CANVAS_EMAIL_NOTIFICATION['course_migration_success_body']
-                        logger.debug("notifying success via email: to_addr=%s and adding course url =%s" % (to_address, canvas_course_url))
-
-                        # add the course url to the  message
-                        complete_msg = success_msg.format(canvas_course_url)
-                        send_email_helper(settings.CANVAS_EMAIL_NOTIFICATION['course_migration_success_subject'], complete_msg, to_address)
-
-                elif workflow_state == CanvasCourseGenerationJob.STATUS_FAILED:
-                    error_text = 'Content migration failed for course with sis_course_id %s (HUID:%s)' \
-                                 % (job.sis_course_id, job.created_by_user_id)
-                    logger.info(error_text)
-                    tech_logger.error(error_text)
-
-                    # Update the Job table with the new state
-                    job.workflow_state = CanvasCourseGenerationJob.STATUS_FAILED
-                    job.save(update_fields=['workflow_state'])
-
-                    if not job.bulk_job_id:
-                        # send email to notify of failure if it's not a bulk fed course
-                        user_profile = get_canvas_user_profile(job.created_by_user_id)
-                        send_failure_email(user_profile['primary_email'], job.sis_course_id)
 
+def _holds_lease(job, lease_owner):
+    """ True if jobs aren't leased, or lease_owner still holds the job's lease (which is renewed) """
+    return lease_owner is None or bool(CanvasCourseGenerationJob.objects.renew_leases(lease_owner, [job]))
+
+
+def _process_job(job, polled_workflow_state=None, lease_owner=None):
+    """
+    Process a single CanvasCourseGenerationJob: check the progress of its content migration (unless the progress
+    was already fetched by _poll_migration_progress and is given as polled_workflow_state), finalize the course
+    once the migration is complete, and notify the initiator of single course jobs of success or failure.
+    Each change to the job is made with a conditional update (see CanvasCourseGenerationJob.transition_workflow_state)
+    before anything is done on the strength of it, so that if another worker has moved the job on first this
+    one leaves the job, and its notification, to that worker. If lease_owner is given, the job is also only
+    finalized, or its initiator notified of an error, while lease_owner holds its lease.
+    """
+    try:
+        """
+        TODO - it turns out we only really need the job_id of the content migration
+        no the whole url since we are using the canvas_sdk to check the value. We should
+        update this in the database and the setting method. In the meantime just parse out
+        the job_id from the url.
+        """
+
+        job_start_message = '\nProcessing course with sis_course_id %s' % (job.sis_course_id)
+        logger.info(job_start_message)
+        user_profile = None
+
+        # Check if the job is flagged for migration or is running the migration
+        workflow_state = job.workflow_state
+
+        if workflow_state in (CanvasCourseGenerationJob.STATUS_QUEUED,
+                              CanvasCourseGenerationJob.STATUS_RUNNING):
+            if polled_workflow_state is None:
+                response = client.get(SDK_CONTEXT, job.status_url)
+                progress_response = response.json()
+                workflow_state = progress_response['workflow_state']
+            elif isinstance(polled_workflow_state, Exception):
+                # the progress check failed; handle it as if the check had been made here
+                raise polled_workflow_state
+            else:
+                # progress was fetched (and any change already saved) by the concurrent poller
+                workflow_state = polled_workflow_state
+
+            if workflow_state in (CanvasCourseGenerationJob.STATUS_COMPLETED,
+                                  CanvasCourseGenerationJob.STATUS_FAILED):
+                if polled_workflow_state is None:
+                    # Update the Job table with the new state immediately; if another worker got there first (or
+                    # has taken over the job's lease), it takes care of the job from here
+                    if not _holds_lease(job, lease_owner) or \
+                            not job.transition_workflow_state(job.workflow_state, workflow_state):
+                        return
                 else:
-                    """
-                    if the workflow_state is 'queued' or 'running' the job
-                    is not complete and a failure has not occured on Canvas.
-                    log that we checked
-                    Note: we won't need to update the DB as we will record only the completin or failure in the job table
-                    """
-                    message = 'content migration state is %s for course with sis_course_id %s' % (workflow_state, job.sis_course_id)
-                    logger.info(message)
-
-            except Exception as e:
-                error_text = "There was a problem in processing the job for canvas course sis_course_id %s (HUID:%s)" \
+                    job.workflow_state = workflow_state
+
+        if workflow_state in (CanvasCourseGenerationJob.STATUS_COMPLETED,
+                              CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE) and not _holds_lease(job, lease_owner):
+            logger.info('Leaving job %s to be finalized by the worker which has taken over its lease', job.pk)
+            return
+
+        if workflow_state == CanvasCourseGenerationJob.STATUS_COMPLETED:
+            logger.info('content migration complete for course with sis_course_id %s' % job.sis_course_id)
+            # Take the job for finalization, so that it is only finalized by one worker
+            if not job.transition_workflow_state(CanvasCourseGenerationJob.STATUS_COMPLETED,
+                                                 CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE):
+                return
+            workflow_state = CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE
+
+        if workflow_state == CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE:
+
+            logger.debug('Workflow state updated, starting finalization process...')
+            try:
+                update_syllabus_body(job)
+                canvas_course_url = finalize_new_canvas_course(
+                    job.canvas_course_id,
+                    job.sis_course_id,
+                    'sis_user_id:%s' % job.created_by_user_id,
+                    job.bulk_job_id
+                )
+            except Exception:
+                # Catch exceptions from finalize method to set the workflow_state to STATUS_FINALIZE_FAILED
+                # and then re raise it so that generic tasks like tech logger, email generation will continue
+                # to be handled in the larger try block
+                logger.exception('Exception during finalize method, '
+                                 'setting state to STATUS_FINALIZE_FAILED '
+                                 'for sis_course_id id %s' % job.sis_course_id)
+                if not job.transition_workflow_state(CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE,
+                                                     CanvasCourseGenerationJob.STATUS_FINALIZE_FAILED):
+                    # another worker has finished the job, and notifies the initiator
+                    return
+
+                raise
+
+            # Update the Job table with the STATUS_FINALIZED state if finalize is successful
+            if not job.transition_workflow_state(CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE,
+                                                 CanvasCourseGenerationJob.STATUS_FINALIZED):
+                return
+
+            # if this is not a bulk_job then proceed with email generation to user
+            if not job.bulk_job_id:
+                # Once finalized successfully, only the initiator needs to be emailed
+                user_profile = get_canvas_user_profile(job.created_by_user_id)
+                to_address = [user_profile['primary_email']]
+                success_msg = settings.CANVAS_EMAIL_NOTIFICATION['course_migration_success_body']
+                logger.debug("notifying success via email: to_addr=%s and adding course url =%s" % (to_address, canvas_course_url))
+
+                # add the course url to the  message
+                complete_msg = success_msg.format(canvas_course_url)
+                queue_email(settings.CANVAS_EMAIL_NOTIFICATION['course_migration_success_subject'], complete_msg, to_address)
+
+        elif workflow_state == CanvasCourseGenerationJob.STATUS_FAILED:
+            error_text = 'Content migration failed for course with sis_course_id %s (HUID:%s)' \
+                         % (job.sis_course_id, job.created_by_user_id)
+            logger.info(error_text)
+            tech_logger.error(error_text)
+
+            if not job.bulk_job_id:
+                # send email to notify of failure if it's not a bulk fed course
+                user_profile = get_canvas_user_profile(job.created_by_user_id)
+                send_failure_email(user_profile['primary_email'], job.sis_course_id)
+
+        else:
+            """
+            if the workflow_state is 'queued' or 'running' the job
+            is not complete and a failure has not occured on Canvas.
+            log that we checked
+            Note: we won't need to update the DB as we will record only the completin or failure in the job table
+            (when polling concurrently, a change from 'queued' to 'running' has already been saved by the poller)
+            """
+            message = 'content migration state is %s for course with sis_course_id %s' % (workflow_state, job.sis_course_id)
+            logger.info(message)
+
+    except Exception as e:
+        error_text = "There was a problem in processing the job for canvas course sis_course_id %s (HUID:%s)" \
+                     % (job.sis_course_id, job.created_by_user_id)
+        # Note: equivalent to .error(error_text, exc_info=1) -- logs at ERROR level
+        logger.exception(error_text)
+
+        # Use the friendly display_text for the subject of the tech_logger email if it's available
+        if isinstance(e, RenderableException):
+            error_text = '%s (HUID:%s)' % (e.display_text, job.created_by_user_id)
+        tech_logger.exception(error_text)
+
+        # send email if it's not a bulk created course
+        if not job.bulk_job_id:
+            try:
+                if not _holds_lease(job, lease_owner):
+                    # the job has been taken over by another worker, which notifies the initiator if need be
+                    return
+
+                # if failure happened before user profile was fetched, get the user profile
+                # to retrieve email, else reuse the user_profile info
+                if not user_profile:
+                    user_profile = get_canvas_user_profile(job.created_by_user_id)
+
+                send_failure_email(user_profile['primary_email'], job.sis_course_id)
+            except Exception:
+                # If exception occurs while sending failure email, log it
+                error_text = "There was a problem in sending the failure notification email to initiator " \
+                             "and support staff for sis_course_id %s (HUID:%s)" \
                              % (job.sis_course_id, job.created_by_user_id)
-                # Note: equivalent to .error(error_text, exc_info=1) -- logs at ERROR level
                 logger.exception(error_text)
-
-                # Use the friendly display_text for the subject of the tech_logger email if it's available
-                if isinstance(e, RenderableException):
-                    error_text = '%s (HUID:%s)' % (e.display_text, job.created_by_user_id)
                 tech_logger.exception(error_text)
 
-                # send email if it's not a bulk created course
-                if not job.bulk_job_id:
-                    try:
-                        # if failure happened before user profile was fetched, get the user profile
-                        # to retrieve email, else reuse the user_profile info
-                        if not user_profile:
-                            user_profile = get_canvas_user_profile(job.created_by_user_id)
-
-                        send_failure_email(user_profile['primary_email'], job.sis_course_id)
-                    except Exception:
-                        # If exception occurs while sending failure email, log it
-                        error_text = "There was a problem in sending the failure notification email to initiator " \
-                                     "and support staff for sis_course_id %s (HUID:%s)" \
-                                     % (job.sis_course_id, job.created_by_user_id)
-                        logger.exception(error_text)
-                        tech_logger.exception(error_text)
-
-        logger.info('command took %s seconds to run', str(datetime.now() - start_time))
 
-        # unlock and close the file used for determining if another process is running
-        try:
-            fcntl.lockf(_pid_file_handle, fcntl.LOCK_UN)
-            _pid_file_handle.close()
-        except IOError:
-            logger.error("could not release lock on pid file or close pid file properly")
+async def _poll_migration_progress(jobs, max_in_flight):
+    """
+    Checks the content migration progress (status_url) of each of the given jobs concurrently, with at most
+    max_in_flight requests in flight at once. All requests go through the keep-alive session of the shared
+    SDK_CONTEXT.
+    :return: dict mapping each job's pk to the workflow_state reported by Canvas, or to the exception raised
+    while checking it
+    """
+    semaphore = asyncio.Semaphore(max_in_flight)
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+
+        async def poll(job):
+            async with semaphore:
+                try:
+                    response = await loop.run_in_executor(executor, client.get, SDK_CONTEXT, job.status_url)
+                    return job.pk, response.json()['workflow_state']
+                except Exception as e:
+                    return job.pk, e
+
+        results = await asyncio.gather(*[poll(job) for job in jobs
+                                         if job.workflow_state in (CanvasCourseGenerationJob.STATUS_QUEUED,
+                                                                   CanvasCourseGenerationJob.STATUS_RUNNING)])
+    return dict(results)
+
+
+def _is_polled_change(job, polled_workflow_state):
+    """ True if polled_workflow_state is a progress state reported by Canvas which the job has yet to be moved to """
+    return polled_workflow_state in _POLLED_WORKFLOW_STATES and polled_workflow_state != job.workflow_state
+
+
+def _save_polled_workflow_states(jobs, progress):
+    """
+    Saves the workflow_state changes reported by Canvas for a batch of jobs (see _poll_migration_progress) back to
+    the CanvasCourseGenerationJob table, with one conditional UPDATE ... WHERE workflow_state = <old state> for
+    each (old state, new state) pair, so that jobs another worker has moved on are left alone. The job
+    objects' workflow_states are left as they were so that _process_job can tell what changed.
+    :return: set of the pks of the jobs this call moved; jobs with a change reported which aren't in it were
+    moved on by another worker first (or reported a change which isn't allowed), and should be skipped
+    """
+    changed_jobs = [job for job in jobs
+                    if _is_polled_change(job, progress.get(job.pk))
+                    and progress[job.pk] in CanvasCourseGenerationJob.ALLOWED_TRANSITIONS.get(job.workflow_state, ())]
+    if not changed_jobs:
+        return set()
+
+    jobs_by_transition = defaultdict(dict)
+    for job in changed_jobs:
+        jobs_by_transition[(job.workflow_state, progress[job.pk])][job.pk] = job
+    moved_pks = set()
+    with transaction.atomic():
+        transitions = []
+        for (old_workflow_state, new_workflow_state), jobs_by_pk in jobs_by_transition.items():
+            updated_pks = CanvasCourseGenerationJob.objects.transition_workflow_states(
+                list(jobs_by_pk), old_workflow_state, workflow_state=new_workflow_state)
+            moved_pks.update(updated_pks)
+            transitions.extend((jobs_by_pk[pk], old_workflow_state, new_workflow_state) for pk in updated_pks)
+        record_workflow_state_transitions(transitions)
+    for job in changed_jobs:
+        if job.pk in moved_pks:
+            # what is saved now, for the bulk job's subjob counters if the job is save()d later
+            job._saved_workflow_state = progress[job.pk]
+    logger.info('Saved migration progress for %d of %d jobs', len(moved_pks), len(jobs))
+    return moved_pks
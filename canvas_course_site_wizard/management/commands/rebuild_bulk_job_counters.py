@@ -0,0 +1,29 @@
+"""
+Rebuild the subjob counters of the BulkCanvasCourseCreationJobs from their CanvasCourseGenerationJobs.
+    To invoke this Command type "python manage.py rebuild_bulk_job_counters"
+"""
+import logging
+
+from django.core.management.base import BaseCommand
+
+from canvas_course_site_wizard.models import BulkCanvasCourseCreationJob
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Recounts the subjobs of each bulk job (or just the given ones) and overwrites the bulk job's subjob counters
+    (see BulkCanvasCourseCreationJobManager.rebuild_subjob_counters). The counters are kept up to date as subjobs
+    change state, so this is only needed after the counter columns are added, or to repair counters after subjobs
+    have been changed directly in the database.
+    """
+    help = "Rebuild the subjob counters of the bulk jobs from their subjobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bulk-job-id', type=int, action='append', dest='bulk_job_ids', default=None,
+                            help='Rebuild only this bulk job (may be given more than once)')
+
+    def handle(self, **options):
+        rebuilt = BulkCanvasCourseCreationJob.objects.rebuild_subjob_counters(options.get('bulk_job_ids'))
+        logger.info('rebuild_bulk_job_counters: rebuilt the subjob counters of %d bulk jobs', rebuilt)
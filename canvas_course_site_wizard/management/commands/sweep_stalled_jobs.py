@@ -0,0 +1,160 @@
+"""
+Recover or fail the CanvasCourseGenerationJobs which have stopped making progress.
+    To invoke this Command type "python manage.py sweep_stalled_jobs"
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from canvas_sdk import client
+from canvas_course_site_wizard.controller import get_canvas_user_profile, send_failure_email
+from canvas_course_site_wizard.models import (CANVAS_COURSE_GENERATION_JOB_MAX_MIGRATION_HOURS,
+                                              CanvasCourseGenerationJob,
+                                              record_workflow_state_transitions)
+from canvas_course_site_wizard.throttling import ThrottledRequestContext
+
+SDK_CONTEXT = ThrottledRequestContext(**settings.CANVAS_SDK_SETTINGS)
+
+logger = logging.getLogger(__name__)
+tech_logger = logging.getLogger('tech_mail')
+
+# States of jobs whose content migration is still in progress in Canvas, and which are re-polled when stalled
+_MIGRATING_WORKFLOW_STATES = (
+    CanvasCourseGenerationJob.STATUS_QUEUED,
+    CanvasCourseGenerationJob.STATUS_RUNNING,
+)
+
+
+class Command(BaseCommand):
+    """
+    Finds the course generation jobs which have gone without progress for longer than the threshold for their
+    workflow_state (see CanvasCourseGenerationJobManager.get_stalled_jobs) and deals with each of them:
+      - queued and running jobs have their content migration progress checked again; progress reported by Canvas
+        is saved, jobs whose migration Canvas reports as failed (or has lost) are marked failed, and jobs whose
+        migration Canvas is still working on are left alone, unless the migration was queued longer ago than
+        CANVAS_COURSE_GENERATION_JOB_MAX_MIGRATION_HOURS, in which case the job is marked failed
+      - completed jobs, whose finalization was interrupted, are handed back to process_async_jobs for finalization
+      - pending_finalize jobs, which process_async_jobs has been unable to finalize, are marked finalize_failed
+    so that stalled subjobs don't keep their bulk jobs from being finalized. The initiators of single course jobs
+    which are marked failed are notified.
+    To invoke this Command type "python manage.py sweep_stalled_jobs"
+    """
+    help = "Re-poll, re-drive or fail the course generation jobs which have stopped making progress"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only log the stalled jobs and what would be done with them')
+
+    def handle(self, **options):
+        sweep_stalled_jobs(dry_run=options.get('dry_run'))
+
+
+def sweep_stalled_jobs(dry_run=False):
+    """
+    Sweeps the stalled jobs (see Command) and returns the number of jobs moved to each new workflow_state, as a
+    dict. The jobs are moved with conditional updates, so that jobs which another worker has moved on in the
+    meantime are left alone.
+    """
+    jobs = list(CanvasCourseGenerationJob.objects.get_stalled_jobs().order_by('pk'))
+    if not jobs:
+        return {}
+    logger.warning('Found %d stalled course generation jobs', len(jobs))
+
+    transitions = defaultdict(list)
+    for job in jobs:
+        recovery_workflow_state = _get_recovery_workflow_state(job)
+        if recovery_workflow_state is None:
+            continue
+        transitions[(job.workflow_state, recovery_workflow_state)].append(job)
+
+    counts = defaultdict(int)
+    for (old_workflow_state, new_workflow_state), stalled_jobs in transitions.items():
+        logger.info('%s %d stalled jobs from %s to %s: %s', 'Would move' if dry_run else 'Moving', len(stalled_jobs),
+                    old_workflow_state, new_workflow_state, [job.pk for job in stalled_jobs])
+        if dry_run:
+            counts[new_workflow_state] += len(stalled_jobs)
+            continue
+        moved_jobs = _transition_jobs(stalled_jobs, old_workflow_state, new_workflow_state)
+        if new_workflow_state == CanvasCourseGenerationJob.STATUS_COMPLETED:
+            # Canvas finished the migration while the job wasn't being checked; finalize it as usual
+            new_workflow_state = CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE
+            moved_jobs = _transition_jobs(moved_jobs, CanvasCourseGenerationJob.STATUS_COMPLETED, new_workflow_state)
+        counts[new_workflow_state] += len(moved_jobs)
+        if new_workflow_state in CanvasCourseGenerationJob.FAILED_STATES:
+            _notify_failure(moved_jobs, old_workflow_state)
+
+    logger.info('Swept stalled course generation jobs: %s', dict(counts))
+    return dict(counts)
+
+
+def _get_recovery_workflow_state(job):
+    """
+    returns the workflow_state a stalled job should be moved to; for queued and running jobs this is the state
+    Canvas now reports for the migration if that is progress (or failed), None if Canvas reports that the migration
+    is still in progress without having moved on, and failed if the progress can't be checked or the migration has
+    been going for longer than the maximum migration age
+    """
+    if job.workflow_state == CanvasCourseGenerationJob.STATUS_COMPLETED:
+        return CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE
+    if job.workflow_state == CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE:
+        return CanvasCourseGenerationJob.STATUS_FINALIZE_FAILED
+
+    if job.workflow_state in _MIGRATING_WORKFLOW_STATES and job.status_url:
+        try:
+            workflow_state = client.get(SDK_CONTEXT, job.status_url).json()['workflow_state']
+        except Exception:
+            # e.g. Canvas no longer knows about the migration
+            logger.exception('Could not check the content migration progress of stalled job %s', job.pk)
+        else:
+            if workflow_state in CanvasCourseGenerationJob.ALLOWED_TRANSITIONS[job.workflow_state]:
+                return workflow_state
+            if _is_past_max_migration_age(job):
+                # a lost or hung migration, which would otherwise keep its bulk job from ever being finalized
+                logger.warning('Stalled job %s is still %s in Canvas, but its migration was queued at %s; failing it',
+                               job.pk, workflow_state, job.migration_queued_at or job.created_at)
+                return CanvasCourseGenerationJob.STATUS_FAILED
+            # e.g. a slow migration which is still queued or running; leave the job for process_async_jobs
+            logger.info('Stalled job %s is still %s in Canvas, leaving it alone', job.pk, workflow_state)
+            return None
+    return CanvasCourseGenerationJob.STATUS_FAILED
+
+
+def _is_past_max_migration_age(job):
+    """ True if the job's migration was queued (or, failing that, the job was created) too long ago to wait on """
+    max_hours = getattr(settings, 'CANVAS_COURSE_GENERATION_JOB_MAX_MIGRATION_HOURS',
+                        CANVAS_COURSE_GENERATION_JOB_MAX_MIGRATION_HOURS)
+    return (job.migration_queued_at or job.created_at) < timezone.now() - timedelta(hours=max_hours)
+
+
+def _transition_jobs(jobs, old_workflow_state, new_workflow_state):
+    """ moves those of the given jobs which are still in old_workflow_state to new_workflow_state; returns them """
+    jobs_by_pk = {job.pk: job for job in jobs}
+    with transaction.atomic():
+        updated_pks = CanvasCourseGenerationJob.objects.transition_workflow_states(
+            list(jobs_by_pk), old_workflow_state, workflow_state=new_workflow_state)
+        moved_jobs = [jobs_by_pk[pk] for pk in updated_pks]
+        record_workflow_state_transitions([(job, old_workflow_state, new_workflow_state) for job in moved_jobs])
+    for job in moved_jobs:
+        job.workflow_state = job._saved_workflow_state = new_workflow_state
+    return moved_jobs
+
+
+def _notify_failure(jobs, stalled_workflow_state):
+    """ reports jobs which have been marked failed, emailing the initiators of single course jobs """
+    for job in jobs:
+        error_text = 'Course generation job for sis_course_id %s (HUID:%s) stalled in %s and was marked %s' % (
+            job.sis_course_id, job.created_by_user_id, stalled_workflow_state, job.workflow_state)
+        tech_logger.error(error_text)
+        if job.bulk_job_id:
+            continue
+        try:
+            user_profile = get_canvas_user_profile(job.created_by_user_id)
+            send_failure_email(user_profile['primary_email'], job.sis_course_id)
+        except Exception:
+            logger.exception('There was a problem in sending the failure notification email for sis_course_id %s '
+                             '(HUID:%s)', job.sis_course_id, job.created_by_user_id)
@@ -0,0 +1,119 @@
+"""
+Report how long course generation jobs spend in each stage of course creation.
+    To invoke this Command type "python manage.py wizard_latency_report"
+"""
+import logging
+import math
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from icommons_common.models import CourseInstance
+
+from canvas_course_site_wizard.models import (BulkCanvasCourseCreationJob, CanvasCourseGenerationJob,
+                                              CanvasCourseGenerationJobUpdateBuffer)
+
+logger = logging.getLogger(__name__)
+
+# (name, field the stage starts at, field the stage ends at) for each stage reported on
+STAGES = (
+    ('setup', 'setup_started_at', 'canvas_course_created_at'),
+    ('queue', 'canvas_course_created_at', 'migration_queued_at'),
+    ('migration', 'migration_queued_at', 'migration_completed_at'),
+    ('finalize', 'migration_completed_at', 'finalized_at'),
+    ('total', 'setup_started_at', 'finalized_at'),
+)
+STAGE_FIELDS = sorted({field for _, start, end in STAGES for field in (start, end)})
+
+GROUP_BY_CHOICES = ('school', 'template', 'bulk_job')
+PERCENTILES = (50, 95, 99)
+# group name used for jobs which weren't part of a bulk job, or which copied the school's default template
+NO_BULK_JOB = 'none'
+DEFAULT_TEMPLATE = 'default'
+
+
+def percentile(sorted_values, p):
+    """ returns the p-th percentile (nearest rank) of a sorted list, or None if the list is empty """
+    if not sorted_values:
+        return None
+    return sorted_values[max(int(math.ceil(p / 100.0 * len(sorted_values))) - 1, 0)]
+
+
+class Command(BaseCommand):
+    """
+    Prints the p50/p95/p99 time spent by course generation jobs in each stage of course creation (setup, waiting for
+    the template copy to be queued, the template copy itself and finalization, plus the total), using the stage
+    timestamps of the jobs created in the reporting window, grouped by school, template and bulk job. Jobs which
+    haven't reached the end of a stage (or which skipped it, e.g. because there was no template to copy) aren't
+    counted for that stage.
+    """
+    help = "Print p50/p95/p99 time spent per course creation stage, by school, template and bulk job"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7,
+                            help='Report on the jobs created in the last DAYS days (default 7)')
+        parser.add_argument('--group-by', choices=GROUP_BY_CHOICES, action='append', dest='group_by', default=None,
+                            help='Group the report by this (may be given more than once; default all of them)')
+
+    def handle(self, **options):
+        since = timezone.now() - timedelta(days=options['days'])
+        group_bys = options.get('group_by') or GROUP_BY_CHOICES
+        durations = get_stage_durations(since)
+
+        for group_by in group_bys:
+            self.stdout.write('\nTime spent per stage (seconds) by %s, jobs created since %s' % (
+                group_by, since.strftime('%Y-%m-%d %H:%M')))
+            self.stdout.write('%-12s %-10s %8s %10s %10s %10s' % ((group_by, 'stage', 'jobs') +
+                                                                  tuple('p%d' % p for p in PERCENTILES)))
+            for group in sorted(durations[group_by], key=str):
+                for stage, _, _ in STAGES:
+                    values = sorted(durations[group_by][group].get(stage, ()))
+                    if not values:
+                        continue
+                    self.stdout.write('%-12s %-10s %8d %10.1f %10.1f %10.1f' % (
+                        (group, stage, len(values)) + tuple(percentile(values, p) for p in PERCENTILES)))
+
+
+def get_stage_durations(since):
+    """
+    Returns {group_by: {group: {stage: [seconds, ...]}}} for the jobs created since the given time. The jobs are
+    streamed rather than loaded all at once; the school and template of bulk subjobs come from their bulk job, and
+    the school of other jobs is looked up for up to 1000 jobs at a time.
+    """
+    durations = {group_by: defaultdict(lambda: defaultdict(list)) for group_by in GROUP_BY_CHOICES}
+    jobs = CanvasCourseGenerationJob.objects.filter(created_at__gte=since)
+
+    bulk_jobs = {
+        pk: (school_id, template_canvas_course_id)
+        for pk, school_id, template_canvas_course_id in BulkCanvasCourseCreationJob.objects.filter(
+            pk__in=jobs.filter(bulk_job_id__isnull=False).values('bulk_job_id')
+        ).values_list('pk', 'school_id', 'template_canvas_course_id')
+    }
+
+    def add(school_id, template, bulk_job_id, timestamps):
+        stamps = dict(zip(STAGE_FIELDS, timestamps))
+        for stage, start, end in STAGES:
+            if stamps[start] is None or stamps[end] is None:
+                continue
+            seconds = (stamps[end] - stamps[start]).total_seconds()
+            for group_by, group in (('school', school_id), ('template', template), ('bulk_job', bulk_job_id)):
+                durations[group_by][group][stage].append(seconds)
+
+    for row in jobs.filter(bulk_job_id__isnull=False).values_list('bulk_job_id', *STAGE_FIELDS).iterator():
+        school_id, template_canvas_course_id = bulk_jobs.get(row[0], (None, None))
+        add(school_id, template_canvas_course_id or DEFAULT_TEMPLATE, row[0], row[1:])
+
+    # jobs created one at a time through the wizard are few enough to hold while their schools are looked up
+    single_jobs = list(jobs.filter(bulk_job_id__isnull=True).values_list('sis_course_id', *STAGE_FIELDS))
+    chunk_size = CanvasCourseGenerationJobUpdateBuffer.MAX_IDS_PER_UPDATE
+    for i in range(0, len(single_jobs), chunk_size):
+        chunk = single_jobs[i:i + chunk_size]
+        schools = dict(CourseInstance.objects.filter(
+            pk__in=[int(row[0]) for row in chunk if str(row[0]).isdigit()]
+        ).values_list('pk', 'course__school_id'))
+        for row in chunk:
+            school_id = schools.get(int(row[0])) if str(row[0]).isdigit() else None
+            add(school_id, DEFAULT_TEMPLATE, NO_BULK_JOB, row[1:])
+
+    return durations
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Composite indexes for the canvas_course_generation_job lookup paths, and uniqueness of a course within a bulk
+    job. Oracle does not support the conditional unique constraint, so Django skips it there; the equivalent
+    function-based unique index is in 10162026_dbchanges.sql.
+    """
+
+    dependencies = [
+        ('canvas_course_site_wizard', '0009_table_exists_check_and_population'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='canvascoursegenerationjob',
+            index=models.Index(fields=['workflow_state', 'bulk_job_id'], name='ccgj_state_bulk_job_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='canvascoursegenerationjob',
+            index=models.Index(fields=['sis_course_id', 'bulk_job_id'], name='ccgj_sis_course_bulk_job_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='canvascoursegenerationjob',
+            constraint=models.UniqueConstraint(condition=models.Q(bulk_job_id__isnull=False),
+                                               fields=('bulk_job_id', 'sis_course_id'),
+                                               name='ccgj_bulk_job_sis_course_uniq'),
+        ),
+    ]
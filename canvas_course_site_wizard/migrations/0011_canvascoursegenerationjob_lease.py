@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas_course_site_wizard', '0010_canvascoursegenerationjob_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='canvascoursegenerationjob',
+            name='lease_owner',
+            field=models.CharField(max_length=100, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='canvascoursegenerationjob',
+            name='lease_expires_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+    ]
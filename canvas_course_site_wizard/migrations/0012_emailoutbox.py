@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas_course_site_wizard', '0011_canvascoursegenerationjob_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailOutbox',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('subject', models.CharField(max_length=255)),
+                ('message', models.TextField()),
+                ('from_address', models.CharField(max_length=254)),
+                ('to_addresses', models.TextField()),
+                ('status', models.CharField(default='pending', max_length=10,
+                                            choices=[('pending', 'pending'), ('sent', 'sent'),
+                                                     ('failed', 'failed')])),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(null=True, blank=True)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('claimed_by', models.CharField(max_length=100, null=True, blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sent_at', models.DateTimeField(null=True, blank=True)),
+            ],
+            options={
+                'db_table': 'canvas_wizard_email_outbox',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='emailoutbox',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='cw_email_outbox_due_idx'),
+        ),
+    ]
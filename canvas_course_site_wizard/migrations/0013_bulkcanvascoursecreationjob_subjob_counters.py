@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas_course_site_wizard', '0012_emailoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bulkcanvascoursecreationjob',
+            name='subjobs_total',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='bulkcanvascoursecreationjob',
+            name='subjobs_setup',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='bulkcanvascoursecreationjob',
+            name='subjobs_in_flight',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='bulkcanvascoursecreationjob',
+            name='subjobs_finalized',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='bulkcanvascoursecreationjob',
+            name='subjobs_failed',
+            field=models.IntegerField(default=0),
+        ),
+    ]
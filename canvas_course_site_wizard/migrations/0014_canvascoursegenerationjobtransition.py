@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas_course_site_wizard', '0013_bulkcanvascoursecreationjob_subjob_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CanvasCourseGenerationJobTransition',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('job_id', models.IntegerField()),
+                ('bulk_job_id', models.IntegerField(null=True, blank=True)),
+                ('from_state', models.CharField(max_length=20)),
+                ('to_state', models.CharField(max_length=20)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('worker', models.CharField(max_length=100)),
+                ('duration_seconds', models.FloatField(null=True, blank=True)),
+            ],
+            options={
+                'db_table': 'canvas_wizard_job_transition',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='canvascoursegenerationjobtransition',
+            index=models.Index(fields=['created_at'], name='cw_job_trans_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='canvascoursegenerationjobtransition',
+            index=models.Index(fields=['job_id', 'created_at'], name='cw_job_trans_job_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='canvascoursegenerationjobtransition',
+            index=models.Index(fields=['bulk_job_id', 'created_at'], name='cw_job_trans_bulk_job_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas_course_site_wizard', '0014_canvascoursegenerationjobtransition'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='canvascoursegenerationjob',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AlterField(
+            model_name='bulkcanvascoursecreationjob',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='canvascoursegenerationjob',
+            name='setup_started_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='canvascoursegenerationjob',
+            name='canvas_course_created_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='canvascoursegenerationjob',
+            name='migration_queued_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='canvascoursegenerationjob',
+            name='migration_completed_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='canvascoursegenerationjob',
+            name='finalized_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas_course_site_wizard', '0015_canvascoursegenerationjob_stage_timestamps'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='canvascoursegenerationjob',
+            index=models.Index(fields=['workflow_state', 'updated_at'], name='ccgj_state_updated_idx'),
+        ),
+    ]
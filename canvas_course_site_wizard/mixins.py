@@ -1,6 +1,7 @@
 from .models_api import get_course_data
-from icommons_common.canvas_utils import SessionInactivityExpirationRC
+from .throttling import ThrottledRequestContext
 from canvas_sdk.methods import admins
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 from django.views.generic.detail import SingleObjectMixin
 from django.http import Http404
@@ -11,10 +12,55 @@ from django.utils.translation import ugettext as _
 import logging
 
 # Set up the request context that will be used for canvas API calls
-SDK_CONTEXT = SessionInactivityExpirationRC(**settings.CANVAS_SDK_SETTINGS)
+SDK_CONTEXT = ThrottledRequestContext(**settings.CANVAS_SDK_SETTINGS)
 
 logger = logging.getLogger(__name__)
 
+# Default number of seconds a user's admin roles in a school account are cached for, and (more briefly) the
+# fact that they have none (see get_account_admin_roles)
+ACCOUNT_ADMIN_ROLES_CACHE_TIMEOUT = 5 * 60
+ACCOUNT_ADMIN_ROLES_NONE_CACHE_TIMEOUT = 60
+
+
+def get_account_admin_roles(sis_user_id, school_id):
+    """
+    Returns the Canvas account admin roles the user holds in the school's account (an empty list if they have none).
+    The roles are cached (keyed by user and school) for ACCOUNT_ADMIN_ROLES_CACHE_TIMEOUT seconds, and users with no
+    roles for ACCOUNT_ADMIN_ROLES_NONE_CACHE_TIMEOUT seconds, so that permission checks don't call Canvas on every
+    request. Use invalidate_account_admin_roles() when a user's roles are known to have changed.
+
+    :raises: Exception from SDK (failed lookups are not cached)
+    """
+    cache_key = _account_admin_roles_cache_key(sis_user_id, school_id)
+    user_account_admin_list = cache.get(cache_key)
+    if user_account_admin_list is not None:
+        return user_account_admin_list
+
+    user_account_admin_list = admins.list_account_admins(
+        request_ctx=SDK_CONTEXT,
+        account_id='sis_account_id:school:%s' % school_id,
+        user_id='sis_user_id:%s' % sis_user_id
+    ).json()
+    logger.debug("Admin list for %s in sis_account_id:school:%s is %s"
+                 % (sis_user_id, school_id, user_account_admin_list))
+
+    if user_account_admin_list:
+        timeout = getattr(settings, 'ACCOUNT_ADMIN_ROLES_CACHE_TIMEOUT', ACCOUNT_ADMIN_ROLES_CACHE_TIMEOUT)
+    else:
+        timeout = getattr(settings, 'ACCOUNT_ADMIN_ROLES_NONE_CACHE_TIMEOUT', ACCOUNT_ADMIN_ROLES_NONE_CACHE_TIMEOUT)
+    cache.set(cache_key, user_account_admin_list, timeout)
+    return user_account_admin_list
+
+
+def invalidate_account_admin_roles(sis_user_id, school_id):
+    """ Drops the cached admin roles of the user in the school's account (see get_account_admin_roles) """
+    cache.delete(_account_admin_roles_cache_key(sis_user_id, school_id))
+
+
+def _account_admin_roles_cache_key(sis_user_id, school_id):
+    return 'canvas_course_site_wizard:account_admin_roles:%s:%s' % (sis_user_id, school_id)
+
+
 class CourseDataMixin(SingleObjectMixin):
     """
     Retrieve an sis course data object and store in context
@@ -66,7 +112,7 @@ class CourseDataPermissionsMixin(CourseDataMixin):
         """
         Make an API call to Canvas that returns the list of account admins associated with the course's
         school.  Limit result set to the currently logged in user.  The list can be used for truth testing
-        conditions.
+        conditions.  The result is cached briefly (see get_account_admin_roles).
 
         :return: Canvas account admin information (response of admin request), limited to current user
         :rtype: list of account admin Python objects (converted from return value of SDK call)
@@ -79,16 +125,7 @@ class CourseDataPermissionsMixin(CourseDataMixin):
         # List account admins for school associated with course. TLT-382 specified that only school-level admins
         # will have access to the course creation process for now, so using school_code in combination with school:
         # subaccount (instead of using sis_account_id, which would cover cases for dept: and coursegroup: as well).
-        user_account_admin_list = admins.list_account_admins(
-            request_ctx=SDK_CONTEXT,
-            account_id='sis_account_id:school:%s' % self.object.school_code,
-            user_id='sis_user_id:%s' % self.request.user.username
-        ).json()
-        logger.debug("Admin list for %s in sis_account_id:school:%s is %s"
-                     % (self.request.user.username, self.object.school_code,
-                        user_account_admin_list))
-
-        return user_account_admin_list
+        return get_account_admin_roles(self.request.user.username, self.object.school_code)
 
 class CourseSiteCreationAllowedMixin(CourseDataPermissionsMixin):
 
@@ -117,7 +154,7 @@ class BulkCourseSiteCreationAllowedMixin(SingleObjectMixin):
         """
         Make an API call to Canvas that returns the list of account admins associated with the course's
         school.  Limit result set to the currently logged in user.  The list can be used for truth testing
-        conditions.
+        conditions.  The result is cached briefly (see get_account_admin_roles).
 
         :return: Canvas account admin information (response of admin request), limited to current user
         :rtype: list of account admin Python objects (converted from return value of SDK call)
@@ -130,18 +167,7 @@ class BulkCourseSiteCreationAllowedMixin(SingleObjectMixin):
         # List account admins for school associated with term. TLT-1132 specified that only school-level admins
         # will have access to the bulk course creation process for now,
 
-        # todo remove this after verification
-        print('%s' % self.object.school_id)
-        user_account_admin_list = admins.list_account_admins(
-            request_ctx=SDK_CONTEXT,
-            account_id='sis_account_id:school:%s' % self.object.school_id,
-            user_id='sis_user_id:%s' % self.request.user.username
-        ).json()
-        logger.debug("Admin list for %s in sis_account_id:school:%s is %s"
-                     % (self.request.user.username, self.object.school_id,
-                        user_account_admin_list))
-
-        return user_account_admin_list
+        return get_account_admin_roles(self.request.user.username, self.object.school_id)
 
     def dispatch(self, request, *args, **kwargs):
         # Retrieve the term data object and determine if user can go ahead with creation
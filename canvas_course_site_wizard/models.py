@@ -1,16 +1,147 @@
 import logging
+import operator
+import os
+import socket
+import threading
 import time
 
+from collections import defaultdict
 from datetime import datetime, timedelta
-from django.db.models import Q
+from functools import reduce
+from itertools import islice
+from django.db.models import Count, Exists, F, IntegerField, Max, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
 from icommons_common.models import CourseInstance, CourseSite, SiteMap, SiteMapType
 from django.conf import settings
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
+from django.utils import timezone
+
+from .exceptions import InvalidWorkflowStateTransition
 
 
 logger = logging.getLogger(__name__)
 
 
+# Default number of seconds a worker holds the CanvasCourseGenerationJobs it claims, or last renewed its leases on
+# (see claim_jobs and renew_leases)
+CANVAS_COURSE_GENERATION_JOB_LEASE_SECONDS = 5 * 60
+
+# Default number of minutes a CanvasCourseGenerationJob may go without progress (without its updated_at moving) in
+# each of these workflow_states before it is treated as stalled (see get_stalled_jobs)
+CANVAS_COURSE_GENERATION_JOB_STALLED_MINUTES = {
+    'queued': 6 * 60,
+    'running': 12 * 60,
+    'completed': 30,
+    'pending_finalize': 2 * 60,
+}
+
+# Default number of hours a CanvasCourseGenerationJob's content migration may take, from when it was queued, before
+# the job is failed even though Canvas still reports the migration as queued or running (see sweep_stalled_jobs)
+CANVAS_COURSE_GENERATION_JOB_MAX_MIGRATION_HOURS = 48
+
+
+def job_leasing_enabled():
+    """
+    True if the commands should claim CanvasCourseGenerationJobs with leases (so that any number of workers, on
+    any number of hosts, can share the queue) rather than relying on a pid file lock to run one at a time
+    """
+    return getattr(settings, 'CANVAS_COURSE_GENERATION_JOB_LEASING', False)
+
+
+def get_job_lease_owner():
+    """ Identifies this worker process as the holder of job leases """
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+# Number of seconds a bulk job's progress version is kept in the cache once it stops changing
+BULK_JOB_PROGRESS_VERSION_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def get_bulk_job_progress_version(bulk_job_id):
+    """
+    Returns the bulk job's progress version, a number which changes whenever the bulk job or one of its subjobs
+    changes state, so that watchers can tell when its progress needs to be read again without querying the
+    subjobs. Returns None if there is no version in the cache (e.g. it has been evicted), in which case watchers
+    have to fall back to reading the progress periodically.
+    """
+    return cache.get(_bulk_job_progress_version_cache_key(bulk_job_id))
+
+
+def bump_bulk_job_progress_version(bulk_job_ids):
+    """
+    Changes the progress version of each of the given bulk jobs (see get_bulk_job_progress_version) once the
+    current transaction commits, so that watchers don't read the progress before the change is visible
+    """
+    bulk_job_ids = set(bulk_job_id for bulk_job_id in bulk_job_ids if bulk_job_id)
+    if bulk_job_ids:
+        transaction.on_commit(lambda: _bump_bulk_job_progress_versions(bulk_job_ids))
+
+
+def _bump_bulk_job_progress_versions(bulk_job_ids):
+    for bulk_job_id in bulk_job_ids:
+        cache_key = _bulk_job_progress_version_cache_key(bulk_job_id)
+        try:
+            try:
+                cache.incr(cache_key)
+            except ValueError:
+                # not in the cache yet
+                cache.set(cache_key, 1, BULK_JOB_PROGRESS_VERSION_CACHE_TIMEOUT)
+        except Exception:
+            # progress watchers fall back to polling without the version, so this needn't hold up job processing
+            logger.warning('Could not update the progress version of bulk job %s', bulk_job_id, exc_info=True)
+
+
+def _bulk_job_progress_version_cache_key(bulk_job_id):
+    return 'canvas_course_site_wizard:bulk_job_progress_version:%s' % bulk_job_id
+
+
+def record_subjob_state_changes(changes):
+    """
+    Updates the subjob counters of the bulk jobs (see BulkCanvasCourseCreationJob.SUBJOB_COUNTER_FIELDS) for the
+    given subjob workflow_state changes, with one UPDATE ... SET counter = counter + n per bulk job (in bulk job id
+    order), and changes their progress versions. Call it in the same transaction as the changes are saved in.
+        :param changes: iterable of (bulk_job_id, old_workflow_state, new_workflow_state) tuples; old_workflow_state
+                        is None for a new subjob. Changes to subjobs without a bulk job are ignored.
+    """
+    deltas = defaultdict(lambda: defaultdict(int))
+    for bulk_job_id, old_workflow_state, new_workflow_state in changes:
+        if not bulk_job_id or old_workflow_state == new_workflow_state:
+            continue
+        bulk_job_deltas = deltas[bulk_job_id]
+        if old_workflow_state is None:
+            bulk_job_deltas['subjobs_total'] += 1
+        else:
+            bulk_job_deltas[BulkCanvasCourseCreationJob.get_subjob_counter_field(old_workflow_state)] -= 1
+        bulk_job_deltas[BulkCanvasCourseCreationJob.get_subjob_counter_field(new_workflow_state)] += 1
+
+    # update the bulk jobs in id order, so that concurrent transactions lock their rows in the same order and
+    # can't deadlock
+    for bulk_job_id in sorted(deltas):
+        bulk_job_deltas = deltas[bulk_job_id]
+        counter_updates = {field: F(field) + delta for field, delta in bulk_job_deltas.items() if delta}
+        if counter_updates:
+            BulkCanvasCourseCreationJob.objects.filter(pk=bulk_job_id).update(**counter_updates)
+    bump_bulk_job_progress_version(list(deltas))
+
+
+def record_workflow_state_transitions(transitions):
+    """
+    Records workflow_state changes which have just been written for CanvasCourseGenerationJobs: logs them as
+    CanvasCourseGenerationJobTransition events and counts them in the bulk jobs' subjob counters, with a fixed number
+    of queries however many jobs changed. Call it in the same transaction as the changes are saved in.
+        :param transitions: iterable of (job, old_workflow_state, new_workflow_state) tuples
+    """
+    transitions = [(job, old_workflow_state, new_workflow_state)
+                   for job, old_workflow_state, new_workflow_state in transitions
+                   if old_workflow_state != new_workflow_state]
+    if not transitions:
+        return
+    CanvasCourseGenerationJobTransition.objects.record(transitions)
+    record_subjob_state_changes((job.bulk_job_id, old_workflow_state, new_workflow_state)
+                                for job, old_workflow_state, new_workflow_state in transitions)
+
+
 class SISCourseDataMixin(object):
     """
     Extends an SIS-fed CourseInstance object with methods and properties needed for course site
@@ -145,6 +276,59 @@ class SISCourseData(CourseInstance, SISCourseDataMixin):
         proxy = True
 
 
+# Default number of course instance ids read per query by iter_course_instance_id_chunks
+ELIGIBLE_COURSE_INSTANCE_CHUNK_SIZE = 1000
+# Default number of CanvasCourseGenerationJobs inserted per batch by create_bulk_job
+BULK_JOB_CREATION_BATCH_SIZE = 500
+
+
+def get_eligible_course_instances(sis_term_id, school_id=None, sis_department_id=None, sis_course_group_id=None):
+    """
+    Returns a queryset of the course instances in the term (optionally limited to a school, and to one of its
+    departments or course groups) which are eligible to have a Canvas course created in bulk: those which aren't
+    already in Canvas, aren't excluded from the iSites feed, and have neither an iSite nor an external site.
+    The site checks are NOT EXISTS subqueries, so each course instance appears once however many sites it has.
+    """
+    filters = {
+        'term_id': sis_term_id,
+        'canvas_course_id__isnull': True,
+        'exclude_from_isites': 0,
+    }
+    if school_id:
+        filters['course__school'] = school_id
+    if sis_department_id:
+        filters['course__departments'] = sis_department_id
+    elif sis_course_group_id:
+        filters['course__course_groups'] = sis_course_group_id
+
+    course_sites = SiteMap.objects.filter(course_instance=OuterRef('pk'))
+    return CourseInstance.objects.filter(**filters).filter(
+        ~Exists(course_sites.filter(course_site__site_type_id='isite')),
+        ~Exists(course_sites.filter(course_site__external_id__isnull=False)),
+    )
+
+
+def iter_course_instance_id_chunks(queryset, chunk_size=None):
+    """
+    Yields the ids of the course instances in the queryset as lists of up to chunk_size ids, in id order. Each chunk
+    is read with its own query, starting after the last id of the previous chunk (keyset pagination), so that the
+    ids of any number of course instances can be worked through without holding them all in memory.
+    """
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'BULK_COURSE_CREATION', {}).get('eligibility_chunk_size',
+                                                                       ELIGIBLE_COURSE_INSTANCE_CHUNK_SIZE)
+    queryset = queryset.order_by('course_instance_id')
+    last_id = None
+    while True:
+        chunk_queryset = queryset if last_id is None else queryset.filter(course_instance_id__gt=last_id)
+        ids = list(chunk_queryset.values_list('course_instance_id', flat=True)[:chunk_size])
+        if ids:
+            yield ids
+        if len(ids) < chunk_size:
+            return
+        last_id = ids[-1]
+
+
 class CanvasCourseGenerationJobManager(models.Manager):
     """
     Custom manager for CanvasCourseGenerationJob
@@ -185,6 +369,130 @@ class CanvasCourseGenerationJobManager(models.Manager):
         })
         return self.filter(**kwargs)
 
+    def claim_jobs(self, lease_owner, limit, lease_seconds=None, after_pk=None, **kwargs):
+        """
+        Leases up to `limit` of the jobs matching kwargs (and with pk greater than after_pk, if given) to
+        lease_owner, in pk order, and returns them. Jobs already leased to another worker are skipped unless the
+        lease has expired, so the jobs of workers which have died are picked up again once their leases run out.
+        The candidate rows are locked with SELECT ... FOR UPDATE SKIP LOCKED, so concurrent workers claim
+        different jobs without waiting on each other; the lease is re-checked in the UPDATE for databases
+        without row locking.
+        """
+        if lease_seconds is None:
+            lease_seconds = getattr(settings, 'CANVAS_COURSE_GENERATION_JOB_LEASE_SECONDS',
+                                    CANVAS_COURSE_GENERATION_JOB_LEASE_SECONDS)
+        now = timezone.now()
+        lease_expires_at = now + timedelta(seconds=lease_seconds)
+        unleased = Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=now)
+
+        candidates = self.filter(unleased, **kwargs)
+        if after_pk is not None:
+            candidates = candidates.filter(pk__gt=after_pk)
+        with transaction.atomic():
+            # Oracle doesn't allow FOR UPDATE with a row limit, so stop reading after `limit` rows instead
+            locked = candidates.select_for_update(skip_locked=True).order_by('pk').values_list('pk', flat=True)
+            pks = list(islice(locked.iterator(), limit))
+            if pks:
+                self.filter(unleased, pk__in=pks).update(lease_owner=lease_owner, lease_expires_at=lease_expires_at)
+
+        if not pks:
+            return []
+        return list(self.filter(pk__in=pks, lease_owner=lease_owner,
+                                lease_expires_at=lease_expires_at).order_by('pk'))
+
+    def renew_leases(self, lease_owner, jobs, lease_seconds=None):
+        """
+        Extends lease_owner's leases on the given jobs by lease_seconds from now, and returns those of the jobs whose
+        leases it still held (the others have run out and been claimed by another worker, and should be left alone).
+        Call it between jobs or sub-batches of a claimed batch, so that the leases outlast the work on it.
+        """
+        if lease_seconds is None:
+            lease_seconds = getattr(settings, 'CANVAS_COURSE_GENERATION_JOB_LEASE_SECONDS',
+                                    CANVAS_COURSE_GENERATION_JOB_LEASE_SECONDS)
+        lease_expires_at = timezone.now() + timedelta(seconds=lease_seconds)
+        pks = [job.pk for job in jobs]
+        held_pks = set()
+        for i in range(0, len(pks), CanvasCourseGenerationJobUpdateBuffer.MAX_IDS_PER_UPDATE):
+            chunk = pks[i:i + CanvasCourseGenerationJobUpdateBuffer.MAX_IDS_PER_UPDATE]
+            updated = self.filter(pk__in=chunk, lease_owner=lease_owner).update(lease_expires_at=lease_expires_at)
+            if updated == len(chunk):
+                held_pks.update(chunk)
+            elif updated:
+                held_pks.update(self.filter(pk__in=chunk, lease_owner=lease_owner).values_list('pk', flat=True))
+        lost_pks = set(pks) - held_pks
+        if lost_pks:
+            logger.warning('Leases on CanvasCourseGenerationJobs %s have been taken over from %s', sorted(lost_pks),
+                           lease_owner)
+        held_jobs = [job for job in jobs if job.pk in held_pks]
+        for job in held_jobs:
+            job.lease_expires_at = lease_expires_at
+        return held_jobs
+
+    def release_jobs(self, lease_owner, jobs):
+        """ Gives up lease_owner's leases on the given jobs """
+        pks = [job.pk for job in jobs]
+        for i in range(0, len(pks), CanvasCourseGenerationJobUpdateBuffer.MAX_IDS_PER_UPDATE):
+            self.filter(
+                pk__in=pks[i:i + CanvasCourseGenerationJobUpdateBuffer.MAX_IDS_PER_UPDATE],
+                lease_owner=lease_owner
+            ).update(lease_owner=None, lease_expires_at=None)
+
+    def get_stalled_jobs(self, stalled_minutes=None, now=None, **kwargs):
+        """
+        Returns the jobs matching kwargs which have gone without progress (their updated_at hasn't moved) for longer
+        than the number of minutes given for their workflow_state in stalled_minutes (by default the
+        CANVAS_COURSE_GENERATION_JOB_STALLED_MINUTES setting). Each state's condition is a range scan of the
+        (workflow_state, updated_at) index.
+        """
+        if stalled_minutes is None:
+            stalled_minutes = getattr(settings, 'CANVAS_COURSE_GENERATION_JOB_STALLED_MINUTES',
+                                      CANVAS_COURSE_GENERATION_JOB_STALLED_MINUTES)
+        if not stalled_minutes:
+            return self.none()
+        now = now or timezone.now()
+        stalled = reduce(operator.or_, [
+            Q(workflow_state=workflow_state, updated_at__lt=now - timedelta(minutes=minutes))
+            for workflow_state, minutes in stalled_minutes.items()
+        ])
+        return self.filter(stalled, **kwargs)
+
+    def mark_setup_started(self, jobs):
+        """ Sets setup_started_at on those of the given jobs which don't have it yet, with one UPDATE per 1000 jobs """
+        now = timezone.now()
+        jobs = [job for job in jobs if not job.setup_started_at]
+        pks = [job.pk for job in jobs]
+        for i in range(0, len(pks), CanvasCourseGenerationJobUpdateBuffer.MAX_IDS_PER_UPDATE):
+            self.filter(
+                pk__in=pks[i:i + CanvasCourseGenerationJobUpdateBuffer.MAX_IDS_PER_UPDATE],
+                setup_started_at__isnull=True
+            ).update(setup_started_at=now, updated_at=now)
+        for job in jobs:
+            job.setup_started_at = now
+
+    def transition_workflow_states(self, pks, expected_workflow_state, **changes):
+        """
+        Sets the given fields (including a new workflow_state) on those of the given jobs which are still in
+        expected_workflow_state, with one UPDATE ... WHERE id IN (...) AND workflow_state = <expected_workflow_state>
+        per 1000 jobs, and returns the pks of the jobs updated. updated_at and the timestamp of the stage reached are
+        set too, unless given. Doesn't record the transitions (see record_workflow_state_transitions).
+        """
+        for name, value in CanvasCourseGenerationJob.get_transition_changes(changes['workflow_state'],
+                                                                            timezone.now()).items():
+            changes.setdefault(name, value)
+        chunk_size = CanvasCourseGenerationJobUpdateBuffer.MAX_IDS_PER_UPDATE
+        updated_pks = []
+        for i in range(0, len(pks), chunk_size):
+            chunk = pks[i:i + chunk_size]
+            updated = self.filter(pk__in=chunk, workflow_state=expected_workflow_state).update(**changes)
+            if updated == len(chunk):
+                updated_pks.extend(chunk)
+            elif updated:
+                # some of the jobs had been moved on; the ones which now have the new values are the ones updated
+                # (this also counts a job another worker moved to the same values, which is harmless)
+                left_alone = set(self.filter(pk__in=chunk).exclude(**changes).values_list('pk', flat=True))
+                updated_pks.extend(pk for pk in chunk if pk not in left_alone)
+        return updated_pks
+
 
 class CanvasCourseGenerationJob(models.Model):
     """
@@ -225,6 +533,29 @@ class CanvasCourseGenerationJob(models.Model):
         (STATUS_FINALIZE_FAILED, STATUS_FINALIZE_FAILED),
     )
 
+    # Non-terminal states, and the terminal states which indicate that course generation failed
+    INTERMEDIATE_STATES = (STATUS_SETUP, STATUS_QUEUED, STATUS_RUNNING, STATUS_COMPLETED, STATUS_PENDING_FINALIZE)
+    FAILED_STATES = (STATUS_SETUP_FAILED, STATUS_FAILED, STATUS_FINALIZE_FAILED)
+
+    # The workflow_states a job may move to from each state (terminal states have none). Jobs are moved with a
+    # conditional UPDATE (see transition_workflow_state), so that of several workers moving a job on, only one wins.
+    ALLOWED_TRANSITIONS = {
+        STATUS_SETUP: (STATUS_SETUP_FAILED, STATUS_QUEUED, STATUS_PENDING_FINALIZE, STATUS_FINALIZED),
+        STATUS_QUEUED: (STATUS_RUNNING, STATUS_COMPLETED, STATUS_FAILED),
+        STATUS_RUNNING: (STATUS_COMPLETED, STATUS_FAILED),
+        # a completed job whose finalization was interrupted is handed back for finalization by the stalled job sweeper
+        STATUS_COMPLETED: (STATUS_FINALIZED, STATUS_FINALIZE_FAILED, STATUS_PENDING_FINALIZE),
+        STATUS_PENDING_FINALIZE: (STATUS_FINALIZED, STATUS_FINALIZE_FAILED),
+    }
+
+    # The stage timestamp set when a job moves to each workflow_state; setup_started_at is set when the job is
+    # picked up for setup, and canvas_course_created_at when its canvas_course_id is first saved
+    STAGE_TIMESTAMP_FIELDS = {
+        STATUS_QUEUED: 'migration_queued_at',
+        STATUS_COMPLETED: 'migration_completed_at',
+        STATUS_FINALIZED: 'finalized_at',
+    }
+
     # User friendly identifiers for states
     STATUS_DISPLAY_NAMES = {
         STATUS_SETUP: 'Queued',
@@ -242,16 +573,37 @@ class CanvasCourseGenerationJob(models.Model):
     sis_course_id = models.CharField(max_length=20, db_index=True)
     content_migration_id = models.IntegerField(null=True, blank=True,)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     status_url = models.CharField(null=True, blank=True, max_length=200)
     workflow_state = models.CharField(max_length=20, choices=WORKFLOW_STATUS_CHOICES, default=STATUS_SETUP)
     created_by_user_id = models.CharField(max_length=20)
     bulk_job_id = models.IntegerField(null=True, blank=True)
+    # the worker currently processing the job, and when its claim on the job runs out (see claim_jobs)
+    lease_owner = models.CharField(max_length=100, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    # when the job reached each stage of course creation (see STAGE_TIMESTAMP_FIELDS and stamp_stages)
+    setup_started_at = models.DateTimeField(null=True, blank=True)
+    canvas_course_created_at = models.DateTimeField(null=True, blank=True)
+    migration_queued_at = models.DateTimeField(null=True, blank=True)
+    migration_completed_at = models.DateTimeField(null=True, blank=True)
+    finalized_at = models.DateTimeField(null=True, blank=True)
 
     objects = CanvasCourseGenerationJobManager()
 
     class Meta:
         db_table = 'canvas_course_generation_job'
+        # the leading workflow_state column also serves queries which filter on workflow_state alone
+        indexes = [
+            models.Index(fields=['workflow_state', 'bulk_job_id'], name='ccgj_state_bulk_job_idx'),
+            models.Index(fields=['sis_course_id', 'bulk_job_id'], name='ccgj_sis_course_bulk_job_idx'),
+            # for finding stalled jobs (see get_stalled_jobs)
+            models.Index(fields=['workflow_state', 'updated_at'], name='ccgj_state_updated_idx'),
+        ]
+        # a course may only be created once per bulk job; single course jobs (no bulk job) may be retried
+        constraints = [
+            models.UniqueConstraint(fields=['bulk_job_id', 'sis_course_id'], condition=Q(bulk_job_id__isnull=False),
+                                    name='ccgj_bulk_job_sis_course_uniq'),
+        ]
 
     def __unicode__(self):
         #TODO: unit test for this method (skipped to support bug fix in QA testing)
@@ -262,20 +614,350 @@ class CanvasCourseGenerationJob(models.Model):
     def status_display_name(self):
         return CanvasCourseGenerationJob.STATUS_DISPLAY_NAMES[self.workflow_state]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        job = super(CanvasCourseGenerationJob, cls).from_db(db, field_names, values)
+        # remember the saved workflow_state, so that save() can tell how the bulk job's subjob counters change
+        job._saved_workflow_state = job.__dict__.get('workflow_state')
+        return job
+
+    def save(self, *args, **kwargs):
+        """
+        Saves the job, setting updated_at and the timestamps of any stages the job has reached (see stamp_stages);
+        a change to its workflow_state is recorded in the same transaction (see record_workflow_state_transitions)
+        """
+        update_fields = kwargs.get('update_fields')
+        saving_workflow_state = update_fields is None or 'workflow_state' in update_fields
+        adding = self._state.adding
+        stamped_fields = self.stamp_stages(
+            workflow_state=self.workflow_state if saving_workflow_state and (
+                adding or getattr(self, '_saved_workflow_state', None) != self.workflow_state) else None,
+            canvas_course_id_saved=update_fields is None or 'canvas_course_id' in update_fields
+        )
+        if update_fields is not None:
+            # updated_at is only set by auto_now when it is saved
+            kwargs['update_fields'] = list(update_fields) + stamped_fields + ['updated_at']
+        with transaction.atomic():
+            super(CanvasCourseGenerationJob, self).save(*args, **kwargs)
+            if saving_workflow_state and adding:
+                record_subjob_state_changes([(self.bulk_job_id, None, self.workflow_state)])
+            elif saving_workflow_state:
+                record_workflow_state_transitions(
+                    [(self, getattr(self, '_saved_workflow_state', self.workflow_state), self.workflow_state)])
+        if saving_workflow_state:
+            self._saved_workflow_state = self.workflow_state
+
+    def stamp_stages(self, workflow_state=None, canvas_course_id_saved=False, now=None):
+        """
+        Sets the timestamp of the stage reached by moving to workflow_state (if any, see STAGE_TIMESTAMP_FIELDS),
+        and canvas_course_created_at if the job's canvas_course_id is being saved for the first time. Returns the
+        names of the fields set.
+        """
+        now = now or timezone.now()
+        stamped_fields = []
+        if workflow_state in CanvasCourseGenerationJob.STAGE_TIMESTAMP_FIELDS:
+            stamped_fields.append(CanvasCourseGenerationJob.STAGE_TIMESTAMP_FIELDS[workflow_state])
+        if canvas_course_id_saved and self.canvas_course_id and not self.canvas_course_created_at:
+            stamped_fields.append('canvas_course_created_at')
+        for name in stamped_fields:
+            setattr(self, name, now)
+        return stamped_fields
+
+    @classmethod
+    def get_transition_changes(cls, workflow_state, now):
+        """ the field values to write when moving a job to workflow_state at the time given by now """
+        changes = {'workflow_state': workflow_state, 'updated_at': now}
+        if workflow_state in cls.STAGE_TIMESTAMP_FIELDS:
+            changes[cls.STAGE_TIMESTAMP_FIELDS[workflow_state]] = now
+        return changes
+
+    @classmethod
+    def check_workflow_state_transition(cls, from_state, to_state):
+        """
+        Raises InvalidWorkflowStateTransition unless a job may move from from_state to to_state (see
+        ALLOWED_TRANSITIONS). Staying in the same state is allowed.
+        """
+        if from_state != to_state and to_state not in cls.ALLOWED_TRANSITIONS.get(from_state, ()):
+            raise InvalidWorkflowStateTransition(cls.__name__, from_state, to_state)
+
+    def transition_workflow_state(self, expected_workflow_state, workflow_state, **fields):
+        """
+        Moves the job from expected_workflow_state to workflow_state with a single
+        UPDATE ... WHERE id = <pk> AND workflow_state = <expected_workflow_state>, and records the change (see
+        record_workflow_state_transitions). Any other fields given are written by the same UPDATE, so they are only
+        saved if the transition is. Returns True if this call moved the job, or False if the job was no
+        longer in expected_workflow_state (e.g. another worker moved it first) or was already in workflow_state.
+        Raises InvalidWorkflowStateTransition if the transition isn't allowed.
+        """
+        CanvasCourseGenerationJob.check_workflow_state_transition(expected_workflow_state, workflow_state)
+        if expected_workflow_state == workflow_state:
+            return False
+        changes = CanvasCourseGenerationJob.get_transition_changes(workflow_state, timezone.now())
+        changes.update(fields)
+        with transaction.atomic():
+            updated = CanvasCourseGenerationJob.objects.filter(
+                pk=self.pk,
+                workflow_state=expected_workflow_state
+            ).update(**changes)
+            if updated:
+                record_workflow_state_transitions([(self, expected_workflow_state, workflow_state)])
+        if not updated:
+            logger.info('CanvasCourseGenerationJob %s was not moved to %s as it was no longer %s', self.pk,
+                        workflow_state, expected_workflow_state)
+            return False
+        for name, value in changes.items():
+            setattr(self, name, value)
+        self._saved_workflow_state = workflow_state
+        return True
+
     def update_workflow_state(self, workflow_state, raise_exception=False):
         """
-        Updates job workflow_state. Return True if update succeeded. If raise_exception param is not True, or not provided,
-         it will return False if update fails. If raise_exception is True, it will re-raise failures/exceptions.
+        Moves the job from its current workflow_state to the given one (see transition_workflow_state). Returns True
+        if the job was moved, and False if another worker moved it first. If raise_exception param is not True, or
+        not provided, it will also return False if the update fails (including if the transition isn't allowed).
+        If raise_exception is True, it will re-raise failures/exceptions.
         """
-        self.workflow_state = workflow_state
         try:
-            self.save(update_fields=['workflow_state'])
+            return self.transition_workflow_state(self.workflow_state, workflow_state)
         except Exception as e:
             if raise_exception:
                 raise e
             else:
                 return False
-        return True
+
+
+class CanvasCourseGenerationJobUpdateBuffer(object):
+    """
+    Write-behind buffer for changes to CanvasCourseGenerationJob fields. Changes recorded with update() are applied
+    to the job object straight away, but are only written to the database when the buffer is flushed: explicitly
+    with flush(), once flush_size jobs have pending changes, or on leaving the buffer's `with` block. Jobs with the
+    same pending values are written with one UPDATE ... WHERE id IN (...) statement, and the rest with bulk_update().
+    Workflow_state changes are checked against CanvasCourseGenerationJob.ALLOWED_TRANSITIONS when they are
+    recorded, and written with UPDATE ... WHERE id IN (...) AND workflow_state = <the state the job was in>, so a
+    job which another worker has moved on in the meantime is left alone; its pk is added to lost_job_ids, unless
+    the job had already been moved to the same workflow_state (e.g. failed by the controller, which records the
+    failure itself), in which case the change is treated as written.
+    Safe to share between threads.
+    """
+    BUFFERED_FIELDS = ('workflow_state', 'canvas_course_id', 'content_migration_id', 'status_url')
+
+    # Oracle allows at most 1000 items in an IN list
+    MAX_IDS_PER_UPDATE = 1000
+
+    def __init__(self, flush_size=None):
+        if flush_size is None:
+            flush_size = getattr(settings, 'CANVAS_COURSE_GENERATION_JOB_UPDATE_FLUSH_SIZE', 100)
+        self.flush_size = flush_size
+        self._pending = {}
+        self._jobs = {}
+        # the workflow_state each job with a pending workflow_state change was in before the change
+        self._expected_workflow_states = {}
+        # the stage timestamps (see CanvasCourseGenerationJob.stamp_stages) to set for each job when it is flushed
+        self._stage_fields = {}
+        # jobs whose buffered changes weren't written because they were no longer in the expected workflow_state
+        self.lost_job_ids = set()
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def update(self, job, **fields):
+        """
+        Sets the given fields on the job and queues them to be written to the database. Raises
+        InvalidWorkflowStateTransition if the job may not move to the given workflow_state.
+        """
+        unbuffered_fields = set(fields) - set(self.BUFFERED_FIELDS)
+        if unbuffered_fields:
+            raise ValueError("can't buffer changes to %s" % ', '.join(sorted(unbuffered_fields)))
+
+        with self._lock:
+            stage_fields = self._stage_fields.setdefault(job.pk, set())
+            if 'workflow_state' in fields:
+                CanvasCourseGenerationJob.check_workflow_state_transition(job.workflow_state, fields['workflow_state'])
+                if job.pk not in self._expected_workflow_states:
+                    self._expected_workflow_states[job.pk] = job.workflow_state
+                if fields['workflow_state'] in CanvasCourseGenerationJob.STAGE_TIMESTAMP_FIELDS and \
+                        fields['workflow_state'] != job.workflow_state:
+                    stage_fields.add(CanvasCourseGenerationJob.STAGE_TIMESTAMP_FIELDS[fields['workflow_state']])
+            if fields.get('canvas_course_id') and not job.canvas_course_created_at:
+                stage_fields.add('canvas_course_created_at')
+            self._jobs[job.pk] = job
+            for name, value in fields.items():
+                setattr(job, name, value)
+            if 'workflow_state' in fields:
+                # the change is counted when the buffer is flushed, not if the job is saved in the meantime
+                job._saved_workflow_state = job.workflow_state
+            self._pending.setdefault(job.pk, {}).update(fields)
+            if len(self._pending) >= self.flush_size:
+                self.flush()
+
+    def update_workflow_state(self, job, workflow_state):
+        """ Buffered equivalent of CanvasCourseGenerationJob.update_workflow_state """
+        self.update(job, workflow_state=workflow_state)
+
+    def flush(self):
+        """
+        Writes all pending changes to the database, setting updated_at and the stage timestamps of the jobs to the
+        time of the flush. Returns the number of jobs updated.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            jobs, self._jobs = self._jobs, {}
+            expected_workflow_states, self._expected_workflow_states = self._expected_workflow_states, {}
+            stage_fields, self._stage_fields = self._stage_fields, {}
+            if not pending:
+                return 0
+
+            now = timezone.now()
+            for pk, fields in pending.items():
+                fields['updated_at'] = now
+                for name in stage_fields.get(pk, ()):
+                    fields[name] = now
+                    setattr(jobs[pk], name, now)
+
+            # group the jobs by the fields that changed, then by the values they changed to (and, for workflow_state
+            # changes, the state they changed from)
+            jobs_by_fields = defaultdict(lambda: defaultdict(list))
+            for pk, fields in pending.items():
+                values = tuple(fields[f] for f in sorted(fields))
+                if pk in expected_workflow_states:
+                    values += (expected_workflow_states[pk],)
+                jobs_by_fields[tuple(sorted(fields))][values].append(pk)
+
+            try:
+                with transaction.atomic():
+                    updated, lost_job_ids = self._write(jobs_by_fields, jobs)
+            except Exception:
+                logger.exception('Failed to write buffered changes for %d CanvasCourseGenerationJobs', len(pending))
+                raise
+            if lost_job_ids:
+                self.lost_job_ids.update(lost_job_ids)
+                logger.warning('Dropped buffered changes for %d CanvasCourseGenerationJobs which had already been '
+                               'moved on by another worker: %s', len(lost_job_ids), lost_job_ids)
+
+        logger.debug('Wrote buffered changes for %d CanvasCourseGenerationJobs', updated)
+        return updated
+
+    def _write(self, jobs_by_fields, jobs):
+        """ writes the grouped changes; returns the number of jobs updated, and the pks of the jobs left alone """
+        updated = 0
+        lost_job_ids = []
+        transitions = []
+        for field_names, jobs_by_values in jobs_by_fields.items():
+            single_jobs = []
+            for values, pks in jobs_by_values.items():
+                changes = dict(zip(field_names, values))
+                if 'workflow_state' in field_names:
+                    expected_workflow_state = values[-1]
+                    updated_pks = CanvasCourseGenerationJob.objects.transition_workflow_states(
+                        pks, expected_workflow_state, **changes)
+                    updated += len(updated_pks)
+                    lost_job_ids.extend(self._get_lost_job_ids(set(pks) - set(updated_pks),
+                                                               changes['workflow_state']))
+                    transitions.extend((jobs[pk], expected_workflow_state, changes['workflow_state'])
+                                       for pk in updated_pks)
+                elif len(pks) == 1:
+                    single_jobs.append(CanvasCourseGenerationJob(pk=pks[0], **changes))
+                else:
+                    for i in range(0, len(pks), self.MAX_IDS_PER_UPDATE):
+                        updated += CanvasCourseGenerationJob.objects.filter(
+                            pk__in=pks[i:i + self.MAX_IDS_PER_UPDATE]
+                        ).update(**changes)
+            if single_jobs:
+                CanvasCourseGenerationJob.objects.bulk_update(single_jobs, field_names,
+                                                              batch_size=self.MAX_IDS_PER_UPDATE)
+                updated += len(single_jobs)
+        record_workflow_state_transitions(transitions)
+        return updated, lost_job_ids
+
+    def _get_lost_job_ids(self, pks, workflow_state):
+        """
+        returns those of the given jobs, whose buffered change to workflow_state wasn't written, which are not
+        already in workflow_state; the others were moved there by someone else and don't need the change
+        """
+        if not pks:
+            return []
+        pks = sorted(pks)
+        already_moved = set()
+        for i in range(0, len(pks), self.MAX_IDS_PER_UPDATE):
+            already_moved.update(CanvasCourseGenerationJob.objects.filter(
+                pk__in=pks[i:i + self.MAX_IDS_PER_UPDATE],
+                workflow_state=workflow_state
+            ).values_list('pk', flat=True))
+        if already_moved:
+            logger.debug('CanvasCourseGenerationJobs %s were already %s', sorted(already_moved), workflow_state)
+        return [pk for pk in pks if pk not in already_moved]
+
+
+class CanvasCourseGenerationJobTransitionManager(models.Manager):
+
+    def record(self, transitions):
+        """
+        Adds an event for each of the given (job, old_workflow_state, new_workflow_state) transitions, with one
+        query per 1000 jobs for the time of each job's previous event (the job's creation time if it has none) and
+        a single bulk insert. Use record_workflow_state_transitions rather than calling this directly.
+        """
+        now = timezone.now()
+        worker = get_job_lease_owner()
+        job_ids = list(dict.fromkeys(job.pk for job, _, _ in transitions))
+        chunk_size = CanvasCourseGenerationJobUpdateBuffer.MAX_IDS_PER_UPDATE
+        previous_event_times = {}
+        for i in range(0, len(job_ids), chunk_size):
+            previous_event_times.update(self.filter(job_id__in=job_ids[i:i + chunk_size]).order_by().values_list(
+                'job_id').annotate(Max('created_at')))
+
+        events = []
+        for job, old_workflow_state, new_workflow_state in transitions:
+            entered_at = previous_event_times.get(job.pk) or job.created_at
+            events.append(CanvasCourseGenerationJobTransition(
+                job_id=job.pk,
+                bulk_job_id=job.bulk_job_id,
+                from_state=old_workflow_state,
+                to_state=new_workflow_state,
+                created_at=now,
+                worker=worker,
+                duration_seconds=(now - entered_at).total_seconds() if entered_at else None,
+            ))
+            # a job may change more than once in a batch (e.g. completed and then finalized)
+            previous_event_times[job.pk] = now
+        return self.bulk_create(events, batch_size=chunk_size)
+
+
+class CanvasCourseGenerationJobTransition(models.Model):
+    """
+    Append-only log of the workflow_state changes of CanvasCourseGenerationJobs (see
+    record_workflow_state_transitions), recording when each change was made, by which worker, and how long the job
+    had spent in the state it left. Rows are never updated.
+    """
+    job_id = models.IntegerField()
+    bulk_job_id = models.IntegerField(null=True, blank=True)
+    from_state = models.CharField(max_length=20)
+    to_state = models.CharField(max_length=20)
+    created_at = models.DateTimeField(default=timezone.now)
+    # the worker which made the change (see get_job_lease_owner)
+    worker = models.CharField(max_length=100)
+    # seconds since the job's previous transition (or its creation)
+    duration_seconds = models.FloatField(null=True, blank=True)
+
+    objects = CanvasCourseGenerationJobTransitionManager()
+
+    class Meta:
+        db_table = 'canvas_wizard_job_transition'
+        indexes = [
+            models.Index(fields=['created_at'], name='cw_job_trans_time_idx'),
+            models.Index(fields=['job_id', 'created_at'], name='cw_job_trans_job_idx'),
+            models.Index(fields=['bulk_job_id', 'created_at'], name='cw_job_trans_bulk_job_idx'),
+        ]
+
+    def __unicode__(self):
+        return "(CanvasCourseGenerationJobTransition ID=%s: job_id=%s | %s -> %s)" % (
+            self.pk, self.job_id, self.from_state, self.to_state)
 
 
 class CanvasSchoolTemplate(models.Model):
@@ -298,6 +980,15 @@ class BulkCanvasCourseCreationJobManager(models.Manager):
     Custom manager for BulkCanvasCourseCreationJob
     """
     def create_bulk_job(self, **kwargs):
+        """
+        Creates a bulk job, with a CanvasCourseGenerationJob for each of the given course_instance_ids (or, if none
+        are given, each of the eligible course instances, see get_eligible_course_instances), all in one
+        transaction. The subjobs are inserted a batch at a time (BULK_COURSE_CREATION['job_creation_batch_size'],
+        at most 1000) so that neither the statements nor the memory used grow with the size of the term.
+        Course instances which already have an active or finalized job, and repeats in course_instance_ids, are
+        skipped. The numbers of subjobs inserted, course instances skipped and duplicate ids are set on the
+        returned bulk job as ingestion_counts.
+        """
         school_id = kwargs.get('school_id')
         sis_term_id = kwargs.get('sis_term_id')
         sis_department_id = kwargs.get('sis_department_id')
@@ -306,52 +997,99 @@ class BulkCanvasCourseCreationJobManager(models.Manager):
         created_by_user_id = kwargs.get('created_by_user_id')
         course_instance_ids = kwargs.get('course_instance_ids')
 
-        bulk_job = BulkCanvasCourseCreationJob(
-            school_id=school_id,
-            sis_term_id=sis_term_id,
-            sis_department_id=sis_department_id,
-            sis_course_group_id=sis_course_group_id,
-            template_canvas_course_id=template_canvas_course_id,
-            created_by_user_id=created_by_user_id
+        batch_size = min(
+            getattr(settings, 'BULK_COURSE_CREATION', {}).get('job_creation_batch_size', BULK_JOB_CREATION_BATCH_SIZE),
+            CanvasCourseGenerationJobUpdateBuffer.MAX_IDS_PER_UPDATE
         )
-        bulk_job.save()
-
-        if not course_instance_ids:
-            filters = {
-                'canvas_course_id__isnull': True,
-                'exclude_from_isites': 0,
-                'term_id': sis_term_id,
-                'course__school': school_id
-            }
-            if sis_department_id:
-                filters['course__departments'] = sis_department_id
-            elif sis_course_group_id:
-                filters['course__course_groups'] = sis_course_group_id
-            course_instance_ids = [
-                ci_id for ci_id in CourseInstance.objects.filter(**filters).values_list(
-                    'course_instance_id',
-                    flat=True
-                )
-            ]
+        ingestion_counts = {'inserted': 0, 'skipped': 0, 'duplicates': 0}
 
-        course_jobs = []
-        for ci_id in course_instance_ids:
-            course_job = CanvasCourseGenerationJob(
-                sis_course_id=ci_id,
-                bulk_job_id=bulk_job.id,
+        start = time.time()
+        with transaction.atomic():
+            bulk_job = BulkCanvasCourseCreationJob(
+                school_id=school_id,
+                sis_term_id=sis_term_id,
+                sis_department_id=sis_department_id,
+                sis_course_group_id=sis_course_group_id,
+                template_canvas_course_id=template_canvas_course_id,
                 created_by_user_id=created_by_user_id
             )
-            course_jobs.append(course_job)
-
-        start = time.time()
-        CanvasCourseGenerationJob.objects.bulk_create(course_jobs)
-        logger.info("Created %d CanvasCourseGenerationJobs in %d", len(course_jobs), (time.time() - start) * 1000)
-
-        bulk_job.status = BulkCanvasCourseCreationJob.STATUS_PENDING
-        bulk_job.save(update_fields=['status'])
-
+            bulk_job.save()
+
+            if course_instance_ids:
+                unique_course_instance_ids = list(dict.fromkeys(course_instance_ids))
+                ingestion_counts['duplicates'] = len(course_instance_ids) - len(unique_course_instance_ids)
+                course_instance_id_chunks = (
+                    unique_course_instance_ids[i:i + batch_size]
+                    for i in range(0, len(unique_course_instance_ids), batch_size)
+                )
+            else:
+                # stream the eligible course instances in chunks, rather than loading all of the term's ids at once
+                course_instance_id_chunks = iter_course_instance_id_chunks(get_eligible_course_instances(
+                    sis_term_id,
+                    school_id=school_id,
+                    sis_department_id=sis_department_id,
+                    sis_course_group_id=sis_course_group_id
+                ), chunk_size=batch_size)
+
+            for chunk in course_instance_id_chunks:
+                existing_sis_course_ids = set(CanvasCourseGenerationJob.objects.filter(
+                    sis_course_id__in=[str(ci_id) for ci_id in chunk],
+                    workflow_state__in=CanvasCourseGenerationJob.INTERMEDIATE_STATES + (
+                        CanvasCourseGenerationJob.STATUS_FINALIZED,)
+                ).values_list('sis_course_id', flat=True))
+                course_jobs = [
+                    CanvasCourseGenerationJob(
+                        sis_course_id=ci_id,
+                        bulk_job_id=bulk_job.id,
+                        created_by_user_id=created_by_user_id
+                    )
+                    for ci_id in chunk if str(ci_id) not in existing_sis_course_ids
+                ]
+                CanvasCourseGenerationJob.objects.bulk_create(course_jobs, batch_size=batch_size)
+                ingestion_counts['inserted'] += len(course_jobs)
+                ingestion_counts['skipped'] += len(chunk) - len(course_jobs)
+
+            # bulk_create() bypasses save(), so the new subjobs are counted here
+            bulk_job.subjobs_total = bulk_job.subjobs_setup = ingestion_counts['inserted']
+            bulk_job.status = BulkCanvasCourseCreationJob.STATUS_PENDING
+            bulk_job.save(update_fields=['status', 'subjobs_total', 'subjobs_setup', 'updated_at'])
+
+        logger.info("Created %d CanvasCourseGenerationJobs for bulk job %s in %d ms (%d skipped as they already have "
+                    "a job, %d duplicates)", ingestion_counts['inserted'], bulk_job.id, (time.time() - start) * 1000,
+                    ingestion_counts['skipped'], ingestion_counts['duplicates'])
+        bulk_job.ingestion_counts = ingestion_counts
         return bulk_job
 
+    def rebuild_subjob_counters(self, bulk_job_ids=None):
+        """
+        Recounts the subjobs of the given bulk jobs (all bulk jobs if none are given) and overwrites their subjob
+        counters, a chunk of bulk jobs at a time, e.g. to repair counters which drifted because subjobs were
+        changed outside of save() and CanvasCourseGenerationJobUpdateBuffer. Returns the number of bulk jobs
+        rebuilt.
+        """
+        if bulk_job_ids is None:
+            bulk_job_ids = self.order_by('pk').values_list('pk', flat=True).iterator()
+        chunk_size = CanvasCourseGenerationJobUpdateBuffer.MAX_IDS_PER_UPDATE
+        counter_fields = ['subjobs_total'] + sorted(set(BulkCanvasCourseCreationJob.SUBJOB_COUNTER_FIELDS.values()))
+        bulk_job_ids = iter(bulk_job_ids)
+        rebuilt = 0
+        while True:
+            chunk = list(islice(bulk_job_ids, chunk_size))
+            if not chunk:
+                break
+            counters = {bulk_job_id: dict.fromkeys(counter_fields, 0) for bulk_job_id in chunk}
+            subjob_counts = CanvasCourseGenerationJob.objects.filter(bulk_job_id__in=chunk).order_by().values_list(
+                'bulk_job_id', 'workflow_state').annotate(Count('pk'))
+            for bulk_job_id, workflow_state, count in subjob_counts:
+                counters[bulk_job_id]['subjobs_total'] += count
+                counters[bulk_job_id][BulkCanvasCourseCreationJob.get_subjob_counter_field(workflow_state)] += count
+            with transaction.atomic():
+                # in id order, like record_subjob_state_changes, so that the row locks are taken in the same order
+                for bulk_job_id in sorted(counters):
+                    rebuilt += self.filter(pk=bulk_job_id).update(**counters[bulk_job_id])
+            bump_bulk_job_progress_version(chunk)
+        return rebuilt
+
     def get_long_running_jobs(self, older_than_date=None, older_than_minutes=None, **kwargs):
         """
         Returns a list of bulk create job objects in a non-terminal state older than
@@ -383,6 +1121,37 @@ class BulkCanvasCourseCreationJobManager(models.Manager):
         })
         return self.filter(**kwargs)
 
+    def get_jobs_ready_to_finalize(self, **kwargs):
+        """
+        Returns the bulk jobs which are ready to finalize (see BulkCanvasCourseCreationJob.ready_to_finalize) in a
+        single query: PENDING jobs for which NOT EXISTS a subjob in an intermediate state. Each job is annotated
+        with completed_subjobs_count and failed_subjobs_count.
+        """
+        subjobs = CanvasCourseGenerationJob.objects.filter(bulk_job_id=OuterRef('pk'))
+        kwargs.update({
+            'status': BulkCanvasCourseCreationJob.STATUS_PENDING
+        })
+        return self.filter(**kwargs).annotate(
+            has_intermediate_subjobs=Exists(
+                subjobs.filter(workflow_state__in=CanvasCourseGenerationJob.INTERMEDIATE_STATES)
+            ),
+            completed_subjobs_count=_count_subjobs(subjobs, Q(workflow_state=CanvasCourseGenerationJob.STATUS_FINALIZED)),
+            failed_subjobs_count=_count_subjobs(subjobs, Q(workflow_state__in=CanvasCourseGenerationJob.FAILED_STATES)),
+        ).filter(has_intermediate_subjobs=False)
+
+
+def _count_subjobs(subjobs, condition):
+    """
+    Returns a subquery expression counting the given (correlated) subjobs which match the condition
+    """
+    return Coalesce(
+        Subquery(
+            subjobs.order_by().values('bulk_job_id').annotate(count=Count('pk', filter=condition)).values('count'),
+            output_field=IntegerField()
+        ),
+        0
+    )
+
 
 class BulkCanvasCourseCreationJob(models.Model):
     """
@@ -415,6 +1184,23 @@ class BulkCanvasCourseCreationJob(models.Model):
         STATUS_NOTIFICATION_SUCCESSFUL: 'Complete'
     }
 
+    # The statuses a job may move to from each status; jobs are moved with a conditional UPDATE (see
+    # transition_status), so that of several workers moving a job on, only one wins
+    ALLOWED_TRANSITIONS = {
+        STATUS_SETUP: (STATUS_PENDING,),
+        STATUS_PENDING: (STATUS_FINALIZING,),
+        STATUS_FINALIZING: (STATUS_NOTIFICATION_SUCCESSFUL, STATUS_NOTIFICATION_FAILED),
+    }
+
+    # the subjob counter each subjob workflow_state is counted in (subjobs_total counts all subjobs)
+    SUBJOB_COUNTER_FIELDS = dict(
+        [(CanvasCourseGenerationJob.STATUS_SETUP, 'subjobs_setup'),
+         (CanvasCourseGenerationJob.STATUS_FINALIZED, 'subjobs_finalized')] +
+        [(state, 'subjobs_in_flight') for state in CanvasCourseGenerationJob.INTERMEDIATE_STATES
+         if state != CanvasCourseGenerationJob.STATUS_SETUP] +
+        [(state, 'subjobs_failed') for state in CanvasCourseGenerationJob.FAILED_STATES]
+    )
+
     school_id = models.CharField(max_length=10)
     sis_term_id = models.IntegerField()
     sis_department_id = models.IntegerField(null=True, blank=True)
@@ -423,7 +1209,13 @@ class BulkCanvasCourseCreationJob(models.Model):
     status = models.CharField(max_length=25, choices=STATUS_CHOICES, default=STATUS_SETUP)
     created_at = models.DateTimeField(auto_now_add=True)
     created_by_user_id = models.CharField(max_length=20)
-    updated_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # subjob counters, kept up to date by record_subjob_state_changes (and rebuilt by rebuild_subjob_counters)
+    subjobs_total = models.IntegerField(default=0)
+    subjobs_setup = models.IntegerField(default=0)
+    subjobs_in_flight = models.IntegerField(default=0)
+    subjobs_finalized = models.IntegerField(default=0)
+    subjobs_failed = models.IntegerField(default=0)
 
     objects = BulkCanvasCourseCreationJobManager()
 
@@ -437,65 +1229,188 @@ class BulkCanvasCourseCreationJob(models.Model):
     def status_display_name(self):
         return BulkCanvasCourseCreationJob.STATUS_DISPLAY_NAMES[self.status]
 
-    def update_status(self, status, raise_exception=False):
+    def save(self, *args, **kwargs):
+        super(BulkCanvasCourseCreationJob, self).save(*args, **kwargs)
+        bump_bulk_job_progress_version([self.pk])
+
+    def is_finished(self):
+        return self.status in (BulkCanvasCourseCreationJob.STATUS_NOTIFICATION_SUCCESSFUL,
+                               BulkCanvasCourseCreationJob.STATUS_NOTIFICATION_FAILED)
+
+    @classmethod
+    def get_subjob_counter_field(cls, workflow_state):
+        return cls.SUBJOB_COUNTER_FIELDS[workflow_state]
+
+    def get_progress(self):
+        """
+        Returns the bulk job's status along with its subjob counters, so costs no queries however many subjobs the
+        bulk job has. Refresh the job (or at least its status and counter fields) first for up to date figures.
+        """
+        done = self.subjobs_finalized + self.subjobs_failed
+        return {
+            'bulk_job_id': self.id,
+            'status': self.status,
+            'status_display_name': self.status_display_name,
+            'finished': self.is_finished(),
+            'subjobs_total': self.subjobs_total,
+            'subjobs_setup': self.subjobs_setup,
+            'subjobs_in_flight': self.subjobs_in_flight,
+            'subjobs_finalized': self.subjobs_finalized,
+            'subjobs_failed': self.subjobs_failed,
+            'percent_complete': done * 100 // self.subjobs_total if self.subjobs_total else 0,
+        }
+
+    def transition_status(self, expected_status, status):
         """
-        Updates job status. Return True if update succeeded. If raise_exception param is not True, or not provided,
-         it will return False if update fails. If raise_exception is True, it will re-raise failures/exceptions.
+        Moves the job from expected_status to status with a single
+        UPDATE ... WHERE id = <pk> AND status = <expected_status>. Returns True if this call moved the job, or False
+        if the job was no longer in expected_status (e.g. another worker moved it first) or was already in status.
+        Raises InvalidWorkflowStateTransition if the transition isn't allowed (see ALLOWED_TRANSITIONS).
         """
+        if expected_status == status:
+            return False
+        if status not in BulkCanvasCourseCreationJob.ALLOWED_TRANSITIONS.get(expected_status, ()):
+            raise InvalidWorkflowStateTransition(BulkCanvasCourseCreationJob.__name__, expected_status, status)
+        now = timezone.now()
+        updated = BulkCanvasCourseCreationJob.objects.filter(pk=self.pk, status=expected_status).update(
+            status=status, updated_at=now)
+        if not updated:
+            logger.info('BulkCanvasCourseCreationJob %s was not moved to %s as it was no longer %s', self.pk, status,
+                        expected_status)
+            return False
         self.status = status
+        self.updated_at = now
+        bump_bulk_job_progress_version([self.pk])
+        return True
+
+    def update_status(self, status, raise_exception=False):
+        """
+        Moves the job from its current status to the given one (see transition_status). Returns True if the job was
+        moved, and False if another worker moved it first. If raise_exception param is not True, or not provided,
+        it will also return False if the update fails (including if the transition isn't allowed). If
+        raise_exception is True, it will re-raise failures/exceptions.
+        """
         try:
-            self.save(update_fields=['status'])
+            return self.transition_status(self.status, status)
         except Exception as e:
             if raise_exception:
                 raise e
             else:
                 return False
-        return True
+
+    def start_finalizing(self):
+        """
+        Moves a PENDING job to FINALIZING. Returns False, leaving the job alone, if it was no longer pending (e.g.
+        because another worker has already started finalizing it).
+        """
+        return self.transition_status(BulkCanvasCourseCreationJob.STATUS_PENDING,
+                                      BulkCanvasCourseCreationJob.STATUS_FINALIZING)
 
     def ready_to_finalize(self):
         """
         A bulk job is ready to finalize if it is PENDING and none of its subjobs are in an intermediate state
         (i.e. all subjobs are in a terminal state)
         """
-
-        subjob_intermediate_states = [
-            CanvasCourseGenerationJob.STATUS_QUEUED,
-            CanvasCourseGenerationJob.STATUS_RUNNING,
-            CanvasCourseGenerationJob.STATUS_SETUP,
-            CanvasCourseGenerationJob.STATUS_COMPLETED,
-            CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE
-        ]
         intermediate_subjob_count = CanvasCourseGenerationJob.objects.filter(
-            workflow_state__in=subjob_intermediate_states,
+            workflow_state__in=CanvasCourseGenerationJob.INTERMEDIATE_STATES,
             bulk_job_id=self.id).count()
 
         return self.status == BulkCanvasCourseCreationJob.STATUS_PENDING and intermediate_subjob_count == 0
 
     def get_failed_subjobs(self):
         """ Returns a list of subjobs in a known failed state """
-
-        subjob_failed_states = [
-            CanvasCourseGenerationJob.STATUS_SETUP_FAILED,
-            CanvasCourseGenerationJob.STATUS_FAILED,
-            CanvasCourseGenerationJob.STATUS_FINALIZE_FAILED
-        ]
-        subjobs = CanvasCourseGenerationJob.objects.filter(
-            workflow_state__in=subjob_failed_states,
-            bulk_job_id=self.id)
-
-        return list(subjobs)
+        return list(self._failed_subjobs())
 
     def get_failed_subjobs_count(self):
-        return len(self.get_failed_subjobs())
+        return self._failed_subjobs().count()
+
+    def _failed_subjobs(self):
+        return CanvasCourseGenerationJob.objects.filter(
+            workflow_state__in=CanvasCourseGenerationJob.FAILED_STATES,
+            bulk_job_id=self.id)
 
     def get_completed_subjobs(self):
         """ Returns a list of subjobs in a known finalized state """
-        subjobs = CanvasCourseGenerationJob.objects.filter(
+        return list(self._completed_subjobs())
+
+    def get_completed_subjobs_count(self):
+        return self._completed_subjobs().count()
+
+    def _completed_subjobs(self):
+        return CanvasCourseGenerationJob.objects.filter(
             workflow_state=CanvasCourseGenerationJob.STATUS_FINALIZED,
             bulk_job_id=self.id
         )
-        return list(subjobs)
 
-    def get_completed_subjobs_count(self):
-        return len(self.get_completed_subjobs())
 
+class EmailOutboxManager(models.Manager):
+
+    def queue(self, subject, message, from_address, to_addresses):
+        """ Adds a message to the outbox, to be sent by the next dispatch (see email_outbox.dispatch_email_outbox) """
+        return self.create(
+            subject=subject,
+            message=message,
+            from_address=from_address,
+            to_addresses=EmailOutbox.ADDRESS_SEPARATOR.join(to_addresses),
+        )
+
+    def claim_due_messages(self, claimed_by, limit, claim_seconds):
+        """
+        Claims up to `limit` pending messages which are due to be sent for the dispatcher claimed_by, and returns
+        them. A claim holds the messages back from other dispatchers for claim_seconds; if the dispatcher dies
+        the messages become due again once it runs out.
+        """
+        now = timezone.now()
+        due = Q(status=EmailOutbox.STATUS_PENDING, next_attempt_at__lte=now)
+        pks = list(self.filter(due).order_by('next_attempt_at', 'pk').values_list('pk', flat=True)[:limit])
+        if not pks:
+            return []
+        self.filter(due, pk__in=pks).update(claimed_by=claimed_by,
+                                            next_attempt_at=now + timedelta(seconds=claim_seconds))
+        return list(self.filter(pk__in=pks, claimed_by=claimed_by, status=EmailOutbox.STATUS_PENDING).order_by('pk'))
+
+
+class EmailOutbox(models.Model):
+    """
+    Email notifications waiting to be sent. Messages are queued by the course creation process and sent in batches
+    over a single mail server connection by email_outbox.dispatch_email_outbox, so that a slow mail server doesn't
+    hold up job processing. Messages which can't be sent are retried, backing off, up to a maximum number of
+    attempts.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (STATUS_PENDING, STATUS_PENDING),
+        (STATUS_SENT, STATUS_SENT),
+        (STATUS_FAILED, STATUS_FAILED),
+    )
+
+    ADDRESS_SEPARATOR = ','
+
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    from_address = models.CharField(max_length=254)
+    to_addresses = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    claimed_by = models.CharField(max_length=100, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    objects = EmailOutboxManager()
+
+    class Meta:
+        db_table = 'canvas_wizard_email_outbox'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='cw_email_outbox_due_idx'),
+        ]
+
+    def __unicode__(self):
+        return "(EmailOutbox ID=%s: status=%s, subject=%s)" % (self.pk, self.status, self.subject)
+
+    def get_to_addresses(self):
+        return [address for address in self.to_addresses.split(self.ADDRESS_SEPARATOR) if address]
@@ -1,10 +1,16 @@
 import logging
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+
 from .models import (
     SISCourseData,
     CanvasCourseGenerationJob,
     CanvasSchoolTemplate,
-    BulkCanvasCourseCreationJob
+    BulkCanvasCourseCreationJob,
+    get_eligible_course_instances,
+    iter_course_instance_id_chunks
 )
 
 from .exceptions import (
@@ -17,6 +23,9 @@ from icommons_common.models import CourseInstance
 
 logger = logging.getLogger(__name__)
 
+# Default number of seconds the course counts for a term are cached for (see get_term_course_counts)
+TERM_COURSE_COUNTS_CACHE_TIMEOUT = 60
+
 
 def get_course_data(course_sis_id):
     """
@@ -25,7 +34,23 @@ def get_course_data(course_sis_id):
     if the id does not map to an instance or a MultipleObjectsReturned
     exception if multiple instances match the input id.
     """
-    return SISCourseData.objects.select_related('course').get(pk=course_sis_id)
+    return SISCourseData.objects.select_related('course', 'term').get(pk=course_sis_id)
+
+
+def get_course_data_for_sis_course_ids(course_sis_ids, chunk_size=1000):
+    """
+    Bulk version of get_course_data: loads the SISCourseData instances (along with their course and term) for
+    all of the given course sis ids, chunk_size ids per query (Oracle allows at most 1000 items in an IN list).
+    Returns a dict mapping each id (as a string, like CanvasCourseGenerationJob.sis_course_id) to its
+    SISCourseData instance; ids which don't map to an instance are left out.
+    """
+    course_sis_ids = list({str(course_sis_id) for course_sis_id in course_sis_ids})
+    course_data = {}
+    for i in range(0, len(course_sis_ids), chunk_size):
+        chunk = course_sis_ids[i:i + chunk_size]
+        for sis_course_data in SISCourseData.objects.select_related('course', 'term').filter(pk__in=chunk):
+            course_data[str(sis_course_data.pk)] = sis_course_data
+    return course_data
 
 
 def get_course_generation_data_for_canvas_course_id(canvas_course_id):
@@ -132,6 +157,40 @@ def get_courses_for_term(term_id, is_in_canvas=None, is_in_isite=None, not_creat
     return CourseInstance.objects.filter(**kwargs).count()
 
 
+def get_term_course_counts(term_id):
+    """
+    Get all of the course counts shown for a term on the bulk create page with a single query: the same counts as
+    get_courses_for_term gives for each of its options. Each course is counted once, however many sites it has. The
+    counts are cached for TERM_COURSE_COUNTS_CACHE_TIMEOUT seconds; use invalidate_term_course_counts() to drop
+    them sooner.
+    :param term_id: the term_id of the term
+    :return: dict with the total_courses, canvas_courses, isites_courses and not_created counts
+    """
+    cache_key = _term_course_counts_cache_key(term_id)
+    counts = cache.get(cache_key)
+    if counts is None:
+        counts = CourseInstance.objects.filter(term__term_id=term_id).aggregate(
+            total_courses=Count('course_instance_id', distinct=True),
+            canvas_courses=Count('course_instance_id', distinct=True, filter=Q(sync_to_canvas=True)),
+            isites_courses=Count('course_instance_id', distinct=True, filter=Q(sites__site_type_id='isite')),
+            not_created=Count('course_instance_id', distinct=True, filter=Q(sites__external_id__isnull=True)),
+        )
+        cache.set(cache_key, counts, getattr(settings, 'TERM_COURSE_COUNTS_CACHE_TIMEOUT',
+                                             TERM_COURSE_COUNTS_CACHE_TIMEOUT))
+    return counts
+
+
+def invalidate_term_course_counts(term_id):
+    """
+    Drops the cached course counts for the term (see get_term_course_counts)
+    """
+    cache.delete(_term_course_counts_cache_key(term_id))
+
+
+def _term_course_counts_cache_key(term_id):
+    return 'canvas_course_site_wizard:term_course_counts:%s' % term_id
+
+
 def get_bulk_job_records_for_term(term_id, in_progress=None):
     """
     Get the bulk job records from the BulkCanvasCourseCreationJob table for the sis_term_id.
@@ -147,25 +206,19 @@ def get_bulk_job_records_for_term(term_id, in_progress=None):
 
     return BulkCanvasCourseCreationJob.objects.filter(**kwargs)
 
-def select_courses_for_bulk_create(term_id):
+def select_courses_for_bulk_create(term_id, school_id=None):
     """
-    Given a term id, select all course instance id's that are eligible to have a Canvas
-    course created. The statement below selects courses where:
-        term_id = term_is
-        external_id = Null
-        site_type_id != 'isite'
+    Given a term id, yield all course instance id's that are eligible to have a Canvas
+    course created (see models.get_eligible_course_instances): courses in the term (and school, if given)
+    which are not already in Canvas and have neither an iSite nor an external site.
+    The ids are read a chunk at a time (see models.iter_course_instance_id_chunks), so any number of courses can be
+    worked through without loading them all into memory.
 
     :param term_id:
-    :return: List of course instance id's
+    :param school_id: (optional) only select courses in this school
+    :return: Generator of course instance id's
     """
-    select_query = {
-        'term_id': term_id,
-        'sites__external_id__isnull': True,
-        }
-
-    exclude_query = {
-        'sites__site_type_id': 'isite',
-        }
-
-    return CourseInstance.objects.filter(**select_query)\
-        .exclude(**exclude_query).values_list('course_instance_id', flat=True)
+    queryset = get_eligible_course_instances(term_id, school_id=school_id)
+    for chunk in iter_course_instance_id_chunks(queryset):
+        for course_instance_id in chunk:
+            yield course_instance_id
@@ -0,0 +1,160 @@
+"""
+Creates Canvas courses, and their primary sections, for a batch of SIS courses with a single Canvas SIS import
+rather than separate create course and create section API calls for each course.
+"""
+import csv
+import io
+import logging
+import time
+import zipfile
+from urllib.parse import urlencode
+
+from canvas_sdk import client
+from django.conf import settings
+
+from .exceptions import CanvasSISImportError
+from .throttling import ThrottledRequestContext
+
+SDK_CONTEXT = ThrottledRequestContext(**settings.CANVAS_SDK_SETTINGS)
+logger = logging.getLogger(__name__)
+
+# Default number of seconds between checks on the progress of an SIS import, and before giving up on it
+SIS_IMPORT_POLL_INTERVAL = 10
+SIS_IMPORT_TIMEOUT = 60 * 60
+
+# SIS import workflow states; the import is finished once it is in one of the SUCCESS or FAILURE states
+SIS_IMPORT_SUCCESS_STATES = ('imported', 'imported_with_messages')
+SIS_IMPORT_FAILURE_STATES = ('failed', 'failed_with_messages', 'aborted')
+
+COURSES_CSV_HEADER = ('course_id', 'short_name', 'long_name', 'account_id', 'term_id', 'status')
+SECTIONS_CSV_HEADER = ('section_id', 'course_id', 'name', 'status')
+
+
+def create_canvas_courses_with_sis_import(course_data_list, on_poll=None):
+    """
+    Creates a Canvas course, with its primary section, for each of the given SISCourseData objects in one SIS
+    import, waits for the import to finish and then looks up the ids of the new Canvas courses.
+        :param course_data_list: the SISCourseData of the courses to create; their Canvas accounts must exist
+        :param on_poll: optional callable, called with no arguments each time the import's progress is checked
+                        while waiting for it (see wait_for_sis_import)
+        :return: dict mapping the sis_course_id (as a string) of each course created to its Canvas course id.
+                 Courses which Canvas failed to create are left out.
+        :raises: CanvasSISImportError if the import could not be submitted or did not finish successfully
+    """
+    if not course_data_list:
+        return {}
+
+    sis_import = submit_sis_import(build_sis_import_zip(course_data_list))
+    sis_import = wait_for_sis_import(sis_import['id'], on_poll=on_poll)
+    for message in sis_import.get('processing_warnings') or []:
+        logger.warning('SIS import %s: %s', sis_import['id'], message)
+    for message in sis_import.get('processing_errors') or []:
+        logger.error('SIS import %s: %s', sis_import['id'], message)
+
+    canvas_course_ids = {}
+    sis_course_ids_by_term = {}
+    for course_data in course_data_list:
+        sis_course_ids_by_term.setdefault(course_data.sis_term_id, set()).add(str(course_data.pk))
+    for sis_term_id, sis_course_ids in sis_course_ids_by_term.items():
+        canvas_course_ids.update(get_canvas_course_ids_for_term(sis_term_id, sis_course_ids))
+    return canvas_course_ids
+
+
+def build_sis_import_zip(course_data_list):
+    """
+    Returns the bytes of a zip file holding the courses.csv and sections.csv describing the given courses in
+    Canvas' SIS import format. Each course gets a single section, with the same SIS id as the course, as it would
+    from create_canvas_course.
+    """
+    courses_csv = io.StringIO()
+    sections_csv = io.StringIO()
+    courses_writer = csv.writer(courses_csv)
+    sections_writer = csv.writer(sections_csv)
+    courses_writer.writerow(COURSES_CSV_HEADER)
+    sections_writer.writerow(SECTIONS_CSV_HEADER)
+    for course_data in course_data_list:
+        sis_course_id = str(course_data.pk)
+        courses_writer.writerow((sis_course_id, course_data.course_code, course_data.course_name,
+                                 course_data.sis_account_id, course_data.sis_term_id, 'active'))
+        sections_writer.writerow((sis_course_id, sis_course_id, course_data.primary_section_name(), 'active'))
+
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('courses.csv', courses_csv.getvalue())
+        zip_file.writestr('sections.csv', sections_csv.getvalue())
+    return zip_buffer.getvalue()
+
+
+def submit_sis_import(zip_data):
+    """
+    Uploads the zip file of SIS import CSVs to Canvas and returns the new SIS import
+        :raises: CanvasSISImportError if Canvas did not accept the import
+    """
+    try:
+        sis_import = client.post(
+            SDK_CONTEXT,
+            _sis_imports_url(),
+            payload={'import_type': 'instructure_csv', 'extension': 'zip'},
+            files={'attachment': ('courses.zip', zip_data, 'application/zip')},
+        ).json()
+    except Exception as e:
+        raise CanvasSISImportError('SIS import could not be submitted: %s' % e)
+    logger.info('Submitted SIS import %s', sis_import['id'])
+    return sis_import
+
+
+def wait_for_sis_import(sis_import_id, poll_interval=None, timeout=None, on_poll=None):
+    """
+    Polls the SIS import's progress until it has finished, and returns it. on_poll, if given, is called each time
+    the progress is checked, so that the caller can keep up anything which has to outlast the wait (e.g. the leases
+    on the jobs whose courses are being imported).
+        :raises: CanvasSISImportError if the import failed, or had not finished after `timeout` seconds
+    """
+    if poll_interval is None:
+        poll_interval = getattr(settings, 'SIS_IMPORT_POLL_INTERVAL', SIS_IMPORT_POLL_INTERVAL)
+    if timeout is None:
+        timeout = getattr(settings, 'SIS_IMPORT_TIMEOUT', SIS_IMPORT_TIMEOUT)
+
+    deadline = time.monotonic() + timeout
+    while True:
+        if on_poll is not None:
+            on_poll()
+        sis_import = client.get(SDK_CONTEXT, '%s/%s' % (_sis_imports_url(), sis_import_id)).json()
+        workflow_state = sis_import['workflow_state']
+        logger.debug('SIS import %s is %s (%s%%)', sis_import_id, workflow_state, sis_import.get('progress'))
+        if workflow_state in SIS_IMPORT_SUCCESS_STATES:
+            return sis_import
+        if workflow_state in SIS_IMPORT_FAILURE_STATES:
+            raise CanvasSISImportError('SIS import %s %s: %s' % (sis_import_id, workflow_state,
+                                                                 sis_import.get('processing_errors')))
+        if time.monotonic() >= deadline:
+            raise CanvasSISImportError('SIS import %s did not finish within %s seconds' % (sis_import_id, timeout))
+        time.sleep(poll_interval)
+
+
+def get_canvas_course_ids_for_term(sis_term_id, sis_course_ids):
+    """
+    Looks up the Canvas course ids of the given courses by listing the courses in the term, a page (of up to 100
+    courses) at a time, rather than fetching each course separately
+        :return: dict mapping the sis_course_ids found to their Canvas course ids
+    """
+    canvas_course_ids = {}
+    url = '%s/v1/accounts/%s/courses?%s' % (SDK_CONTEXT.base_api_url, _get_sis_import_account_id(),
+                                            urlencode({'enrollment_term_id': 'sis_term_id:%s' % sis_term_id,
+                                                       'per_page': 100}))
+    while url and len(canvas_course_ids) < len(sis_course_ids):
+        response = client.get(SDK_CONTEXT, url)
+        for course in response.json():
+            if course.get('sis_course_id') in sis_course_ids:
+                canvas_course_ids[course['sis_course_id']] = course['id']
+        url = response.links.get('next', {}).get('url')
+    return canvas_course_ids
+
+
+def _sis_imports_url():
+    return '%s/v1/accounts/%s/sis_imports' % (SDK_CONTEXT.base_api_url, _get_sis_import_account_id())
+
+
+def _get_sis_import_account_id():
+    """ SIS imports are made to the root account ('self' unless configured otherwise) """
+    return getattr(settings, 'BULK_COURSE_CREATION', {}).get('sis_import_account_id', 'self')
@@ -17,9 +17,9 @@ def create_jobs(school_id, sis_term_id, sis_department_id=None, sis_course_group
             status=status,
             created_by_user_id="10564158"
         )
-        for (workflow_state, _) in CanvasCourseGenerationJob.WORKFLOW_STATUS_CHOICES:
+        for index, (workflow_state, _) in enumerate(CanvasCourseGenerationJob.WORKFLOW_STATUS_CHOICES):
             CanvasCourseGenerationJob.objects.create(
-                sis_course_id=1111,
+                sis_course_id=1111 + index,
                 workflow_state=workflow_state,
                 created_by_user_id="10564158",
                 bulk_job_id=bulk_job.id
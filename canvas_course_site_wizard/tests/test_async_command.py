@@ -5,6 +5,8 @@ from canvas_course_site_wizard.management.commands import process_async_jobs
 from canvas_course_site_wizard.exceptions import (CanvasCourseAlreadyExistsError, CopySISEnrollmentsError,
                                                   MarkOfficialError)
 from django.test.utils import override_settings
+import os
+import signal
 
 
 def start_job_with_noargs():
@@ -32,7 +34,8 @@ def mock_user_profile(profile_mock, return_value='a@a.com'):
     logger=DEFAULT,
     update_syllabus_body=DEFAULT,
     finalize_new_canvas_course=DEFAULT,
-    send_email_helper=DEFAULT,
+    queue_email=DEFAULT,
+    dispatch_email_outbox=DEFAULT,
     get_canvas_user_profile=DEFAULT,
     client=DEFAULT,
     tech_logger=DEFAULT
@@ -67,6 +70,7 @@ class CommandsTestCase(TestCase):
     m_canvas_content_migration_job_with_bulk_id = Mock(
         spec=CanvasCourseGenerationJob,
         id=2,
+        pk=2,
         bulk_job_id=2,
         canvas_course_id=12345,
         sis_course_id=6789,
@@ -95,9 +99,9 @@ class CommandsTestCase(TestCase):
         client.get.assert_called_with(ANY, self.status_url)
 
     def test_process_async_jobs_invokes_correct_methods_on_completed_status(self, client, get_canvas_user_profile,
-            send_email_helper, **kwargs):
+            queue_email, **kwargs):
         """
-        test that the send_email_helper and get_canvas_user_profile helper method are called
+        test that the queue_email and get_canvas_user_profile helper method are called
         with the right params when the workflow_state of the job changes to 'completed'
         """
 
@@ -106,13 +110,13 @@ class CommandsTestCase(TestCase):
 
         start_job_with_noargs()
         get_canvas_user_profile.assert_called_with(self.created_by_user_id)
-        send_email_helper.assert_called_once_with(ANY, ANY, ANY)
+        queue_email.assert_called_once_with(ANY, ANY, ANY)
 
     @patch('canvas_course_site_wizard.management.commands.process_async_jobs.CanvasCourseGenerationJob.objects.filter')
     def test_process_async_jobs_doesnt_send_email_for_bulk_created_course(self, filter_mock, client,
-                                                                          send_email_helper, **kwargs):
+                                                                          queue_email, **kwargs):
         """
-        test that the send_email_helper is not called for a bulk created course,
+        test that the queue_email is not called for a bulk created course,
         irrespective of the workflow_state
         """
         mock_client_json(client, 'this can be anything')
@@ -121,12 +125,12 @@ class CommandsTestCase(TestCase):
         iterable_ccmjob_mock.__iter__ = Mock(return_value=iter([self.m_canvas_content_migration_job_with_bulk_id]))
 
         start_job_with_noargs()
-        self.assertFalse(send_email_helper.called)
+        self.assertFalse(queue_email.called)
 
     @patch('canvas_course_site_wizard.management.commands.process_async_jobs.logger.info')
     @patch('canvas_course_site_wizard.management.commands.process_async_jobs.CanvasCourseGenerationJob.objects.filter')
     def test_process_async_jobs_on_failure_for_bulk_course_calls_tech_logger(self, mock_logger, filter_mock, client,
-                                                                             get_canvas_user_profile, send_email_helper,
+                                                                             get_canvas_user_profile, queue_email,
                                                                              tech_logger, **kwargs):
         """
         test that the tech_logger is called even for bulk jobs when there is a failure.
@@ -192,7 +196,7 @@ class CommandsTestCase(TestCase):
         tech_logger.exception.assert_called_with('%s (HUID:%s)' % (e.display_text, self.created_by_user_id))
 
     def test_process_async_jobs_sends_failure_email_when_any_exception_occurs(self, client, get_canvas_user_profile,
-            send_email_helper, finalize_new_canvas_course, logger, send_failure_email, **kwargs):
+            queue_email, finalize_new_canvas_course, logger, send_failure_email, **kwargs):
         """ test that the sync jobs send a failure email notification on an exception during job processing """
 
         client.get.side_effect = Exception
@@ -201,24 +205,24 @@ class CommandsTestCase(TestCase):
         start_job_with_noargs()
         send_failure_email.assert_called_with(ANY, ANY)
 
-    def test_process_async_jobs_logs_exception_thrown_by_send_email_helper(self, client, get_canvas_user_profile,
-            send_email_helper, finalize_new_canvas_course, logger, **kwargs):
-        """ Test that an exception is raised when send_email_helper method throws an exception """
+    def test_process_async_jobs_logs_exception_thrown_by_queue_email(self, client, get_canvas_user_profile,
+            queue_email, finalize_new_canvas_course, logger, **kwargs):
+        """ Test that an exception is raised when queue_email method throws an exception """
 
         mock_client_json(client, 'completed')
         mock_user_profile(get_canvas_user_profile)
-        send_email_helper.side_effect = Exception
+        queue_email.side_effect = Exception
 
         start_job_with_noargs()
         self.assertTrue(logger.exception.called)
 
-    def test_tech_logger_on_exception_thrown_by_send_email_helper(self, client, get_canvas_user_profile,
-              send_email_helper, finalize_new_canvas_course, logger, tech_logger, **kwargs):
-        """ Test that tech_logger is called when send_email_helper method throws an exception """
+    def test_tech_logger_on_exception_thrown_by_queue_email(self, client, get_canvas_user_profile,
+              queue_email, finalize_new_canvas_course, logger, tech_logger, **kwargs):
+        """ Test that tech_logger is called when queue_email method throws an exception """
 
         mock_client_json(client, 'completed')
         mock_user_profile(get_canvas_user_profile)
-        send_email_helper.side_effect = Exception
+        queue_email.side_effect = Exception
 
         start_job_with_noargs()
         self.assertEqual(tech_logger.exception.call_count, 1)
@@ -241,7 +245,7 @@ class CommandsTestCase(TestCase):
         self.assertEqual(get_canvas_user_profile.call_count, 1)
 
     def test_job_workflow_state_saved_when_status_complete_and_finalize_throws_exception(self, client,
-            get_canvas_user_profile, send_email_helper, finalize_new_canvas_course, **kwargs):
+            get_canvas_user_profile, queue_email, finalize_new_canvas_course, **kwargs):
         """
         Test that the  CanvasCourseGenerationJob's  workflow state is updated to STATUS_FINALIZE_FAILED
         when there is an exception in finalizing
@@ -254,7 +258,7 @@ class CommandsTestCase(TestCase):
         self.assertEqual(cm.workflow_state, CanvasCourseGenerationJob.STATUS_FINALIZE_FAILED)
 
     def test_job_workflow_state_saved_when_status_failed_and_finalize_throws_exception(self, client,
-            get_canvas_user_profile, send_email_helper, finalize_new_canvas_course, **kwargs):
+            get_canvas_user_profile, queue_email, finalize_new_canvas_course, **kwargs):
         """
         Test that the CanvasCourseGenerationJob's  workflow state is updated to failure
         regardless of whether finalizing throws an exception
@@ -267,7 +271,7 @@ class CommandsTestCase(TestCase):
         self.assertEqual(cm.workflow_state, CanvasCourseGenerationJob.STATUS_FAILED)
 
     def test_job_workflow_state_saved_after_finalize_success(self, client,
-            get_canvas_user_profile, send_email_helper, finalize_new_canvas_course, **kwargs):
+            get_canvas_user_profile, queue_email, finalize_new_canvas_course, **kwargs):
         """
         Test that the  CanvasCourseGenerationJob's  state is updated from 'complete' to
          CanvasCourseGenerationJob.STATUS_FINALIZED after finalize is  successful
@@ -280,7 +284,7 @@ class CommandsTestCase(TestCase):
 
 
     def test_job_workflow_state_saved_when_finalize_fails_during_sync_to_canvas(self, client,
-            get_canvas_user_profile, send_email_helper, finalize_new_canvas_course, **kwargs):
+            get_canvas_user_profile, queue_email, finalize_new_canvas_course, **kwargs):
         """
         Test that the  CanvasCourseGenerationJob's workflow state is updated from
         CanvasCourseGenerationJob.STATUS_COMPLETED to CanvasCourseGenerationJob.STATUS_FINALIZE_FAILED
@@ -293,7 +297,7 @@ class CommandsTestCase(TestCase):
         self.assertEqual(cm.workflow_state, CanvasCourseGenerationJob.STATUS_FINALIZE_FAILED)
 
     def test_job_workflow_state_saved_when_finalize_fails_due_to_mark_official(self, client,
-            get_canvas_user_profile, send_email_helper, finalize_new_canvas_course, **kwargs):
+            get_canvas_user_profile, queue_email, finalize_new_canvas_course, **kwargs):
         """
         Test that the  CanvasCourseGenerationJob's workflow state is updated from CanvasCourseGenerationJob.STATUS_COMPLETED to
          CanvasCourseGenerationJob.STATUS_FINALIZE_FAILED when finalize fails due to
@@ -305,3 +309,189 @@ class CommandsTestCase(TestCase):
         cm = CanvasCourseGenerationJob.objects.get(pk=self.migration.pk)
         self.assertEqual(cm.workflow_state, CanvasCourseGenerationJob.STATUS_FINALIZE_FAILED)
 
+
+    @override_settings(PROCESS_ASYNC_JOBS_MAX_CONCURRENT_POLLS=4)
+    def test_concurrent_poller_saves_failed_state(self, client, get_canvas_user_profile, **kwargs):
+        """
+        Test that when polling concurrently the workflow state reported by Canvas is saved back to the job
+        """
+        mock_client_json(client, CanvasCourseGenerationJob.STATUS_FAILED)
+        mock_user_profile(get_canvas_user_profile)
+
+        start_job_with_noargs()
+        client.get.assert_called_with(ANY, self.status_url)
+        cm = CanvasCourseGenerationJob.objects.get(pk=self.migration.pk)
+        self.assertEqual(cm.workflow_state, CanvasCourseGenerationJob.STATUS_FAILED)
+
+    @override_settings(PROCESS_ASYNC_JOBS_MAX_CONCURRENT_POLLS=4, PROCESS_ASYNC_JOBS_POLL_BATCH_SIZE=2)
+    def test_concurrent_poller_finalizes_completed_jobs(self, client, get_canvas_user_profile,
+            finalize_new_canvas_course, **kwargs):
+        """
+        Test that jobs whose migrations were reported complete by the concurrent poller are finalized, across
+        multiple batches
+        """
+        other_migrations = [self.create_migration_job_from_setup() for _ in range(2)]
+        mock_client_json(client, CanvasCourseGenerationJob.STATUS_COMPLETED)
+        mock_user_profile(get_canvas_user_profile)
+
+        start_job_with_noargs()
+        self.assertEqual(client.get.call_count, 3)
+        self.assertEqual(finalize_new_canvas_course.call_count, 3)
+        for migration in [self.migration] + other_migrations:
+            cm = CanvasCourseGenerationJob.objects.get(pk=migration.pk)
+            self.assertEqual(cm.workflow_state, CanvasCourseGenerationJob.STATUS_FINALIZED)
+
+    @override_settings(PROCESS_ASYNC_JOBS_MAX_CONCURRENT_POLLS=4)
+    def test_concurrent_poller_handles_failed_progress_check(self, client, get_canvas_user_profile,
+            send_failure_email, tech_logger, **kwargs):
+        """
+        Test that an error checking a job's progress in the concurrent poller is handled like any other error
+        processing the job
+        """
+        client.get.side_effect = Exception
+        mock_user_profile(get_canvas_user_profile)
+
+        start_job_with_noargs()
+        self.assertEqual(tech_logger.exception.call_count, 1)
+        send_failure_email.assert_called_with(ANY, ANY)
+
+    @override_settings(PROCESS_ASYNC_JOBS_MAX_CONCURRENT_POLLS=4)
+    def test_concurrent_poller_stops_starting_jobs_when_asked(self, client, get_canvas_user_profile,
+            finalize_new_canvas_course, **kwargs):
+        """
+        Test that when polling concurrently no more jobs in the batch are processed once should_stop returns True,
+        and that the jobs left are kept in their polled state for the next run
+        """
+        other_migration = self.create_migration_job_from_setup()
+        mock_client_json(client, CanvasCourseGenerationJob.STATUS_COMPLETED)
+        mock_user_profile(get_canvas_user_profile)
+        # don't stop before the batch or its first job, then stop
+        checks = iter([False, False])
+
+        process_async_jobs._process_jobs(should_stop=lambda: next(checks, True))
+        self.assertEqual(client.get.call_count, 2)
+        self.assertEqual(finalize_new_canvas_course.call_count, 1)
+        states = sorted(CanvasCourseGenerationJob.objects.filter(
+            pk__in=[self.migration.pk, other_migration.pk]).values_list('workflow_state', flat=True))
+        self.assertEqual(states, sorted([CanvasCourseGenerationJob.STATUS_COMPLETED,
+                                         CanvasCourseGenerationJob.STATUS_FINALIZED]))
+
+    def test_process_jobs_stops_starting_jobs_when_asked(self, client, **kwargs):
+        """ Test that no more jobs are started once should_stop returns True """
+        process_async_jobs._process_jobs(should_stop=lambda: True)
+        self.assertFalse(client.get.called)
+        cm = CanvasCourseGenerationJob.objects.get(pk=self.migration.pk)
+        self.assertEqual(cm.workflow_state, self.workflow_state)
+
+    @patch('canvas_course_site_wizard.management.commands.process_async_jobs.close_old_connections')
+    @patch('canvas_course_site_wizard.management.commands.process_async_jobs._process_jobs')
+    def test_daemon_runs_until_sigterm(self, m_process_jobs, m_close_old_connections, **kwargs):
+        """
+        Test that in daemon mode the jobs are processed on every tick until SIGTERM is received, after which the
+        in-flight run is finished and the previous signal handler restored
+        """
+        def process_jobs(should_stop):
+            if m_process_jobs.call_count == 2:
+                os.kill(os.getpid(), signal.SIGTERM)
+                self.assertTrue(should_stop())
+        m_process_jobs.side_effect = process_jobs
+        previous_handler = signal.getsignal(signal.SIGTERM)
+
+        process_async_jobs.Command().handle(daemon=True, tick=0)
+        self.assertEqual(m_process_jobs.call_count, 2)
+        self.assertTrue(m_close_old_connections.called)
+        self.assertEqual(signal.getsignal(signal.SIGTERM), previous_handler)
+
+    @patch('canvas_course_site_wizard.management.commands.process_async_jobs._process_jobs')
+    def test_daemon_keeps_running_after_error(self, m_process_jobs, logger, **kwargs):
+        """ Test that an unexpected error in one run is logged and doesn't stop the daemon """
+        def process_jobs(should_stop):
+            if m_process_jobs.call_count == 1:
+                raise Exception
+            os.kill(os.getpid(), signal.SIGTERM)
+        m_process_jobs.side_effect = process_jobs
+
+        process_async_jobs.Command().handle(daemon=True, tick=0)
+        self.assertEqual(m_process_jobs.call_count, 2)
+        self.assertTrue(logger.exception.called)
+
+    @override_settings(CANVAS_COURSE_GENERATION_JOB_LEASING=True, PROCESS_ASYNC_JOBS_POLL_BATCH_SIZE=1)
+    def test_leased_jobs_are_processed_and_released(self, client, get_canvas_user_profile, **kwargs):
+        """
+        Test that with job leasing enabled the jobs are claimed a batch at a time, processed, and their leases
+        released afterwards
+        """
+        other_migration = self.create_migration_job_from_setup()
+        mock_client_json(client, CanvasCourseGenerationJob.STATUS_COMPLETED)
+        mock_user_profile(get_canvas_user_profile)
+
+        start_job_with_noargs()
+        self.assertEqual(client.get.call_count, 2)
+        for migration in (self.migration, other_migration):
+            cm = CanvasCourseGenerationJob.objects.get(pk=migration.pk)
+            self.assertEqual(cm.workflow_state, CanvasCourseGenerationJob.STATUS_FINALIZED)
+            self.assertIsNone(cm.lease_owner)
+
+    def test_racing_workers_finalize_and_notify_once(self, client, get_canvas_user_profile,
+            finalize_new_canvas_course, queue_email, **kwargs):
+        """
+        Test that when two workers process the same job, the one which moves the job on first finalizes it and
+        emails the initiator, and the other leaves the job alone
+        """
+        mock_client_json(client, CanvasCourseGenerationJob.STATUS_COMPLETED)
+        mock_user_profile(get_canvas_user_profile)
+        worker_a_job = CanvasCourseGenerationJob.objects.get(pk=self.migration.pk)
+        worker_b_job = CanvasCourseGenerationJob.objects.get(pk=self.migration.pk)
+
+        # worker b checks the job while worker a is finalizing it
+        finalize_new_canvas_course.side_effect = lambda *args: process_async_jobs._process_job(worker_b_job)
+        process_async_jobs._process_job(worker_a_job)
+
+        self.assertEqual(finalize_new_canvas_course.call_count, 1)
+        queue_email.assert_called_once_with(ANY, ANY, ANY)
+        cm = CanvasCourseGenerationJob.objects.get(pk=self.migration.pk)
+        self.assertEqual(cm.workflow_state, CanvasCourseGenerationJob.STATUS_FINALIZED)
+
+    def test_racing_pollers_finalize_and_notify_once(self, client, get_canvas_user_profile,
+            finalize_new_canvas_course, queue_email, **kwargs):
+        """
+        Test that of two workers saving the same polled progress for a job, only the one whose update moved the job
+        goes on to finalize it
+        """
+        mock_user_profile(get_canvas_user_profile)
+        worker_a_job = CanvasCourseGenerationJob.objects.get(pk=self.migration.pk)
+        worker_b_job = CanvasCourseGenerationJob.objects.get(pk=self.migration.pk)
+        progress = {self.migration.pk: CanvasCourseGenerationJob.STATUS_COMPLETED}
+
+        self.assertEqual(process_async_jobs._save_polled_workflow_states([worker_a_job], progress),
+                         {self.migration.pk})
+        self.assertEqual(process_async_jobs._save_polled_workflow_states([worker_b_job], progress), set())
+        process_async_jobs._process_job(worker_a_job, progress[self.migration.pk])
+
+        self.assertEqual(finalize_new_canvas_course.call_count, 1)
+        queue_email.assert_called_once_with(ANY, ANY, ANY)
+
+    @override_settings(PROCESS_ASYNC_JOBS_MAX_CONCURRENT_POLLS=4)
+    @patch('canvas_course_site_wizard.management.commands.process_async_jobs._save_polled_workflow_states')
+    def test_concurrent_poller_skips_jobs_moved_by_another_worker(self, m_save_polled_workflow_states, client,
+            finalize_new_canvas_course, queue_email, **kwargs):
+        """ Test that jobs whose polled progress another worker saved first aren't processed """
+        mock_client_json(client, CanvasCourseGenerationJob.STATUS_COMPLETED)
+        m_save_polled_workflow_states.return_value = set()
+
+        start_job_with_noargs()
+        self.assertFalse(finalize_new_canvas_course.called)
+        self.assertFalse(queue_email.called)
+
+    def test_job_taken_over_by_another_worker_is_not_finalized(self, client, get_canvas_user_profile,
+            finalize_new_canvas_course, queue_email, **kwargs):
+        """ Test that a worker whose lease on a job has been taken over leaves the job to the lease's new holder """
+        mock_client_json(client, CanvasCourseGenerationJob.STATUS_COMPLETED)
+        CanvasCourseGenerationJob.objects.claim_jobs('host1:1', 1, lease_seconds=-1)
+        job, = CanvasCourseGenerationJob.objects.claim_jobs('host2:1', 1)
+
+        process_async_jobs._process_job(job, lease_owner='host1:1')
+        self.assertFalse(finalize_new_canvas_course.called)
+        self.assertFalse(queue_email.called)
+        cm = CanvasCourseGenerationJob.objects.get(pk=self.migration.pk)
+        self.assertEqual(cm.workflow_state, self.workflow_state)
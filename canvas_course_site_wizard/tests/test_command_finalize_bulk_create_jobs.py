@@ -37,7 +37,7 @@ class FinalizeBulkCanvasCourseCreationJobsCommandTests(TestCase):
     """
 
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.logger')
-    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.BulkJob.objects.get_jobs_by_status')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.BulkJob.objects.get_jobs_ready_to_finalize')
     def test_finalize_bulk_create_jobs_no_pending_jobs(self, m_queryset, m_logger, **kwargs):
         """ exit gracefully if there are no jobs in the table that require checking pending subjobs """
         m_queryset.return_value = BulkJob.objects.none()
@@ -47,18 +47,17 @@ class FinalizeBulkCanvasCourseCreationJobsCommandTests(TestCase):
         self.assertEqual(m_logger.exception.call_count, 0)
 
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.logger')
-    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.BulkJob.objects.get_jobs_by_status')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.BulkJob.objects.get_jobs_ready_to_finalize')
     def test_finalize_bulk_create_jobs_pending_jobs_leave_pending(self, m_queryset, m_logger, **kwargs):
         """ exit gracefully if the pending jobs still have pending subjobs (so bulk jobs should not be finalized) """
-        m_bulk_job = get_mock_bulk_job()
-        m_bulk_job.ready_to_finalize.return_value = False
-        m_queryset.return_value = [m_bulk_job]
+        m_queryset.return_value = []
         start_job_with_noargs()
+        m_queryset.assert_called_once_with()
         self.assertEqual(m_logger.error.call_count, 0)
         self.assertEqual(m_logger.exception.call_count, 0)
 
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs._send_notification')
-    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.BulkJob.objects.get_jobs_by_status')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.BulkJob.objects.get_jobs_ready_to_finalize')
     def test_finalize_bulk_create_jobs_finalize_pending_jobs(self, m_queryset, m_send, **kwargs):
         """ if the pending jobs have no pending subjobs (ie they are all in terminal state) then finalize bulk jobs """
         m_bulk_job = get_mock_bulk_job()
@@ -71,7 +70,7 @@ class FinalizeBulkCanvasCourseCreationJobsCommandTests(TestCase):
 
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.logger.exception')
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs._send_notification')
-    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.BulkJob.objects.get_jobs_by_status')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.BulkJob.objects.get_jobs_ready_to_finalize')
     def test_finalize_bulk_create_jobs_save_fails_before_notification(self, m_queryset, m_send, m_logger, **kwargs):
         """ if we fail updating the job status before the send step, failure is logged and no notification is sent """
         m_bulk_job = get_mock_bulk_job()
@@ -85,7 +84,7 @@ class FinalizeBulkCanvasCourseCreationJobsCommandTests(TestCase):
 
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.logger.exception')
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs._send_notification')
-    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.BulkJob.objects.get_jobs_by_status')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.BulkJob.objects.get_jobs_ready_to_finalize')
     def test_finalize_bulk_create_jobs_save_fails_after_notification(self, m_queryset, m_send, m_logger, **kwargs):
         """ if we fail updating the job status after the notification is sent failure is still logged """
         m_bulk_job = get_mock_bulk_job()
@@ -98,7 +97,7 @@ class FinalizeBulkCanvasCourseCreationJobsCommandTests(TestCase):
         self.assertEqual(m_send.call_count, 1)
 
 
-    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.send_email_helper')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.queue_email')
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs._format_notification_email_body')
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs._format_notification_email_subject')
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_canvas_user_profile')
@@ -111,7 +110,7 @@ class FinalizeBulkCanvasCourseCreationJobsCommandTests(TestCase):
         self.assertTrue(_send_notification(m_bulk_job))
         m_body.assert_called_once_with(ANY, ANY, 1, 0)
 
-    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.send_email_helper')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.queue_email')
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs._format_notification_email_body')
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs._format_notification_email_subject')
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_canvas_user_profile')
@@ -124,6 +123,20 @@ class FinalizeBulkCanvasCourseCreationJobsCommandTests(TestCase):
         self.assertTrue(_send_notification(m_bulk_job))
         m_body.assert_called_once_with(ANY, ANY, 1, 2)
 
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.queue_email')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs._format_notification_email_body')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs._format_notification_email_subject')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_canvas_user_profile')
+    def test_send_notification_uses_annotated_counts(self, m_profile, m_subj, m_body, m_send, **kwargs):
+        """ notifications should use the subjob counts annotated on the job instead of counting them again """
+        m_profile.return_value = {'primary_email': 'icommons-technical@g.harvard.edu'}
+        m_bulk_job = Mock(id=1, school_id='colgsas', sis_term_id=1, created_by_user_id='12345678',
+                          completed_subjobs_count=5, failed_subjobs_count=2)
+        self.assertTrue(_send_notification(m_bulk_job))
+        m_body.assert_called_once_with(ANY, ANY, 5, 2)
+        self.assertFalse(m_bulk_job.get_completed_subjobs_count.called)
+        self.assertFalse(m_bulk_job.get_failed_subjobs_count.called)
+
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs._log_notification_failure')
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_canvas_user_profile')
     def test_send_notification_bad_canvas_user(self, m_profile, m_log_failure, **kwargs):
@@ -133,7 +146,7 @@ class FinalizeBulkCanvasCourseCreationJobsCommandTests(TestCase):
         self.assertFalse(_send_notification(m_bulk_job))
         m_log_failure.assert_called_once_with(m_bulk_job)
 
-    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.send_email_helper')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.queue_email')
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs._format_notification_email_body')
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs._format_notification_email_subject')
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.Term.objects.get')
@@ -155,14 +168,14 @@ class FinalizeBulkCanvasCourseCreationJobsCommandTests(TestCase):
         m_subj.assert_called_with(m_bulk_job.school_id, m_bulk_job.sis_term_id)
 
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs._log_notification_failure')
-    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.send_email_helper')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.queue_email')
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs._format_notification_email_body')
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs._format_notification_email_subject')
     @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_canvas_user_profile')
     def test_send_notification_bad_send(self, m_profile, m_subj, m_body, m_send, m_log_failure, **kwargs):
         """ if notification fails due to send mail helper then command should log state and fail gracefully """
         m_profile.return_value = {'primary_email': 'icommons-technical@g.harvard.edu'}
-        m_send.side_effect = Exception('problem with send email helper')
+        m_send.side_effect = Exception('problem queueing email')
         m_bulk_job = get_mock_bulk_job()
         self.assertFalse(_send_notification(m_bulk_job))
         m_log_failure.assert_called_once_with(m_bulk_job)
@@ -1,4 +1,6 @@
+from django.core.cache import cache
 from django.test import TestCase
+from django.test.utils import override_settings
 from mock import patch, ANY, DEFAULT, Mock, MagicMock, call
 from canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs import _init_courses_with_status_setup
 from canvas_course_site_wizard.models import CanvasCourseGenerationJob, BulkCanvasCourseCreationJob
@@ -18,6 +20,8 @@ class ContentMigrationJob:
         self.created_by_user_id = created_by_user_id
         self.sis_course_id = sis_course_id
         self.workflow_state = state
+        self.setup_started_at = None
+        self.canvas_course_created_at = None
 
     def update_workflow_state(self, state):
         self.workflow_state = state
@@ -67,7 +71,8 @@ class FinalizeInitCoursesWithStatusSetupCommandTests(TestCase):
         template_copy_calls = []
         for index, course in enumerate(self.courses):
             create_course_calls.append(
-                call(course, self.user_id, bulk_job=BulkCanvasCourseCreationJob(id=self.bulk_job_id))
+                call(course, self.user_id, bulk_job=BulkCanvasCourseCreationJob(id=self.bulk_job_id),
+                     course_data=ANY)
             )
             create_course_calls.append(ANY)
             template_copy_calls.append(
@@ -133,3 +138,201 @@ class FinalizeInitCoursesWithStatusSetupCommandTests(TestCase):
         _init_courses_with_status_setup()
         # make sure that the job's status is updated to STATUS_PENDING_FINALIZE
         self.assertEqual(self.cm_jobs[1].workflow_state, CanvasCourseGenerationJob.STATUS_SETUP_FAILED)
+
+    @override_settings(BULK_COURSE_CREATION={'setup_workers': 4, 'max_concurrent_setup_jobs': 2})
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.BulkJob.objects.filter')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.'
+           'CanvasCourseGenerationJob.objects.filter_setup_for_bulkjobs')
+    def test_that_all_courses_are_set_up_when_using_a_worker_pool(self, mock_getjobs, mock_filter_bulk_jobs,
+                                                                  get_course_data, create_canvas_course,
+                                                                  start_course_template_copy):
+        """
+        when setup_workers > 1 every course should still be created, and per-job failures should still leave
+        the job in STATUS_SETUP_FAILED
+        """
+        mock_getjobs.return_value = self.cm_jobs
+        mock_filter_bulk_jobs.return_value = self.bulk_jobs
+        failed_course = self.courses[2]
+
+        def create_course(sis_course_id, sis_user_id, bulk_job=None, course_data=None):
+            if sis_course_id == failed_course:
+                raise CanvasCourseAlreadyExistsError(msg_details=sis_course_id)
+            return {'id': sis_course_id}
+        create_canvas_course.side_effect = create_course
+
+        _init_courses_with_status_setup()
+        self.assertEqual(create_canvas_course.call_count, len(self.courses))
+        self.assertEqual(start_course_template_copy.call_count, len(self.courses) - 1)
+        self.assertEqual(self.cm_jobs[2].workflow_state, CanvasCourseGenerationJob.STATUS_SETUP_FAILED)
+
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_course_data_for_sis_course_ids')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.BulkJob.objects.filter')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.'
+           'CanvasCourseGenerationJob.objects.filter_setup_for_bulkjobs')
+    def test_that_preloaded_course_data_is_passed_through(self, mock_getjobs, mock_filter_bulk_jobs,
+                                                          mock_preload, get_course_data, create_canvas_course,
+                                                          start_course_template_copy):
+        """
+        test that the course data for all the courses is loaded in bulk and passed through to
+        create_canvas_course and start_course_template_copy, instead of being looked up for each course
+        """
+        mock_getjobs.return_value = self.cm_jobs
+        mock_filter_bulk_jobs.return_value = self.bulk_jobs
+        preloaded = {str(course): Mock(name='course_data_%s' % course) for course in self.courses}
+        mock_preload.return_value = preloaded
+
+        _init_courses_with_status_setup()
+        mock_preload.assert_called_once_with(self.courses)
+        self.assertFalse(get_course_data.called)
+        for course in self.courses:
+            create_canvas_course.assert_any_call(course, self.user_id, bulk_job=ANY,
+                                                 course_data=preloaded[str(course)])
+            start_course_template_copy.assert_any_call(preloaded[str(course)], ANY, self.user_id,
+                                                       course_job_id=ANY, bulk_job_id=self.bulk_job_id,
+                                                       template_id=self.template_id)
+
+    @override_settings(BULK_COURSE_CREATION={'setup_engine': 'sis_import'})
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.SISCourseData.objects.bulk_update')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_template_course_settings')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_or_create_account')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.'
+           'create_canvas_courses_with_sis_import')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_course_data_for_sis_course_ids')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.BulkJob.objects.filter')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.'
+           'CanvasCourseGenerationJob.objects.filter_setup_for_bulkjobs')
+    def test_that_courses_are_created_with_one_sis_import(self, mock_getjobs, mock_filter_bulk_jobs, mock_preload,
+                                                          mock_sis_import, mock_get_or_create_account,
+                                                          mock_template_settings, mock_bulk_update,
+                                                          get_course_data, create_canvas_course,
+                                                          start_course_template_copy):
+        """
+        with the sis_import setup engine the courses should be created by a single SIS import instead of
+        create_canvas_course, and courses the import didn't create should be marked as STATUS_SETUP_FAILED
+        """
+        mock_getjobs.return_value = self.cm_jobs
+        mock_filter_bulk_jobs.return_value = self.bulk_jobs
+        preloaded = {str(course): Mock(canvas_course_id=None, sis_account_id='dept:150') for course in self.courses}
+        mock_preload.return_value = preloaded
+        not_created = str(self.courses[1])
+        mock_sis_import.return_value = {str(course): index + 1000 for index, course in enumerate(self.courses)
+                                        if str(course) != not_created}
+        mock_template_settings.return_value = {'is_public': False, 'public_syllabus': False}
+
+        _init_courses_with_status_setup()
+        self.assertFalse(create_canvas_course.called)
+        mock_sis_import.assert_called_once_with([preloaded[str(course)] for course in self.courses], on_poll=None)
+        # all of the courses share an account, so it's only checked once
+        self.assertEqual(mock_get_or_create_account.call_count, 1)
+        self.assertEqual(start_course_template_copy.call_count, len(self.courses) - 1)
+        start_course_template_copy.assert_any_call(preloaded[str(self.courses[0])], 1000, self.user_id,
+                                                   course_job_id=0, bulk_job_id=self.bulk_job_id,
+                                                   template_id=self.template_id)
+        self.assertEqual(preloaded[str(self.courses[0])].canvas_course_id, 1000)
+        self.assertEqual(self.cm_jobs[1].workflow_state, CanvasCourseGenerationJob.STATUS_SETUP_FAILED)
+
+    @override_settings(BULK_COURSE_CREATION={'setup_engine': 'sis_import'})
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.SISCourseData.objects.bulk_update')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_template_course_settings')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_or_create_account')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.'
+           'create_canvas_courses_with_sis_import')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_course_data_for_sis_course_ids')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.BulkJob.objects.filter')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.'
+           'CanvasCourseGenerationJob.objects.filter_setup_for_bulkjobs')
+    def test_that_courses_in_a_failed_account_are_left_out_of_the_sis_import(self, mock_getjobs, mock_filter_bulk_jobs,
+                                                                             mock_preload, mock_sis_import,
+                                                                             mock_get_or_create_account,
+                                                                             mock_template_settings, mock_bulk_update,
+                                                                             get_course_data, create_canvas_course,
+                                                                             start_course_template_copy):
+        """
+        with the sis_import setup engine, all of the courses in an account which can't be created should be marked
+        as STATUS_SETUP_FAILED and left out of the import
+        """
+        mock_getjobs.return_value = self.cm_jobs
+        mock_filter_bulk_jobs.return_value = self.bulk_jobs
+        # every other course is in an account which can't be created
+        preloaded = {str(course): Mock(canvas_course_id=None, sis_account_id='dept:%d' % (150 + index % 2))
+                     for index, course in enumerate(self.courses)}
+        mock_preload.return_value = preloaded
+
+        def get_or_create_account(course_data, *args, **kwargs):
+            if course_data.sis_account_id == 'dept:151':
+                raise Exception('could not create account')
+        mock_get_or_create_account.side_effect = get_or_create_account
+        mock_sis_import.return_value = {str(course): index + 1000 for index, course in enumerate(self.courses)}
+        mock_template_settings.return_value = {'is_public': False, 'public_syllabus': False}
+
+        _init_courses_with_status_setup()
+        mock_sis_import.assert_called_once_with([preloaded[str(course)] for index, course in enumerate(self.courses)
+                                                 if not index % 2], on_poll=None)
+        for index, cm_job in enumerate(self.cm_jobs):
+            if index % 2:
+                self.assertEqual(cm_job.workflow_state, CanvasCourseGenerationJob.STATUS_SETUP_FAILED)
+        self.assertEqual(start_course_template_copy.call_count, len(self.courses) // 2)
+
+    @override_settings(BULK_COURSE_CREATION={'setup_engine': 'sis_import', 'setup_lease_renewal_batch_size': 2},
+                       CANVAS_COURSE_GENERATION_JOB_LEASING=True)
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.SISCourseData.objects.bulk_update')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_template_course_settings')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_or_create_account')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.'
+           'create_canvas_courses_with_sis_import')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_course_data_for_sis_course_ids')
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.BulkJob.objects.filter')
+    @patch.multiple('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.'
+                    'CanvasCourseGenerationJob.objects', claim_jobs=DEFAULT, renew_leases=DEFAULT,
+                    release_jobs=DEFAULT)
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.get_job_lease_owner',
+           Mock(return_value='host1:1'))
+    def test_that_a_claimed_batch_is_created_with_one_sis_import(self, mock_filter_bulk_jobs, mock_preload,
+                                                                 mock_sis_import, mock_get_or_create_account,
+                                                                 mock_template_settings, mock_bulk_update,
+                                                                 get_course_data, create_canvas_course,
+                                                                 start_course_template_copy, claim_jobs,
+                                                                 renew_leases, release_jobs):
+        """
+        with job leasing and the sis_import setup engine, a whole claimed batch should be created by one SIS import,
+        and the leases on the batch should be renewed each time the import is polled
+        """
+        claim_jobs.side_effect = [self.cm_jobs, []]
+        mock_filter_bulk_jobs.return_value = self.bulk_jobs
+        preloaded = {str(course): Mock(canvas_course_id=None, sis_account_id='dept:150') for course in self.courses}
+        mock_preload.return_value = preloaded
+
+        def sis_import(course_data_list, on_poll=None):
+            on_poll()
+            on_poll()
+            return {str(course): index + 1000 for index, course in enumerate(self.courses)}
+        mock_sis_import.side_effect = sis_import
+        mock_template_settings.return_value = {'is_public': False, 'public_syllabus': False}
+
+        _init_courses_with_status_setup()
+        mock_sis_import.assert_called_once_with([preloaded[str(course)] for course in self.courses], on_poll=ANY)
+        renew_leases.assert_has_calls([call('host1:1', self.cm_jobs)] * 2)
+        release_jobs.assert_called_once_with('host1:1', self.cm_jobs)
+        self.assertEqual(start_course_template_copy.call_count, len(self.courses))
+
+
+class SetupSlotTests(TestCase):
+    """ tests for the course setup slots shared by every worker setting up courses against the Canvas host """
+
+    def tearDown(self):
+        cache.clear()
+
+    @patch('canvas_course_site_wizard.management.commands.finalize_bulk_create_jobs.time.sleep')
+    def test_that_a_worker_waits_for_a_free_slot(self, mock_sleep):
+        """ with every slot taken (e.g. by another run), a worker should wait for one to be freed, then free it """
+        slot_keys = [finalize_bulk_create_jobs._setup_slot_key(slot) for slot in range(2)]
+        for slot_key in slot_keys:
+            cache.add(slot_key, 'another-worker')
+        mock_sleep.side_effect = lambda interval: cache.delete(slot_keys[1])
+
+        with finalize_bulk_create_jobs._setup_slot(2):
+            self.assertEqual(mock_sleep.call_count, 1)
+            self.assertIsNotNone(cache.get(slot_keys[1]))
+            self.assertEqual(cache.get(slot_keys[0]), 'another-worker')
+        self.assertIsNone(cache.get(slot_keys[1]))
+        self.assertEqual(cache.get(slot_keys[0]), 'another-worker')
@@ -0,0 +1,108 @@
+from datetime import timedelta
+from itertools import count
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from mock import patch, DEFAULT
+from canvas_course_site_wizard.models import CanvasCourseGenerationJob
+from canvas_course_site_wizard.management.commands.sweep_stalled_jobs import sweep_stalled_jobs
+
+# jobs must have unique sis_course_ids within a bulk job
+_sis_course_id_generator = count(6789)
+
+
+@override_settings(CANVAS_COURSE_GENERATION_JOB_STALLED_MINUTES={
+    CanvasCourseGenerationJob.STATUS_QUEUED: 30,
+    CanvasCourseGenerationJob.STATUS_COMPLETED: 30,
+    CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE: 30,
+})
+@patch.multiple(
+    'canvas_course_site_wizard.management.commands.sweep_stalled_jobs',
+    client=DEFAULT,
+    get_canvas_user_profile=DEFAULT,
+    send_failure_email=DEFAULT,
+    tech_logger=DEFAULT
+)
+class SweepStalledJobsTests(TestCase):
+    """
+    tests for the sweep_stalled_jobs management command
+    """
+    def _create_stalled_job(self, workflow_state, minutes=60, bulk_job_id=None):
+        job = CanvasCourseGenerationJob.objects.create(
+            canvas_course_id=1,
+            sis_course_id=str(next(_sis_course_id_generator)),
+            status_url='http://example.com/1234',
+            created_by_user_id='123',
+            workflow_state=workflow_state,
+            bulk_job_id=bulk_job_id
+        )
+        # update() leaves updated_at alone
+        CanvasCourseGenerationJob.objects.filter(pk=job.pk).update(
+            updated_at=timezone.now() - timedelta(minutes=minutes))
+        return job
+
+    def _workflow_state(self, job):
+        return CanvasCourseGenerationJob.objects.get(pk=job.pk).workflow_state
+
+    def test_lost_migration_is_marked_failed(self, client, get_canvas_user_profile, send_failure_email, **kwargs):
+        """ a queued job whose migration Canvas can no longer find should fail, and its initiator be told """
+        job = self._create_stalled_job(CanvasCourseGenerationJob.STATUS_QUEUED)
+        client.get.side_effect = Exception('404 Not Found')
+        get_canvas_user_profile.return_value = {'primary_email': 'a@a.com'}
+        sweep_stalled_jobs()
+        self.assertEqual(self._workflow_state(job), CanvasCourseGenerationJob.STATUS_FAILED)
+        send_failure_email.assert_called_once_with('a@a.com', job.sis_course_id)
+
+    def test_migration_still_in_progress_is_left_alone(self, client, send_failure_email, **kwargs):
+        """ a queued job whose migration Canvas still reports as queued shouldn't be failed """
+        job = self._create_stalled_job(CanvasCourseGenerationJob.STATUS_QUEUED)
+        client.get.return_value.json.return_value = {'workflow_state': CanvasCourseGenerationJob.STATUS_QUEUED}
+        self.assertEqual(sweep_stalled_jobs(), {})
+        self.assertEqual(self._workflow_state(job), CanvasCourseGenerationJob.STATUS_QUEUED)
+        self.assertFalse(send_failure_email.called)
+
+    @override_settings(CANVAS_COURSE_GENERATION_JOB_MAX_MIGRATION_HOURS=24)
+    def test_migration_in_progress_past_max_age_is_marked_failed(self, client, get_canvas_user_profile,
+                                                                 send_failure_email, **kwargs):
+        """ a queued job whose migration Canvas has reported as queued for too long should fail as usual """
+        job = self._create_stalled_job(CanvasCourseGenerationJob.STATUS_QUEUED)
+        recent_job = self._create_stalled_job(CanvasCourseGenerationJob.STATUS_QUEUED)
+        CanvasCourseGenerationJob.objects.filter(pk=job.pk).update(
+            migration_queued_at=timezone.now() - timedelta(hours=25))
+        CanvasCourseGenerationJob.objects.filter(pk=recent_job.pk).update(
+            migration_queued_at=timezone.now() - timedelta(hours=23))
+        client.get.return_value.json.return_value = {'workflow_state': CanvasCourseGenerationJob.STATUS_QUEUED}
+        get_canvas_user_profile.return_value = {'primary_email': 'a@a.com'}
+        self.assertEqual(sweep_stalled_jobs(), {CanvasCourseGenerationJob.STATUS_FAILED: 1})
+        self.assertEqual(self._workflow_state(job), CanvasCourseGenerationJob.STATUS_FAILED)
+        self.assertEqual(self._workflow_state(recent_job), CanvasCourseGenerationJob.STATUS_QUEUED)
+        send_failure_email.assert_called_once_with('a@a.com', job.sis_course_id)
+
+    def test_completed_migration_is_handed_back_for_finalization(self, client, send_failure_email, **kwargs):
+        """ a queued job whose migration Canvas reports complete should be moved on to be finalized """
+        job = self._create_stalled_job(CanvasCourseGenerationJob.STATUS_QUEUED)
+        client.get.return_value.json.return_value = {'workflow_state': CanvasCourseGenerationJob.STATUS_COMPLETED}
+        sweep_stalled_jobs()
+        job = CanvasCourseGenerationJob.objects.get(pk=job.pk)
+        self.assertEqual(job.workflow_state, CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE)
+        self.assertIsNotNone(job.migration_completed_at)
+        self.assertFalse(send_failure_email.called)
+
+    def test_completed_and_pending_finalize_jobs(self, send_failure_email, **kwargs):
+        """ interrupted finalizations should be re-driven, and finalizations which keep stalling failed """
+        completed_job = self._create_stalled_job(CanvasCourseGenerationJob.STATUS_COMPLETED, bulk_job_id=1)
+        pending_job = self._create_stalled_job(CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE, bulk_job_id=1)
+        recent_job = self._create_stalled_job(CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE, minutes=5,
+                                              bulk_job_id=2)
+        sweep_stalled_jobs()
+        self.assertEqual(self._workflow_state(completed_job), CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE)
+        self.assertEqual(self._workflow_state(pending_job), CanvasCourseGenerationJob.STATUS_FINALIZE_FAILED)
+        self.assertEqual(self._workflow_state(recent_job), CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE)
+        # bulk jobs' initiators hear about failures in the bulk job's notification
+        self.assertFalse(send_failure_email.called)
+
+    def test_dry_run_changes_nothing(self, client, **kwargs):
+        """ a dry run should leave the stalled jobs as they were """
+        job = self._create_stalled_job(CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE)
+        self.assertEqual(sweep_stalled_jobs(dry_run=True), {CanvasCourseGenerationJob.STATUS_FINALIZE_FAILED: 1})
+        self.assertEqual(self._workflow_state(job), CanvasCourseGenerationJob.STATUS_PENDING_FINALIZE)
@@ -0,0 +1,128 @@
+from datetime import timedelta
+from unittest import TestCase as UnitTestCase
+
+from django.test import TestCase
+from django.utils import timezone
+from mock import patch
+
+from canvas_course_site_wizard.models import BulkCanvasCourseCreationJob, CanvasCourseGenerationJob
+from canvas_course_site_wizard.management.commands.wizard_latency_report import (DEFAULT_TEMPLATE, NO_BULK_JOB,
+                                                                                 get_stage_durations, percentile)
+
+
+class PercentileTests(UnitTestCase):
+    """
+    tests for the nearest rank percentile used by the wizard_latency_report management command
+    """
+    def setUp(self):
+        self.values = list(range(1, 11))
+
+    def test_percentiles(self):
+        """ the p-th percentile should be the smallest value with at least p% of the values at or below it """
+        self.assertEqual(percentile(self.values, 50), 5)
+        self.assertEqual(percentile(self.values, 95), 10)
+        self.assertEqual(percentile(self.values, 99), 10)
+        self.assertEqual(percentile(self.values, 51), 6)
+
+    def test_p100_is_the_largest_value(self):
+        """ the 100th percentile should be the largest value, not one past the end of the list """
+        self.assertEqual(percentile(self.values, 100), 10)
+
+    def test_p0_is_the_smallest_value(self):
+        """ the 0th percentile should be the smallest value """
+        self.assertEqual(percentile(self.values, 0), 1)
+
+    def test_single_value(self):
+        """ every percentile of a single value should be that value """
+        for p in (0, 50, 99, 100):
+            self.assertEqual(percentile([7.5], p), 7.5)
+
+    def test_empty_list(self):
+        """ there is no percentile of an empty list """
+        self.assertIsNone(percentile([], 50))
+        self.assertIsNone(percentile([], 100))
+
+
+@patch('canvas_course_site_wizard.management.commands.wizard_latency_report.CourseInstance')
+class GetStageDurationsTests(TestCase):
+    """
+    tests for the stage durations, and their groups, computed by the wizard_latency_report management command
+    """
+    def setUp(self):
+        self.start = timezone.now() - timedelta(hours=1)
+        self.template_bulk_job = BulkCanvasCourseCreationJob.objects.create(
+            school_id='colgsas', sis_term_id=4579, template_canvas_course_id=1234, created_by_user_id='123',
+            status=BulkCanvasCourseCreationJob.STATUS_PENDING)
+        self.no_template_bulk_job = BulkCanvasCourseCreationJob.objects.create(
+            school_id='colgsas', sis_term_id=4579, created_by_user_id='123',
+            status=BulkCanvasCourseCreationJob.STATUS_PENDING)
+
+        # a job through every stage: 10s setup, 5s queue, 60s migration and 20s finalize
+        self._create_job('1001', self.template_bulk_job.pk, canvas_course_created_at=10, migration_queued_at=15,
+                         migration_completed_at=75, finalized_at=95)
+        # a job still waiting for its template copy to be queued
+        self._create_job('1002', self.template_bulk_job.pk, canvas_course_created_at=20)
+        # a job with no template to copy, finalized straight after setup
+        self._create_job('1003', self.no_template_bulk_job.pk, canvas_course_created_at=30, finalized_at=40)
+        # a job created through the wizard, not part of a bulk job
+        self._create_job('555', None, canvas_course_created_at=5, finalized_at=50)
+        # a job created before the reporting window
+        self._create_job('1004', self.template_bulk_job.pk, canvas_course_created_at=1000,
+                         created_at=timezone.now() - timedelta(days=10))
+
+    def _create_job(self, sis_course_id, bulk_job_id, created_at=None, **stage_seconds):
+        """ creates a job which started setup at self.start and reached each given stage the given seconds later """
+        job = CanvasCourseGenerationJob.objects.create(
+            sis_course_id=sis_course_id,
+            created_by_user_id='123',
+            workflow_state=CanvasCourseGenerationJob.STATUS_QUEUED,
+            bulk_job_id=bulk_job_id
+        )
+        fields = {name: self.start + timedelta(seconds=seconds) for name, seconds in stage_seconds.items()}
+        fields['setup_started_at'] = self.start
+        if created_at:
+            fields['created_at'] = created_at
+        CanvasCourseGenerationJob.objects.filter(pk=job.pk).update(**fields)
+        return job
+
+    def _get_stage_durations(self, CourseInstance):
+        CourseInstance.objects.filter.return_value.values_list.return_value = [(555, 'hls')]
+        durations = get_stage_durations(timezone.now() - timedelta(days=1))
+        # sort each group's durations, which are in no particular order
+        return {group_by: {group: {stage: sorted(values) for stage, values in stages.items()}
+                           for group, stages in groups.items()}
+                for group_by, groups in durations.items()}
+
+    def test_durations_by_school(self, CourseInstance):
+        """ the school of bulk subjobs should come from their bulk job, and of other jobs from their course """
+        durations = self._get_stage_durations(CourseInstance)
+        self.assertEqual(durations['school'], {
+            'colgsas': {'setup': [10, 20, 30], 'queue': [5], 'migration': [60], 'finalize': [20], 'total': [40, 95]},
+            'hls': {'setup': [5], 'total': [50]},
+        })
+        CourseInstance.objects.filter.assert_called_once_with(pk__in=[555])
+
+    def test_durations_by_template(self, CourseInstance):
+        """ jobs which didn't copy a bulk job's template should be grouped under the default template """
+        durations = self._get_stage_durations(CourseInstance)
+        self.assertEqual(durations['template'], {
+            1234: {'setup': [10, 20], 'queue': [5], 'migration': [60], 'finalize': [20], 'total': [95]},
+            DEFAULT_TEMPLATE: {'setup': [5, 30], 'total': [40, 50]},
+        })
+
+    def test_durations_by_bulk_job(self, CourseInstance):
+        """ jobs which weren't part of a bulk job should be grouped together """
+        durations = self._get_stage_durations(CourseInstance)
+        self.assertEqual(durations['bulk_job'], {
+            self.template_bulk_job.pk: {'setup': [10, 20], 'queue': [5], 'migration': [60], 'finalize': [20],
+                                        'total': [95]},
+            self.no_template_bulk_job.pk: {'setup': [30], 'total': [40]},
+            NO_BULK_JOB: {'setup': [5], 'total': [50]},
+        })
+
+    def test_no_jobs_in_window(self, CourseInstance):
+        """ there should be no groups when no jobs were created in the reporting window """
+        durations = get_stage_durations(timezone.now() + timedelta(days=1))
+        self.assertEqual({group_by: dict(groups) for group_by, groups in durations.items()},
+                         {'school': {}, 'template': {}, 'bulk_job': {}})
+        self.assertFalse(CourseInstance.objects.filter.called)
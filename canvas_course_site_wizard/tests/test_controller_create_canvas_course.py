@@ -5,6 +5,7 @@ from mock import patch, DEFAULT, MagicMock, Mock, ANY
 
 from icommons_common.utils import Bunch
 from icommons_ui.exceptions import RenderableException
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from canvas_sdk.exceptions import CanvasAPIError
 from canvas_course_site_wizard import controller
@@ -40,6 +41,8 @@ class CreateCanvasCourseTest(TestCase):
     longMessage = True
 
     def setUp(self):
+        # template course settings are cached between calls to create_canvas_course
+        cache.clear()
         self.bulk_job_id = 10
         self.bulk_job = BulkCanvasCourseCreationJob(id=self.bulk_job_id)
         self.canvas_course_id = uuid.uuid4().hex
@@ -129,7 +132,8 @@ class CreateCanvasCourseTest(TestCase):
         controller.create_canvas_course(self.sis_course_id, self.sis_user_id)
         self.assertTrue(canvas_content_gen_create.called)
         canvas_content_gen_create.assert_called_with(sis_course_id=self.sis_course_id, created_by_user_id=self.sis_user_id,
-                                                      workflow_state=CanvasCourseGenerationJob.STATUS_SETUP)
+                                                      workflow_state=CanvasCourseGenerationJob.STATUS_SETUP,
+                                                      setup_started_at=ANY)
 
     @patch('canvas_course_site_wizard.controller.update_course_generation_workflow_state')
     @patch('canvas_course_site_wizard.controller.CanvasCourseGenerationJob.objects.filter')
@@ -164,7 +168,8 @@ class CreateCanvasCourseTest(TestCase):
         args, kwargs = canvas_content_gen_db_mock.objects.create.call_args
         canvas_content_gen_db_mock.objects.create.assert_called_with(sis_course_id=self.sis_course_id,
                                                                       created_by_user_id=self.sis_user_id,
-                                                                      workflow_state=ANY)
+                                                                      workflow_state=ANY,
+                                                                      setup_started_at=ANY)
 
     @patch('canvas_course_site_wizard.controller.logger')
     @patch('canvas_course_site_wizard.models.CanvasCourseGenerationJob.objects.create')
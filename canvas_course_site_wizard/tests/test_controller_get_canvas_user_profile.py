@@ -1,6 +1,9 @@
 from unittest import TestCase
-from mock import patch, DEFAULT, ANY
-from canvas_course_site_wizard.controller import get_canvas_user_profile
+from mock import patch, DEFAULT, ANY, Mock
+from canvas_sdk.exceptions import CanvasAPIError
+from django.core.cache import cache
+from canvas_course_site_wizard.controller import get_canvas_user_profile, invalidate_canvas_user_profile
+from canvas_course_site_wizard.exceptions import CanvasUserProfileNotFound
 import logging
 import unittest
 
@@ -14,6 +17,7 @@ class GetCanvasUserProfileTest(TestCase):
 
     def setUp(self):
         self.user_id = "12345678"
+        cache.clear()
 
     def test_get_canvas_user_profile_method_called_with_right_params(self, SDK_CONTEXT, get_user_profile):
         """
@@ -29,3 +33,33 @@ class GetCanvasUserProfileTest(TestCase):
         """
         get_user_profile.side_effect = Exception
         self.assertRaises(Exception, get_canvas_user_profile, self.user_id)
+
+    def test_profile_is_cached(self, SDK_CONTEXT, get_user_profile):
+        """
+        Test that the profile is only fetched from Canvas once, until it is invalidated
+        """
+        get_user_profile.return_value = Mock(json=Mock(return_value={'primary_email': 'a@a.com'}))
+        self.assertEqual(get_canvas_user_profile(self.user_id), {'primary_email': 'a@a.com'})
+        self.assertEqual(get_canvas_user_profile(self.user_id), {'primary_email': 'a@a.com'})
+        self.assertEqual(get_user_profile.call_count, 1)
+        invalidate_canvas_user_profile(self.user_id)
+        get_canvas_user_profile(self.user_id)
+        self.assertEqual(get_user_profile.call_count, 2)
+
+    def test_missing_profile_is_cached(self, SDK_CONTEXT, get_user_profile):
+        """
+        Test that a user Canvas doesn't know is only looked up once
+        """
+        get_user_profile.side_effect = CanvasAPIError(status_code=404)
+        self.assertRaises(CanvasUserProfileNotFound, get_canvas_user_profile, self.user_id)
+        self.assertRaises(CanvasUserProfileNotFound, get_canvas_user_profile, self.user_id)
+        self.assertEqual(get_user_profile.call_count, 1)
+
+    def test_other_errors_are_not_cached(self, SDK_CONTEXT, get_user_profile):
+        """
+        Test that a failed lookup which isn't a missing user is tried again
+        """
+        get_user_profile.side_effect = CanvasAPIError(status_code=500)
+        self.assertRaises(CanvasAPIError, get_canvas_user_profile, self.user_id)
+        self.assertRaises(CanvasAPIError, get_canvas_user_profile, self.user_id)
+        self.assertEqual(get_user_profile.call_count, 2)
@@ -0,0 +1,63 @@
+from unittest import TestCase
+from mock import patch, DEFAULT, MagicMock, Mock
+from django.core.cache import cache
+from canvas_sdk.exceptions import CanvasAPIError
+from canvas_course_site_wizard.controller import get_or_create_account
+
+
+@patch.multiple('canvas_course_site_wizard.controller', SDK_CONTEXT=DEFAULT, get_single_account=DEFAULT,
+                create_new_sub_account=DEFAULT, update_course_generation_workflow_state=DEFAULT,
+                Department=DEFAULT)
+class GetOrCreateAccountTest(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        cache.clear()
+        self.sis_course_id = '305841'
+        self.course_data = MagicMock(sis_account_id='dept:123')
+
+    def test_existing_account_is_only_checked_once(self, SDK_CONTEXT, get_single_account, create_new_sub_account,
+                                                   **kwargs):
+        """
+        Test that an account found in Canvas is not looked up again for other courses in the same account
+        """
+        for _ in range(3):
+            get_or_create_account(self.course_data, self.sis_course_id, None, 1)
+        get_single_account.assert_called_once_with(request_ctx=SDK_CONTEXT, id='sis_account_id:dept:123')
+        self.assertFalse(create_new_sub_account.called)
+
+    def test_created_account_is_not_checked_again(self, SDK_CONTEXT, get_single_account, create_new_sub_account,
+                                                  Department, **kwargs):
+        """
+        Test that an account created in Canvas is remembered as existing
+        """
+        get_single_account.side_effect = [CanvasAPIError, Mock(json=Mock(return_value={'id': 1}))]
+        Department.objects.get.return_value = Mock(school_id='colgsas')
+        get_or_create_account(self.course_data, self.sis_course_id, None, 1)
+        get_or_create_account(self.course_data, self.sis_course_id, None, 1)
+        self.assertEqual(create_new_sub_account.call_count, 1)
+        self.assertEqual(get_single_account.call_count, 2)
+
+    def test_account_is_checked_again_when_creation_fails(self, SDK_CONTEXT, get_single_account,
+                                                          create_new_sub_account, Department,
+                                                          update_course_generation_workflow_state, **kwargs):
+        """
+        Test that an account which could not be created is not remembered as existing
+        """
+        get_single_account.side_effect = CanvasAPIError
+        Department.objects.get.return_value = Mock(school_id='colgsas')
+        get_or_create_account(self.course_data, self.sis_course_id, None, 1)
+        get_or_create_account(self.course_data, self.sis_course_id, None, 1)
+        self.assertFalse(create_new_sub_account.called)
+        self.assertEqual(update_course_generation_workflow_state.call_count, 2)
+
+    def test_account_creation_error_raised_when_asked(self, SDK_CONTEXT, get_single_account, create_new_sub_account,
+                                                      Department, update_course_generation_workflow_state, **kwargs):
+        """
+        Test that with raise_exception an error creating the account is re-raised, leaving the job to the caller
+        """
+        get_single_account.side_effect = CanvasAPIError
+        Department.objects.get.return_value = Mock(school_id='colgsas')
+        with self.assertRaises(CanvasAPIError):
+            get_or_create_account(self.course_data, self.sis_course_id, None, 1, raise_exception=True)
+        self.assertFalse(update_course_generation_workflow_state.called)
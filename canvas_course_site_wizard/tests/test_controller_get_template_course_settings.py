@@ -0,0 +1,63 @@
+from unittest import TestCase
+from mock import patch, DEFAULT
+from django.core.cache import cache
+from icommons_common.utils import Bunch
+from canvas_sdk.exceptions import CanvasAPIError
+from canvas_course_site_wizard.controller import (
+    get_template_course_settings,
+    invalidate_template_course_settings
+)
+
+
+@patch.multiple('canvas_course_site_wizard.controller', SDK_CONTEXT=DEFAULT, get_single_course_courses=DEFAULT)
+class GetTemplateCourseSettingsTest(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        cache.clear()
+        self.template_id = 12345
+        self.template_course = {
+            'id': self.template_id,
+            'name': 'template course',
+            'is_public': True,
+            'public_syllabus': False,
+        }
+
+    def test_get_template_course_settings_returns_visibility_settings(self, SDK_CONTEXT, get_single_course_courses):
+        """
+        Test that only the visibility settings of the template course are returned
+        """
+        get_single_course_courses.return_value = Bunch(json=lambda: self.template_course)
+        result = get_template_course_settings(self.template_id)
+        get_single_course_courses.assert_called_once_with(SDK_CONTEXT, self.template_id, 'all_courses')
+        self.assertEqual(result, {'is_public': True, 'public_syllabus': False})
+
+    def test_get_template_course_settings_is_cached(self, SDK_CONTEXT, get_single_course_courses):
+        """
+        Test that repeated lookups of the same template only call Canvas once
+        """
+        get_single_course_courses.return_value = Bunch(json=lambda: self.template_course)
+        for _ in range(3):
+            get_template_course_settings(self.template_id)
+        self.assertEqual(get_single_course_courses.call_count, 1)
+
+    def test_invalidate_template_course_settings(self, SDK_CONTEXT, get_single_course_courses):
+        """
+        Test that the template is looked up in Canvas again after its cached settings are invalidated
+        """
+        get_single_course_courses.return_value = Bunch(json=lambda: self.template_course)
+        get_template_course_settings(self.template_id)
+        invalidate_template_course_settings(self.template_id)
+        get_template_course_settings(self.template_id)
+        self.assertEqual(get_single_course_courses.call_count, 2)
+
+    def test_get_template_course_settings_does_not_cache_errors(self, SDK_CONTEXT, get_single_course_courses):
+        """
+        Test that a failed lookup raises the SDK error and is not cached
+        """
+        get_single_course_courses.side_effect = CanvasAPIError
+        with self.assertRaises(CanvasAPIError):
+            get_template_course_settings(self.template_id)
+        get_single_course_courses.side_effect = None
+        get_single_course_courses.return_value = Bunch(json=lambda: self.template_course)
+        self.assertEqual(get_template_course_settings(self.template_id), {'is_public': True, 'public_syllabus': False})
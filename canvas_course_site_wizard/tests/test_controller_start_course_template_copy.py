@@ -104,17 +104,42 @@ class StartCourseTemplateCopyTest(TestCase):
         self.assertEqual(kwargs.get('settings_source_course_id'), self.template.template_id)
 
     def test_content_migration_job_row_updated(self,content_migrations, get_course_generation_data_for_sis_course_id,
-                                                **kwargs):
+                                                CanvasCourseGenerationJob, **kwargs):
         """
-        Test that start_course_template_copy results in the content migration job row getting saved with the right params
+        Test that start_course_template_copy moves the content migration job row from setup to queued with the
+        migration's params
         """
-
+        content_migrations.create_content_migration_courses.return_value.json.return_value = \
+            self.content_migration_json
         get_course_generation_data_for_sis_course_id.return_value = m_canvas_content_migration_job
         ret = start_course_template_copy(self.sis_course_data, self.canvas_course_id, self.user_id)
-        m_canvas_content_migration_job.save.assert_called_with(update_fields=['canvas_course_id', 'content_migration_id',
-                                                                                'status_url', 'workflow_state',
-                                                                              'created_by_user_id'])
-        # self.assertEqual(ret.workflow_state,  mock_queued)
+        m_canvas_content_migration_job.transition_workflow_state.assert_called_with(
+            CanvasCourseGenerationJob.STATUS_SETUP,
+            CanvasCourseGenerationJob.STATUS_QUEUED,
+            canvas_course_id=self.canvas_course_id,
+            content_migration_id=self.content_migration_json['id'],
+            status_url=self.content_migration_json['progress_url'],
+            created_by_user_id=self.user_id
+        )
+        self.assertFalse(m_canvas_content_migration_job.save.called)
+        self.assertEqual(ret, m_canvas_content_migration_job)
+
+    @patch('canvas_course_site_wizard.controller.logger')
+    def test_migration_not_recorded_if_job_no_longer_in_setup(self, logger, content_migrations,
+                                                              get_course_generation_data_for_sis_course_id, **kwargs):
+        """
+        Test that if another worker moved the job out of setup first, the migration isn't recorded and the conflict
+        is logged
+        """
+        content_migrations.create_content_migration_courses.return_value.json.return_value = \
+            self.content_migration_json
+        job = Mock(spec=CanvasCourseGenerationJob, pk=2, workflow_state='queued')
+        job.transition_workflow_state.return_value = False
+        get_course_generation_data_for_sis_course_id.return_value = job
+        ret = start_course_template_copy(self.sis_course_data, self.canvas_course_id, self.user_id)
+        self.assertEqual(ret, job)
+        self.assertFalse(job.save.called)
+        self.assertTrue(logger.warning.called)
 
     @patch('canvas_course_site_wizard.controller.update_course_generation_workflow_state')
     def test_exception_results_in_worflow_state_getting_updated (self, update_mock, get_default_template_for_school, **kwargs):
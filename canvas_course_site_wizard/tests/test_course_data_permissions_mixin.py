@@ -1,13 +1,15 @@
 from unittest import TestCase
 from mock import Mock, patch
+from django.core.cache import cache
 from canvas_course_site_wizard.models import SISCourseData
-from canvas_course_site_wizard.mixins import CourseDataPermissionsMixin
+from canvas_course_site_wizard.mixins import CourseDataPermissionsMixin, invalidate_account_admin_roles
 
 
 class CourseDataPermissionsMixinTest(TestCase):
     longMessage = True
 
     def setUp(self):
+        cache.clear()
         self.course_data = Mock(
             spec=SISCourseData,
             pk=1234,
@@ -133,3 +135,38 @@ class CourseDataPermissionsMixinTest(TestCase):
         sdk_admins_mock.list_account_admins.return_value.json.return_value = mock_user_list
         return_value = self.mixin.list_current_user_admin_roles_for_course()
         self.assertEqual(return_value, [])
+
+    @patch('canvas_course_site_wizard.mixins.admins')
+    def test_list_current_user_admin_roles_for_course_is_cached(self, sdk_admins_mock):
+        """
+        Admin roles should only be looked up in Canvas once per user and school, until they are invalidated
+        """
+        mock_user_list = [{"role": "AccountAdmin", "user": {"id": 2}}]
+        sdk_admins_mock.list_account_admins.return_value.json.return_value = mock_user_list
+        self.assertEqual(self.mixin.list_current_user_admin_roles_for_course(), mock_user_list)
+        self.assertEqual(self.mixin.list_current_user_admin_roles_for_course(), mock_user_list)
+        self.assertEqual(sdk_admins_mock.list_account_admins.call_count, 1)
+
+        invalidate_account_admin_roles(self.mixin.request.user.username, self.course_data.school_code)
+        self.mixin.list_current_user_admin_roles_for_course()
+        self.assertEqual(sdk_admins_mock.list_account_admins.call_count, 2)
+
+    @patch('canvas_course_site_wizard.mixins.admins')
+    def test_list_current_user_admin_roles_for_course_caches_no_roles(self, sdk_admins_mock):
+        """
+        A user who isn't an admin should also be remembered, rather than looked up on every request
+        """
+        sdk_admins_mock.list_account_admins.return_value.json.return_value = []
+        self.mixin.list_current_user_admin_roles_for_course()
+        self.assertEqual(self.mixin.list_current_user_admin_roles_for_course(), [])
+        self.assertEqual(sdk_admins_mock.list_account_admins.call_count, 1)
+
+    @patch('canvas_course_site_wizard.mixins.admins')
+    def test_list_current_user_admin_roles_for_course_does_not_cache_errors(self, sdk_admins_mock):
+        """
+        A failed lookup should be tried again on the next request
+        """
+        sdk_admins_mock.list_account_admins.side_effect = Exception
+        self.assertRaises(Exception, self.mixin.list_current_user_admin_roles_for_course)
+        self.assertRaises(Exception, self.mixin.list_current_user_admin_roles_for_course)
+        self.assertEqual(sdk_admins_mock.list_account_admins.call_count, 2)
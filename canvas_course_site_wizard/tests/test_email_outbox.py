@@ -0,0 +1,92 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from mock import patch, Mock
+
+from canvas_course_site_wizard.email_outbox import queue_email, dispatch_email_outbox
+from canvas_course_site_wizard.models import EmailOutbox
+
+
+@override_settings(CANVAS_EMAIL_NOTIFICATION={'from_email_address': 'sender@test.com'},
+                   EMAIL_OUTBOX_MAX_ATTEMPTS=3, EMAIL_OUTBOX_RETRY_DELAY=60)
+@patch('canvas_course_site_wizard.email_outbox.get_connection')
+class EmailOutboxTest(TestCase):
+    longMessage = True
+
+    def _queue(self, count):
+        return [queue_email('subject %d' % i, 'body %d' % i, ['a@test.com', 'b@test.com']) for i in range(count)]
+
+    def test_queue_email(self, m_get_connection):
+        """ queueing an email should store it in the outbox without sending anything """
+        message = queue_email('Test subject', 'Test body', ['a@test.com', 'b@test.com'])
+        message = EmailOutbox.objects.get(pk=message.pk)
+        self.assertEqual(message.status, EmailOutbox.STATUS_PENDING)
+        self.assertEqual(message.from_address, 'sender@test.com')
+        self.assertEqual(message.get_to_addresses(), ['a@test.com', 'b@test.com'])
+        self.assertFalse(m_get_connection.called)
+
+    def test_dispatch_sends_batches_over_one_connection(self, m_get_connection):
+        """ every due message should be sent, in batches, over a single connection """
+        connection = m_get_connection.return_value
+        connection.send_messages.return_value = 1
+        self._queue(5)
+        self.assertEqual(dispatch_email_outbox(batch_size=2), (5, 0))
+        m_get_connection.assert_called_once_with(fail_silently=False)
+        self.assertTrue(connection.open.called)
+        # closed once, when the dispatch is finished
+        connection.close.assert_called_once_with()
+        self.assertEqual(connection.send_messages.call_count, 5)
+        sent_message = connection.send_messages.call_args[0][0][0]
+        self.assertEqual(sent_message.to, ['a@test.com', 'b@test.com'])
+        self.assertEqual(EmailOutbox.objects.filter(status=EmailOutbox.STATUS_SENT, attempts=1).count(), 5)
+
+    def test_dispatch_without_messages_opens_no_connection(self, m_get_connection):
+        """ no connection should be opened if there is nothing to send """
+        self.assertEqual(dispatch_email_outbox(), (0, 0))
+        self.assertFalse(m_get_connection.called)
+
+    def test_failed_message_is_retried_later(self, m_get_connection):
+        """ a message which can't be sent should be left pending, and held back for the retry delay """
+        connection = m_get_connection.return_value
+        connection.send_messages.side_effect = [Exception('mail server down'), 1]
+        failing, sent = self._queue(2)
+        self.assertEqual(dispatch_email_outbox(), (1, 1))
+        failing = EmailOutbox.objects.get(pk=failing.pk)
+        self.assertEqual(failing.status, EmailOutbox.STATUS_PENDING)
+        self.assertEqual(failing.attempts, 1)
+        self.assertIn('mail server down', failing.last_error)
+        self.assertGreater(failing.next_attempt_at, timezone.now() + timedelta(seconds=50))
+        self.assertEqual(EmailOutbox.objects.get(pk=sent.pk).status, EmailOutbox.STATUS_SENT)
+        # not due yet, so the next dispatch leaves it alone
+        self.assertEqual(dispatch_email_outbox(), (0, 0))
+
+    def test_message_fails_after_max_attempts(self, m_get_connection):
+        """ a message should be marked failed once it has used up its attempts """
+        m_get_connection.return_value.send_messages.side_effect = Exception('mail server down')
+        message, = self._queue(1)
+        for attempt in range(3):
+            EmailOutbox.objects.filter(pk=message.pk).update(next_attempt_at=timezone.now())
+            self.assertEqual(dispatch_email_outbox(), (0, 1))
+        message = EmailOutbox.objects.get(pk=message.pk)
+        self.assertEqual(message.status, EmailOutbox.STATUS_FAILED)
+        self.assertEqual(message.attempts, 3)
+
+    def test_messages_claimed_by_another_dispatcher_are_skipped(self, m_get_connection):
+        """ messages claimed by another dispatcher shouldn't be sent again until the claim runs out """
+        self._queue(2)
+        claimed = EmailOutbox.objects.claim_due_messages('other-dispatcher', 1, 300)
+        self.assertEqual(len(claimed), 1)
+        m_get_connection.return_value.send_messages.return_value = 1
+        self.assertEqual(dispatch_email_outbox(), (1, 0))
+        self.assertEqual(EmailOutbox.objects.get(pk=claimed[0].pk).status, EmailOutbox.STATUS_PENDING)
+
+    def test_sent_messages_are_recorded_as_they_are_sent(self, m_get_connection):
+        """ messages already sent when a dispatch dies part way through a batch shouldn't be sent again """
+        m_get_connection.return_value.send_messages.side_effect = [1, SystemExit]
+        sent, unsent = self._queue(2)
+        with self.assertRaises(SystemExit):
+            dispatch_email_outbox()
+        self.assertEqual(EmailOutbox.objects.get(pk=sent.pk).status, EmailOutbox.STATUS_SENT)
+        self.assertEqual(EmailOutbox.objects.get(pk=unsent.pk).status, EmailOutbox.STATUS_PENDING)
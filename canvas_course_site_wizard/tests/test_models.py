@@ -1,13 +1,22 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from itertools import count
 from unittest import TestCase, skip
-from mock import patch, Mock
+from mock import patch, Mock, ANY
 from icommons_common.models import Course, CourseInstance, Term, School, TermCode
+from django.core.cache import cache
+from django.test.utils import override_settings
+from django.utils import timezone
 from canvas_course_site_wizard.models import (
     BulkCanvasCourseCreationJob as BulkJob,
     CanvasCourseGenerationJob as SubJob,
-    SISCourseData
+    CanvasCourseGenerationJobTransition as JobTransition,
+    CanvasCourseGenerationJobUpdateBuffer,
+    SISCourseData,
+    get_bulk_job_progress_version,
+    iter_course_instance_id_chunks,
+    record_subjob_state_changes
 )
+from canvas_course_site_wizard.exceptions import InvalidWorkflowStateTransition
 from .setup_bulk_jobs import create_jobs
 
 
@@ -18,12 +27,16 @@ def _create_bulk_job(sis_term_id=1, status=BulkJob.STATUS_SETUP):
     )
 
 
-def _create_subjob(content_migration_id, canvas_course_id=1, sis_course_id='1',
+# subjobs must have unique sis_course_ids within a bulk job
+_sis_course_id_generator = count(100000)
+
+
+def _create_subjob(content_migration_id, canvas_course_id=1, sis_course_id=None,
                    workflow_state=SubJob.STATUS_SETUP, bulk_job_id=1):
     return SubJob.objects.create(
         content_migration_id=content_migration_id,
         canvas_course_id=canvas_course_id,
-        sis_course_id=sis_course_id,
+        sis_course_id=sis_course_id or str(next(_sis_course_id_generator)),
         workflow_state=workflow_state,
         bulk_job_id=bulk_job_id
     )
@@ -113,6 +126,33 @@ class BulkCanvasCourseCreationJobIntegrationTests(TestCase):
         subjob_setup_failed.delete()
 
 
+    def test_get_jobs_ready_to_finalize_integration(self):
+        """
+        get_jobs_ready_to_finalize() should return only pending bulk jobs whose subjobs are all in a terminal
+        state, annotated with their successful and failed subjob counts
+        """
+        job_pending_and_ready = _create_bulk_job(999, status=BulkJob.STATUS_PENDING)
+        job_pending_without_subjobs = _create_bulk_job(998, status=BulkJob.STATUS_PENDING)
+        subjobs = [
+            _create_subjob(9999, workflow_state=SubJob.STATUS_FINALIZED, bulk_job_id=job_pending_and_ready.id),
+            _create_subjob(9999, workflow_state=SubJob.STATUS_FINALIZED, bulk_job_id=job_pending_and_ready.id),
+            _create_subjob(9999, workflow_state=SubJob.STATUS_FINALIZE_FAILED, bulk_job_id=job_pending_and_ready.id),
+        ]
+
+        ready_jobs = {job.id: job for job in BulkJob.objects.get_jobs_ready_to_finalize()}
+        # the fixture's pending bulk job has subjobs in intermediate states, so isn't ready
+        self.assertEqual(set(ready_jobs), {job_pending_and_ready.id, job_pending_without_subjobs.id})
+        self.assertEqual(ready_jobs[job_pending_and_ready.id].completed_subjobs_count, 2)
+        self.assertEqual(ready_jobs[job_pending_and_ready.id].failed_subjobs_count, 1)
+        self.assertEqual(ready_jobs[job_pending_without_subjobs.id].completed_subjobs_count, 0)
+        self.assertEqual(ready_jobs[job_pending_without_subjobs.id].failed_subjobs_count, 0)
+        # clean up
+        job_pending_and_ready.delete()
+        job_pending_without_subjobs.delete()
+        for subjob in subjobs:
+            subjob.delete()
+
+
 class BulkCanvasCourseCreationJobTests(TestCase):
     @patch('canvas_course_site_wizard.models.BulkCanvasCourseCreationJob.save')
     def test_update_status_success(self, m_save):
@@ -227,6 +267,373 @@ class CanvasCourseGenerationJobTests(TestCase):
         self.assertEqual(SubJob.objects.filter_failed(bulk_job_id=bulk_job.id).count(), 3)
 
 
+class CanvasCourseGenerationJobUpdateBufferTests(TestCase):
+
+    def setUp(self):
+        SubJob.objects.all().delete()
+        self.jobs = [_create_subjob(index, sis_course_id=str(index), workflow_state=SubJob.STATUS_QUEUED)
+                     for index in range(1, 6)]
+
+    def tearDown(self):
+        SubJob.objects.all().delete()
+
+    def _states_in_db(self):
+        return {job.pk: job.workflow_state for job in SubJob.objects.filter(pk__in=[j.pk for j in self.jobs])}
+
+    def test_changes_are_only_written_on_flush(self):
+        """ buffered changes should update the job objects immediately but the database only when flushed """
+        buffer = CanvasCourseGenerationJobUpdateBuffer(flush_size=100)
+        for job in self.jobs:
+            buffer.update_workflow_state(job, SubJob.STATUS_COMPLETED)
+        self.assertTrue(all(job.workflow_state == SubJob.STATUS_COMPLETED for job in self.jobs))
+        self.assertEqual(set(self._states_in_db().values()), {SubJob.STATUS_QUEUED})
+
+        self.assertEqual(buffer.flush(), len(self.jobs))
+        self.assertEqual(set(self._states_in_db().values()), {SubJob.STATUS_COMPLETED})
+        self.assertEqual(len(buffer), 0)
+
+    def test_flush_size_triggers_flush(self):
+        """ the buffer should flush itself once flush_size jobs have pending changes """
+        buffer = CanvasCourseGenerationJobUpdateBuffer(flush_size=2)
+        buffer.update_workflow_state(self.jobs[0], SubJob.STATUS_FAILED)
+        self.assertEqual(self._states_in_db()[self.jobs[0].pk], SubJob.STATUS_QUEUED)
+        buffer.update_workflow_state(self.jobs[1], SubJob.STATUS_FAILED)
+        states = self._states_in_db()
+        self.assertEqual(states[self.jobs[0].pk], SubJob.STATUS_FAILED)
+        self.assertEqual(states[self.jobs[1].pk], SubJob.STATUS_FAILED)
+
+    def test_context_manager_flushes_mixed_changes(self):
+        """ leaving the with block should write all pending changes, including different values per job """
+        with CanvasCourseGenerationJobUpdateBuffer() as buffer:
+            buffer.update_workflow_state(self.jobs[0], SubJob.STATUS_COMPLETED)
+            buffer.update_workflow_state(self.jobs[1], SubJob.STATUS_COMPLETED)
+            buffer.update(self.jobs[2], workflow_state=SubJob.STATUS_QUEUED, canvas_course_id=1234,
+                          content_migration_id=55, status_url='http://example.com/55')
+            buffer.update(self.jobs[3], canvas_course_id=5678)
+            # a later change to the same job replaces the earlier one
+            buffer.update_workflow_state(self.jobs[4], SubJob.STATUS_COMPLETED)
+            buffer.update_workflow_state(self.jobs[4], SubJob.STATUS_FINALIZED)
+
+        jobs = {job.pk: job for job in SubJob.objects.filter(pk__in=[j.pk for j in self.jobs])}
+        self.assertEqual(jobs[self.jobs[0].pk].workflow_state, SubJob.STATUS_COMPLETED)
+        self.assertEqual(jobs[self.jobs[1].pk].workflow_state, SubJob.STATUS_COMPLETED)
+        self.assertEqual(jobs[self.jobs[2].pk].canvas_course_id, 1234)
+        self.assertEqual(jobs[self.jobs[2].pk].content_migration_id, 55)
+        self.assertEqual(jobs[self.jobs[2].pk].status_url, 'http://example.com/55')
+        self.assertEqual(jobs[self.jobs[3].pk].canvas_course_id, 5678)
+        self.assertEqual(jobs[self.jobs[3].pk].workflow_state, SubJob.STATUS_QUEUED)
+        self.assertEqual(jobs[self.jobs[4].pk].workflow_state, SubJob.STATUS_FINALIZED)
+
+    def test_unbuffered_fields_are_rejected(self):
+        """ only the buffered fields can be changed through the buffer """
+        buffer = CanvasCourseGenerationJobUpdateBuffer()
+        with self.assertRaises(ValueError):
+            buffer.update(self.jobs[0], created_by_user_id='123')
+
+    def test_invalid_transitions_are_rejected(self):
+        """ a workflow_state change which isn't in ALLOWED_TRANSITIONS shouldn't be buffered """
+        buffer = CanvasCourseGenerationJobUpdateBuffer()
+        with self.assertRaises(InvalidWorkflowStateTransition):
+            buffer.update_workflow_state(self.jobs[0], SubJob.STATUS_SETUP)
+        self.assertEqual(len(buffer), 0)
+
+    def test_jobs_moved_on_by_another_worker_are_left_alone(self):
+        """ a buffered workflow_state change should only be written if the job is still in the state it was in """
+        buffer = CanvasCourseGenerationJobUpdateBuffer()
+        buffer.update_workflow_state(self.jobs[0], SubJob.STATUS_COMPLETED)
+        buffer.update_workflow_state(self.jobs[1], SubJob.STATUS_COMPLETED)
+        SubJob.objects.get(pk=self.jobs[1].pk).update_workflow_state(SubJob.STATUS_FAILED)
+
+        self.assertEqual(buffer.flush(), 1)
+        states = self._states_in_db()
+        self.assertEqual(states[self.jobs[0].pk], SubJob.STATUS_COMPLETED)
+        self.assertEqual(states[self.jobs[1].pk], SubJob.STATUS_FAILED)
+        self.assertEqual(buffer.lost_job_ids, {self.jobs[1].pk})
+
+    def test_jobs_already_in_the_new_state_are_not_lost(self):
+        """ a job already moved to the buffered workflow_state (e.g. failed by the controller) isn't reported lost """
+        buffer = CanvasCourseGenerationJobUpdateBuffer()
+        buffer.update_workflow_state(self.jobs[0], SubJob.STATUS_FAILED)
+        buffer.update_workflow_state(self.jobs[1], SubJob.STATUS_FAILED)
+        SubJob.objects.get(pk=self.jobs[1].pk).update_workflow_state(SubJob.STATUS_FAILED)
+
+        self.assertEqual(buffer.flush(), 1)
+        states = self._states_in_db()
+        self.assertEqual(states[self.jobs[0].pk], SubJob.STATUS_FAILED)
+        self.assertEqual(states[self.jobs[1].pk], SubJob.STATUS_FAILED)
+        self.assertEqual(buffer.lost_job_ids, set())
+
+class CanvasCourseGenerationJobLeaseTests(TestCase):
+
+    def setUp(self):
+        SubJob.objects.all().delete()
+        self.jobs = [_create_subjob(index, sis_course_id=str(index), workflow_state=SubJob.STATUS_QUEUED)
+                     for index in range(1, 6)]
+
+    def tearDown(self):
+        SubJob.objects.all().delete()
+
+    def test_workers_claim_different_jobs(self):
+        """ jobs leased to one worker shouldn't be claimed by another """
+        first = SubJob.objects.claim_jobs('host1:1', 3, workflow_state=SubJob.STATUS_QUEUED)
+        second = SubJob.objects.claim_jobs('host2:1', 3, workflow_state=SubJob.STATUS_QUEUED)
+        self.assertEqual([job.pk for job in first], [job.pk for job in self.jobs[:3]])
+        self.assertEqual([job.pk for job in second], [job.pk for job in self.jobs[3:]])
+        self.assertTrue(all(job.lease_owner == 'host1:1' and job.lease_expires_at for job in first))
+        self.assertEqual(SubJob.objects.claim_jobs('host3:1', 3, workflow_state=SubJob.STATUS_QUEUED), [])
+
+    def test_claim_after_pk(self):
+        """ only jobs after after_pk should be claimed """
+        claimed = SubJob.objects.claim_jobs('host1:1', 10, after_pk=self.jobs[2].pk)
+        self.assertEqual([job.pk for job in claimed], [job.pk for job in self.jobs[3:]])
+
+    def test_expired_leases_are_reclaimed(self):
+        """ the jobs of a worker whose lease has run out should be claimable by other workers """
+        SubJob.objects.claim_jobs('host1:1', 5, lease_seconds=-1)
+        claimed = SubJob.objects.claim_jobs('host2:1', 5)
+        self.assertEqual(len(claimed), 5)
+        self.assertTrue(all(job.lease_owner == 'host2:1' for job in claimed))
+
+    def test_released_jobs_can_be_claimed(self):
+        """ releasing a worker's jobs should make them available again, but not jobs leased to other workers """
+        claimed = SubJob.objects.claim_jobs('host1:1', 5)
+        SubJob.objects.release_jobs('host2:1', claimed)
+        self.assertEqual(SubJob.objects.claim_jobs('host2:1', 5), [])
+        SubJob.objects.release_jobs('host1:1', claimed)
+        self.assertEqual(len(SubJob.objects.claim_jobs('host2:1', 5)), 5)
+
+    def test_renewed_leases_are_not_reclaimed(self):
+        """ renewing a worker's leases should keep its jobs from other workers, unless they have been taken over """
+        claimed = SubJob.objects.claim_jobs('host1:1', 5, lease_seconds=-1)
+        taken_over = SubJob.objects.claim_jobs('host2:1', 1, lease_seconds=300)
+        held = SubJob.objects.renew_leases('host1:1', claimed, lease_seconds=300)
+        self.assertEqual([job.pk for job in held], [job.pk for job in self.jobs[1:]])
+        self.assertEqual(SubJob.objects.claim_jobs('host3:1', 5), [])
+        self.assertEqual(SubJob.objects.get(pk=taken_over[0].pk).lease_owner, 'host2:1')
+
+
+class CanvasCourseGenerationJobTransitionTests(TestCase):
+
+    def setUp(self):
+        self.job = _create_subjob(1, workflow_state=SubJob.STATUS_QUEUED, bulk_job_id=None)
+
+    def tearDown(self):
+        SubJob.objects.all().delete()
+
+    def test_only_one_worker_moves_the_job(self):
+        """ only the first of two copies of a job should move it on """
+        other_copy = SubJob.objects.get(pk=self.job.pk)
+        self.assertTrue(self.job.update_workflow_state(SubJob.STATUS_COMPLETED))
+        self.assertFalse(other_copy.update_workflow_state(SubJob.STATUS_FAILED))
+        self.assertEqual(SubJob.objects.get(pk=self.job.pk).workflow_state, SubJob.STATUS_COMPLETED)
+
+    def test_invalid_transition(self):
+        """ a transition which isn't in ALLOWED_TRANSITIONS should be refused """
+        with self.assertRaises(InvalidWorkflowStateTransition):
+            self.job.update_workflow_state(SubJob.STATUS_FINALIZED, raise_exception=True)
+        self.assertFalse(self.job.update_workflow_state(SubJob.STATUS_FINALIZED))
+        self.assertEqual(SubJob.objects.get(pk=self.job.pk).workflow_state, SubJob.STATUS_QUEUED)
+
+
+class CanvasCourseGenerationJobTransitionLogTests(TestCase):
+
+    def setUp(self):
+        self.jobs = [_create_subjob(index, workflow_state=SubJob.STATUS_QUEUED, bulk_job_id=None)
+                     for index in range(1, 3)]
+
+    def tearDown(self):
+        SubJob.objects.all().delete()
+        JobTransition.objects.all().delete()
+
+    def test_transition_is_logged(self):
+        """ a state change should add an event saying who made it and how long the job spent in the old state """
+        self.jobs[0].update_workflow_state(SubJob.STATUS_COMPLETED)
+        event = JobTransition.objects.get(job_id=self.jobs[0].pk)
+        self.assertEqual((event.from_state, event.to_state), (SubJob.STATUS_QUEUED, SubJob.STATUS_COMPLETED))
+        self.assertTrue(event.worker)
+        self.assertGreaterEqual(event.duration_seconds, 0)
+
+    def test_buffered_transitions_are_logged_together(self):
+        """ buffered state changes should be logged when the buffer is flushed, one event per change """
+        with CanvasCourseGenerationJobUpdateBuffer() as buffer:
+            for job in self.jobs:
+                buffer.update_workflow_state(job, SubJob.STATUS_FAILED)
+            self.assertFalse(JobTransition.objects.exists())
+        self.assertEqual(
+            sorted(JobTransition.objects.values_list('job_id', 'from_state', 'to_state')),
+            [(job.pk, SubJob.STATUS_QUEUED, SubJob.STATUS_FAILED) for job in self.jobs]
+        )
+
+    def test_lost_transitions_are_not_logged(self):
+        """ a change which another worker beat us to shouldn't be logged """
+        other_copy = SubJob.objects.get(pk=self.jobs[0].pk)
+        self.jobs[0].update_workflow_state(SubJob.STATUS_FAILED)
+        other_copy.update_workflow_state(SubJob.STATUS_COMPLETED)
+        self.assertEqual(JobTransition.objects.filter(job_id=self.jobs[0].pk).count(), 1)
+
+
+class CanvasCourseGenerationJobStageTimestampTests(TestCase):
+
+    def setUp(self):
+        self.jobs = [_create_subjob(index, workflow_state=SubJob.STATUS_QUEUED, bulk_job_id=None)
+                     for index in range(1, 3)]
+
+    def tearDown(self):
+        SubJob.objects.all().delete()
+        JobTransition.objects.all().delete()
+
+    def test_transition_stamps_stage_and_updated_at(self):
+        """ moving a job to a new stage should record when it got there, and move updated_at on """
+        updated_at = SubJob.objects.get(pk=self.jobs[0].pk).updated_at
+        self.jobs[0].update_workflow_state(SubJob.STATUS_COMPLETED)
+        job = SubJob.objects.get(pk=self.jobs[0].pk)
+        self.assertIsNotNone(job.migration_completed_at)
+        self.assertGreaterEqual(job.updated_at, updated_at)
+        self.assertIsNone(job.finalized_at)
+
+    def test_buffered_transitions_stamp_stages(self):
+        """ buffered state changes should stamp the stage reached when the buffer is flushed """
+        with CanvasCourseGenerationJobUpdateBuffer() as buffer:
+            for job in self.jobs:
+                buffer.update_workflow_state(job, SubJob.STATUS_COMPLETED)
+        self.assertFalse(SubJob.objects.filter(pk__in=[job.pk for job in self.jobs],
+                                               migration_completed_at__isnull=True).exists())
+
+    def test_setup_started_is_only_stamped_once(self):
+        """ mark_setup_started shouldn't move the setup start of a job which was already set up once """
+        SubJob.objects.mark_setup_started(self.jobs[:1])
+        setup_started_at = SubJob.objects.get(pk=self.jobs[0].pk).setup_started_at
+        self.assertIsNotNone(setup_started_at)
+        SubJob.objects.mark_setup_started(self.jobs)
+        self.assertEqual(SubJob.objects.get(pk=self.jobs[0].pk).setup_started_at, setup_started_at)
+        self.assertIsNotNone(SubJob.objects.get(pk=self.jobs[1].pk).setup_started_at)
+
+
+class CanvasCourseGenerationJobStalledTests(TestCase):
+
+    def setUp(self):
+        self.queued_job = _create_subjob(1, workflow_state=SubJob.STATUS_QUEUED, bulk_job_id=None)
+        self.completed_job = _create_subjob(2, workflow_state=SubJob.STATUS_COMPLETED, bulk_job_id=None)
+        # update() leaves updated_at alone
+        SubJob.objects.all().update(updated_at=timezone.now() - timedelta(minutes=60))
+
+    def tearDown(self):
+        SubJob.objects.all().delete()
+
+    def test_stalled_jobs_use_per_state_thresholds(self):
+        """ a job should only be stalled once it has gone without progress for longer than its state's threshold """
+        stalled = SubJob.objects.get_stalled_jobs({SubJob.STATUS_QUEUED: 120, SubJob.STATUS_COMPLETED: 30})
+        self.assertEqual(list(stalled), [self.completed_job])
+
+    def test_progress_unstalls_job(self):
+        """ moving a job on should reset its clock """
+        self.completed_job.update_workflow_state(SubJob.STATUS_FINALIZED)
+        self.assertFalse(SubJob.objects.get_stalled_jobs({SubJob.STATUS_FINALIZED: 30}).exists())
+
+
+class BulkCanvasCourseCreationJobStartFinalizingTests(TestCase):
+
+    def tearDown(self):
+        BulkJob.objects.all().delete()
+
+    def test_only_one_worker_starts_finalizing(self):
+        """ only the first of two copies of a pending job should move it to FINALIZING """
+        job = _create_bulk_job(status=BulkJob.STATUS_PENDING)
+        other_copy = BulkJob.objects.get(pk=job.pk)
+        self.assertTrue(job.start_finalizing())
+        self.assertEqual(job.status, BulkJob.STATUS_FINALIZING)
+        self.assertFalse(other_copy.start_finalizing())
+        self.assertEqual(other_copy.status, BulkJob.STATUS_PENDING)
+
+    def test_invalid_status_transition(self):
+        """ a pending job can't skip straight to a notification status """
+        job = _create_bulk_job(status=BulkJob.STATUS_PENDING)
+        self.assertFalse(job.update_status(BulkJob.STATUS_NOTIFICATION_SUCCESSFUL))
+        self.assertEqual(BulkJob.objects.get(pk=job.pk).status, BulkJob.STATUS_PENDING)
+
+
+class BulkCanvasCourseCreationJobProgressTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.bulk_job = _create_bulk_job(status=BulkJob.STATUS_PENDING)
+
+    def tearDown(self):
+        BulkJob.objects.all().delete()
+        SubJob.objects.all().delete()
+
+    def test_get_progress(self):
+        """ the progress should report the subjob counters, which saving the subjobs keeps up to date """
+        for workflow_state in (SubJob.STATUS_FINALIZED, SubJob.STATUS_FINALIZED, SubJob.STATUS_FAILED):
+            _create_subjob(1, workflow_state=workflow_state, bulk_job_id=self.bulk_job.pk)
+        _create_subjob(1, workflow_state=SubJob.STATUS_RUNNING, bulk_job_id=self.bulk_job.pk)
+        _create_subjob(1, bulk_job_id=self.bulk_job.pk + 1)
+        self.bulk_job.refresh_from_db()
+        progress = self.bulk_job.get_progress()
+        self.assertEqual(
+            (progress['subjobs_total'], progress['subjobs_setup'], progress['subjobs_in_flight'],
+             progress['subjobs_finalized'], progress['subjobs_failed']),
+            (4, 0, 1, 2, 1)
+        )
+        self.assertEqual(progress['percent_complete'], 75)
+        self.assertFalse(progress['finished'])
+
+    def test_subjob_state_changes_move_counters(self):
+        """ saved and buffered subjob state changes should move the subjob between the bulk job's counters """
+        subjob = _create_subjob(1, bulk_job_id=self.bulk_job.pk)
+        subjob.update_workflow_state(SubJob.STATUS_QUEUED)
+        with CanvasCourseGenerationJobUpdateBuffer() as job_updates:
+            job_updates.update_workflow_state(subjob, SubJob.STATUS_RUNNING)
+            job_updates.update_workflow_state(subjob, SubJob.STATUS_COMPLETED)
+            job_updates.update_workflow_state(subjob, SubJob.STATUS_FINALIZED)
+        self.bulk_job.refresh_from_db()
+        self.assertEqual(
+            (self.bulk_job.subjobs_total, self.bulk_job.subjobs_setup, self.bulk_job.subjobs_in_flight,
+             self.bulk_job.subjobs_finalized),
+            (1, 0, 0, 1)
+        )
+
+    def test_subjob_counters_are_updated_in_bulk_job_order(self):
+        """ the bulk jobs' counters should be updated in id order, whatever order the changes come in """
+        other_bulk_job = _create_bulk_job(status=BulkJob.STATUS_PENDING)
+        with patch.object(BulkJob.objects, 'filter', wraps=BulkJob.objects.filter) as m_filter:
+            record_subjob_state_changes([(other_bulk_job.pk, SubJob.STATUS_QUEUED, SubJob.STATUS_RUNNING),
+                                         (self.bulk_job.pk, SubJob.STATUS_QUEUED, SubJob.STATUS_FAILED)])
+        self.assertEqual([c[1]['pk'] for c in m_filter.call_args_list], [self.bulk_job.pk, other_bulk_job.pk])
+
+    def test_rebuild_subjob_counters(self):
+        """ rebuilding the counters should recount the subjobs, whatever the counters said before """
+        _create_subjob(1, workflow_state=SubJob.STATUS_FINALIZED, bulk_job_id=self.bulk_job.pk)
+        SubJob.objects.filter(bulk_job_id=self.bulk_job.pk).update(workflow_state=SubJob.STATUS_FINALIZE_FAILED)
+        BulkJob.objects.filter(pk=self.bulk_job.pk).update(subjobs_setup=5)
+        self.assertEqual(BulkJob.objects.rebuild_subjob_counters([self.bulk_job.pk]), 1)
+        self.bulk_job.refresh_from_db()
+        self.assertEqual(
+            (self.bulk_job.subjobs_total, self.bulk_job.subjobs_setup, self.bulk_job.subjobs_finalized,
+             self.bulk_job.subjobs_failed),
+            (1, 0, 0, 1)
+        )
+
+    def test_subjob_state_changes_change_progress_version(self):
+        """ saving or buffering a subjob's state change should change the bulk job's progress version """
+        subjob = _create_subjob(1, bulk_job_id=self.bulk_job.pk)
+        version = get_bulk_job_progress_version(self.bulk_job.pk)
+        subjob.update_workflow_state(SubJob.STATUS_QUEUED)
+        self.assertNotEqual(get_bulk_job_progress_version(self.bulk_job.pk), version)
+
+        version = get_bulk_job_progress_version(self.bulk_job.pk)
+        with CanvasCourseGenerationJobUpdateBuffer() as job_updates:
+            job_updates.update_workflow_state(subjob, SubJob.STATUS_RUNNING)
+            self.assertEqual(get_bulk_job_progress_version(self.bulk_job.pk), version)
+        self.assertNotEqual(get_bulk_job_progress_version(self.bulk_job.pk), version)
+
+    def test_bulk_job_status_changes_change_progress_version(self):
+        """ a change to the bulk job's status should change its progress version """
+        version = get_bulk_job_progress_version(self.bulk_job.pk)
+        self.bulk_job.start_finalizing()
+        self.assertNotEqual(get_bulk_job_progress_version(self.bulk_job.pk), version)
+
+
 class BulkCanvasCourseCreationJobTests(TestCase):
 
     def setUp(self):
@@ -254,14 +661,15 @@ class BulkCanvasCourseCreationJobTests(TestCase):
         job = [j for j in BulkJob.objects.filter(status=BulkJob.STATUS_NOTIFICATION_SUCCESSFUL)][0]
         self.assertEqual(job.status_display_name, 'Complete')
 
-    @patch('icommons_common.models.CourseInstance.objects.filter')
-    def test_create_bulk_job_for_filter(self, ci_filter_mock):
+    @patch('canvas_course_site_wizard.models.iter_course_instance_id_chunks')
+    @patch('canvas_course_site_wizard.models.get_eligible_course_instances')
+    def test_create_bulk_job_for_filter(self, eligible_mock, chunks_mock):
         school_id = 'colgsas'
         sis_term_id = 1111
         sis_department_id = 1111
         created_by_user_id = '10564158'
         course_instance_ids = [1, 2, 3]
-        ci_filter_mock.return_value = Mock(**{'values_list.return_value': course_instance_ids})
+        chunks_mock.return_value = iter([[1, 2], [3]])
 
         bulk_job = BulkJob.objects.create_bulk_job(
             school_id=school_id,
@@ -269,13 +677,15 @@ class BulkCanvasCourseCreationJobTests(TestCase):
             sis_department_id=sis_department_id,
             created_by_user_id=created_by_user_id
         )
-        ci_filter_mock.assert_called_with(
-            exclude_from_isites=0,
-            canvas_course_id__isnull=True,
-            term_id=sis_term_id,
-            course__school=school_id,
-            course__departments=sis_department_id
+        eligible_mock.assert_called_with(
+            sis_term_id,
+            school_id=school_id,
+            sis_department_id=sis_department_id,
+            sis_course_group_id=None
         )
+        chunks_mock.assert_called_once_with(eligible_mock.return_value, chunk_size=ANY)
+        self.assertEqual(bulk_job.ingestion_counts, {'inserted': 3, 'skipped': 0, 'duplicates': 0})
+        self.assertEqual((bulk_job.subjobs_total, bulk_job.subjobs_setup), (3, 3))
         self.assertEqual(bulk_job.status, BulkJob.STATUS_PENDING)
         self.assertEqual(bulk_job.school_id, school_id)
         self.assertEqual(bulk_job.sis_term_id, sis_term_id)
@@ -291,6 +701,29 @@ class BulkCanvasCourseCreationJobTests(TestCase):
             self.assertEqual(course_job.created_by_user_id, created_by_user_id)
             self.assertEqual(course_job.workflow_state, SubJob.STATUS_SETUP)
 
+    @override_settings(BULK_COURSE_CREATION={'job_creation_batch_size': 2})
+    def test_create_bulk_job_skips_existing_jobs_and_duplicates(self):
+        """ courses with an active or finalized job, and repeated ids, should not get another subjob """
+        created_by_user_id = '10564158'
+        self.addCleanup(SubJob.objects.filter(sis_course_id__in=['91', '92', '93', '94', '95']).delete)
+        SubJob.objects.create(sis_course_id='91', created_by_user_id=created_by_user_id,
+                              workflow_state=SubJob.STATUS_QUEUED)
+        SubJob.objects.create(sis_course_id='92', created_by_user_id=created_by_user_id,
+                              workflow_state=SubJob.STATUS_FINALIZED)
+        # a course whose earlier job failed may be tried again
+        SubJob.objects.create(sis_course_id='93', created_by_user_id=created_by_user_id,
+                              workflow_state=SubJob.STATUS_FAILED)
+
+        bulk_job = BulkJob.objects.create_bulk_job(
+            school_id='colgsas',
+            sis_term_id=1111,
+            created_by_user_id=created_by_user_id,
+            course_instance_ids=[91, 92, 93, 94, 94, 95]
+        )
+        self.assertEqual(bulk_job.ingestion_counts, {'inserted': 3, 'skipped': 2, 'duplicates': 1})
+        self.assertEqual(sorted(SubJob.objects.filter(bulk_job_id=bulk_job.id).values_list('sis_course_id', flat=True)),
+                         ['93', '94', '95'])
+
     def test_create_bulk_job_for_course_instance_ids(self):
         school_id = 'colgsas'
         sis_term_id = 1111
@@ -319,3 +752,43 @@ class BulkCanvasCourseCreationJobTests(TestCase):
             self.assertEqual(course_job.bulk_job_id, bulk_job.id)
             self.assertEqual(course_job.created_by_user_id, created_by_user_id)
             self.assertEqual(course_job.workflow_state, SubJob.STATUS_SETUP)
+
+
+class FakeCourseInstanceQuerySet(object):
+    """ Stands in for a CourseInstance queryset in iter_course_instance_id_chunks, recording the queries made """
+    def __init__(self, ids, queries=None, after_id=None):
+        self.ids = sorted(ids)
+        self.queries = [] if queries is None else queries
+        self.after_id = after_id
+
+    def order_by(self, *fields):
+        return self
+
+    def filter(self, course_instance_id__gt):
+        return FakeCourseInstanceQuerySet(self.ids, self.queries, course_instance_id__gt)
+
+    def values_list(self, *fields, **kwargs):
+        return self
+
+    def __getitem__(self, chunk):
+        self.queries.append(self.after_id)
+        return [i for i in self.ids if self.after_id is None or i > self.after_id][chunk]
+
+
+class IterCourseInstanceIdChunksTests(TestCase):
+
+    def test_chunks_are_read_with_keyset_pagination(self):
+        """ each chunk should be read after the last id of the previous one, stopping at a short chunk """
+        queryset = FakeCourseInstanceQuerySet([5, 3, 9, 1, 7])
+        self.assertEqual(list(iter_course_instance_id_chunks(queryset, chunk_size=2)), [[1, 3], [5, 7], [9]])
+        self.assertEqual(queryset.queries, [None, 3, 7])
+
+    def test_no_chunks_for_empty_queryset(self):
+        queryset = FakeCourseInstanceQuerySet([])
+        self.assertEqual(list(iter_course_instance_id_chunks(queryset, chunk_size=2)), [])
+
+    def test_exact_multiple_of_chunk_size(self):
+        """ a final empty read should end the iteration when the ids fill the last chunk exactly """
+        queryset = FakeCourseInstanceQuerySet([1, 2, 3, 4])
+        self.assertEqual(list(iter_course_instance_id_chunks(queryset, chunk_size=2)), [[1, 2], [3, 4]])
+        self.assertEqual(queryset.queries, [None, 2, 4])
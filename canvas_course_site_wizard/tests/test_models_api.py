@@ -1,7 +1,8 @@
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 from django.test import TestCase
 
-from mock import patch
+from mock import patch, Mock
 
 from canvas_course_site_wizard.exceptions import MultipleDefaultTemplatesExistForSchool, NoTemplateExistsForSchool
 from canvas_course_site_wizard.models_api import (
@@ -9,7 +10,10 @@ from canvas_course_site_wizard.models_api import (
     get_courses_for_term,
     get_bulk_job_records_for_term,
     select_courses_for_bulk_create,
-    get_course_generation_data_for_sis_course_id
+    get_course_generation_data_for_sis_course_id,
+    get_course_data_for_sis_course_ids,
+    get_term_course_counts,
+    invalidate_term_course_counts
 )
 from canvas_course_site_wizard.models import CanvasSchoolTemplate
 from .setup_bulk_jobs import create_jobs
@@ -81,4 +85,36 @@ class ModelsApiTest(TestCase):
         mock_ci.assert_called_once_with(bulk_job_id=self.bulk_job_id, sis_course_id=self.sis_course_id)
 
 
+    @patch('canvas_course_site_wizard.models_api.SISCourseData.objects.select_related')
+    def test_get_course_data_for_sis_course_ids_loads_in_chunks(self, mock_select_related):
+        """
+        Test that get_course_data_for_sis_course_ids loads the course data (with course and term) in chunks
+        and maps it by sis course id
+        """
+        sis_course_ids = [1, 2, 3, '3', 4, 5]
+        mock_select_related.return_value.filter.side_effect = lambda pk__in: [Mock(pk=int(pk)) for pk in pk__in]
+
+        result = get_course_data_for_sis_course_ids(sis_course_ids, chunk_size=2)
+        mock_select_related.assert_called_with('course', 'term')
+        # five distinct ids in chunks of two
+        self.assertEqual(mock_select_related.return_value.filter.call_count, 3)
+        self.assertEqual(sorted(result.keys()), ['1', '2', '3', '4', '5'])
+        self.assertEqual(result['4'].pk, 4)
+
     #TODO: once we figure out how to deal with legacy data, we can add integration tests for retrieving course data
+
+    @patch('canvas_course_site_wizard.models_api.CourseInstance.objects.filter')
+    def test_get_term_course_counts_uses_one_cached_query(self, mock_filter):
+        """ all of the counts should come from one aggregate query, which is cached until invalidated """
+        cache.clear()
+        counts = {'total_courses': 10, 'canvas_courses': 4, 'isites_courses': 3, 'not_created': 5}
+        mock_filter.return_value.aggregate.return_value = counts
+        self.assertEqual(get_term_course_counts(self.term_id), counts)
+        self.assertEqual(get_term_course_counts(self.term_id), counts)
+        mock_filter.assert_called_once_with(term__term_id=self.term_id)
+        self.assertEqual(mock_filter.return_value.aggregate.call_count, 1)
+        self.assertEqual(set(mock_filter.return_value.aggregate.call_args[1]), set(counts))
+
+        invalidate_term_course_counts(self.term_id)
+        get_term_course_counts(self.term_id)
+        self.assertEqual(mock_filter.return_value.aggregate.call_count, 2)
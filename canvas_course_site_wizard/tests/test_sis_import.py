@@ -0,0 +1,127 @@
+import csv
+import io
+import zipfile
+from itertools import count
+from unittest import TestCase
+
+from mock import patch, Mock
+from django.test.utils import override_settings
+
+from canvas_course_site_wizard.exceptions import CanvasSISImportError
+from canvas_course_site_wizard.sis_import import (create_canvas_courses_with_sis_import,
+                                                  build_sis_import_zip,
+                                                  wait_for_sis_import)
+
+
+class FakeSISImportEndpoint(object):
+    """
+    Local stand-in for the Canvas SIS import and account course list endpoints, used in place of the SDK client.
+    Courses in an uploaded courses.csv are 'created' (given Canvas ids) once the import has been polled through
+    the given workflow states; course_ids_to_skip are left out, as if Canvas had rejected their rows.
+    """
+    def __init__(self, workflow_states=('created', 'importing', 'imported'), course_ids_to_skip=(), page_size=2):
+        self.workflow_states = list(workflow_states)
+        self.course_ids_to_skip = set(course_ids_to_skip)
+        self.page_size = page_size
+        self.uploads = []
+        self.courses = []
+        self._canvas_course_ids = count(1000)
+
+    def post(self, request_ctx, url, payload=None, files=None, **kwargs):
+        assert url.endswith('/sis_imports')
+        assert payload == {'import_type': 'instructure_csv', 'extension': 'zip'}
+        self.uploads.append(files['attachment'][1])
+        return Mock(json=Mock(return_value={'id': len(self.uploads), 'workflow_state': 'created'}))
+
+    def get(self, request_ctx, url, **kwargs):
+        if '/sis_imports/' in url:
+            workflow_state = self.workflow_states.pop(0) if len(self.workflow_states) > 1 else self.workflow_states[0]
+            if workflow_state.startswith('imported'):
+                self._create_courses()
+            return Mock(json=Mock(return_value={'id': 1, 'workflow_state': workflow_state, 'progress': 50}))
+        # account course list, paginated with a 'page' parameter
+        page = int(url.split('&page=')[1]) if '&page=' in url else 0
+        courses = self.courses[page * self.page_size:(page + 1) * self.page_size]
+        has_next = (page + 1) * self.page_size < len(self.courses)
+        links = {'next': {'url': '%s&page=%d' % (url.split('&page=')[0], page + 1)}} if has_next else {}
+        return Mock(json=Mock(return_value=courses), links=links)
+
+    def _create_courses(self):
+        if self.courses:
+            return
+        rows = read_csv(self.uploads[-1], 'courses.csv')
+        self.courses = [{'id': next(self._canvas_course_ids), 'sis_course_id': row['course_id']}
+                        for row in rows if row['course_id'] not in self.course_ids_to_skip]
+
+
+def read_csv(zip_data, name):
+    with zipfile.ZipFile(io.BytesIO(zip_data)) as zip_file:
+        return list(csv.DictReader(io.StringIO(zip_file.read(name).decode())))
+
+
+def get_mock_course_data(sis_course_id):
+    return Mock(pk=sis_course_id, course_code='CS %s' % sis_course_id, course_name='Course %s' % sis_course_id,
+                sis_account_id='dept:150', sis_term_id='2015-1',
+                primary_section_name=Mock(return_value='COLGSAS CS %s' % sis_course_id))
+
+
+@override_settings(SIS_IMPORT_POLL_INTERVAL=0)
+@patch('canvas_course_site_wizard.sis_import.time.sleep')
+class SISImportTest(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.course_data_list = [get_mock_course_data(sis_course_id) for sis_course_id in (101, 102, 103)]
+
+    def test_build_sis_import_zip(self, m_sleep):
+        """ the zip should hold a course, and a section with the same SIS id, for each course """
+        zip_data = build_sis_import_zip(self.course_data_list)
+        courses = read_csv(zip_data, 'courses.csv')
+        sections = read_csv(zip_data, 'sections.csv')
+        self.assertEqual([c['course_id'] for c in courses], ['101', '102', '103'])
+        self.assertEqual(courses[0], {'course_id': '101', 'short_name': 'CS 101', 'long_name': 'Course 101',
+                                      'account_id': 'dept:150', 'term_id': '2015-1', 'status': 'active'})
+        self.assertEqual(sections[0], {'section_id': '101', 'course_id': '101', 'name': 'COLGSAS CS 101',
+                                       'status': 'active'})
+
+    def test_create_canvas_courses_with_sis_import(self, m_sleep):
+        """ courses should be created with one import, and their Canvas ids looked up across pages """
+        endpoint = FakeSISImportEndpoint()
+        with patch('canvas_course_site_wizard.sis_import.client', endpoint):
+            result = create_canvas_courses_with_sis_import(self.course_data_list)
+        self.assertEqual(len(endpoint.uploads), 1)
+        self.assertEqual(result, {'101': 1000, '102': 1001, '103': 1002})
+
+    def test_create_canvas_courses_with_sis_import_leaves_out_rejected_courses(self, m_sleep):
+        """ courses which the import did not create should be left out of the result """
+        endpoint = FakeSISImportEndpoint(workflow_states=('imported_with_messages',), course_ids_to_skip=('102',))
+        with patch('canvas_course_site_wizard.sis_import.client', endpoint):
+            result = create_canvas_courses_with_sis_import(self.course_data_list)
+        self.assertEqual(set(result), {'101', '103'})
+
+    def test_create_canvas_courses_with_sis_import_raises_on_failed_import(self, m_sleep):
+        """ a failed import should raise CanvasSISImportError """
+        endpoint = FakeSISImportEndpoint(workflow_states=('importing', 'failed_with_messages'))
+        with patch('canvas_course_site_wizard.sis_import.client', endpoint):
+            self.assertRaises(CanvasSISImportError, create_canvas_courses_with_sis_import, self.course_data_list)
+
+    def test_create_canvas_courses_with_sis_import_raises_on_failed_upload(self, m_sleep):
+        """ an import which can't be submitted should raise CanvasSISImportError """
+        endpoint = FakeSISImportEndpoint()
+        endpoint.post = Mock(side_effect=Exception)
+        with patch('canvas_course_site_wizard.sis_import.client', endpoint):
+            self.assertRaises(CanvasSISImportError, create_canvas_courses_with_sis_import, self.course_data_list)
+
+    def test_wait_for_sis_import_times_out(self, m_sleep):
+        """ an import which doesn't finish in time should raise CanvasSISImportError """
+        endpoint = FakeSISImportEndpoint(workflow_states=('importing',))
+        with patch('canvas_course_site_wizard.sis_import.client', endpoint):
+            self.assertRaises(CanvasSISImportError, wait_for_sis_import, 1, poll_interval=0, timeout=0)
+
+    def test_wait_for_sis_import_calls_on_poll_each_check(self, m_sleep):
+        """ on_poll should be called every time the import's progress is checked """
+        endpoint = FakeSISImportEndpoint(workflow_states=('created', 'importing', 'imported'))
+        on_poll = Mock()
+        with patch('canvas_course_site_wizard.sis_import.client', endpoint):
+            wait_for_sis_import(1, on_poll=on_poll)
+        self.assertEqual(on_poll.call_count, 3)
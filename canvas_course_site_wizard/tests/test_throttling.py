@@ -0,0 +1,95 @@
+from unittest import TestCase
+
+from django.core.cache import cache
+from django.test.utils import override_settings
+from mock import patch, Mock
+
+from canvas_course_site_wizard.throttling import CanvasRateLimitBucket, ThrottlingHTTPAdapter
+
+
+@override_settings(CANVAS_RATE_LIMIT={'capacity': 700, 'leak_rate': 10, 'slowdown_threshold': 0.5})
+@patch('canvas_course_site_wizard.throttling.time')
+class CanvasRateLimitBucketTest(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        cache.clear()
+
+    def test_no_delay_while_quota_is_above_threshold(self, m_time):
+        """ requests shouldn't be slowed down while plenty of quota remains """
+        m_time.time.return_value = 1000.0
+        bucket = CanvasRateLimitBucket('canvas.example.edu:abc')
+        bucket.update({'X-Rate-Limit-Remaining': '600', 'X-Request-Cost': '1'})
+        self.assertEqual(bucket.acquire(), 0.0)
+        self.assertFalse(m_time.sleep.called)
+
+    def test_delay_rises_smoothly_as_quota_runs_out(self, m_time):
+        """ the delay should grow steadily (without jumps) as the remaining quota falls """
+        bucket = CanvasRateLimitBucket('canvas.example.edu:abc')
+        delays = [bucket.get_delay(remaining, 10.0) for remaining in (350, 300, 200, 100, 0, -10, -100)]
+        self.assertEqual(delays[0], 0.0)
+        self.assertEqual(delays, sorted(delays))
+        self.assertAlmostEqual(bucket.get_delay(0.0, 10.0), bucket.get_delay(-0.0001, 10.0), places=3)
+
+    def test_low_quota_is_shared_and_slows_down_callers(self, m_time):
+        """ a low quota reported to one bucket should slow down other callers sharing the same key """
+        m_time.time.return_value = 1000.0
+        CanvasRateLimitBucket('canvas.example.edu:abc').update(
+            {'X-Rate-Limit-Remaining': '20', 'X-Request-Cost': '5'})
+        delay = CanvasRateLimitBucket('canvas.example.edu:abc').acquire()
+        self.assertGreater(delay, 0)
+        m_time.sleep.assert_called_once_with(delay)
+        # a different access token has its own bucket
+        self.assertEqual(CanvasRateLimitBucket('canvas.example.edu:def').acquire(), 0.0)
+
+    def test_quota_is_restored_over_time(self, m_time):
+        """ the estimated quota should refill at the leak rate between responses """
+        m_time.time.return_value = 1000.0
+        bucket = CanvasRateLimitBucket('canvas.example.edu:abc')
+        bucket.update({'X-Rate-Limit-Remaining': '0'})
+        m_time.time.return_value = 1060.0
+        self.assertEqual(bucket.acquire(), 0.0)
+
+    def test_reservations_wait_for_the_lock_on_the_shared_state(self, m_time):
+        """ a caller should wait while another holds the lock, then reserve from the state that caller left """
+        m_time.time.return_value = 1000.0
+        bucket = CanvasRateLimitBucket('canvas.example.edu:abc')
+        bucket.update({'X-Rate-Limit-Remaining': '600', 'X-Request-Cost': '1'})
+        lock_key = '%s:lock' % bucket.cache_key
+        cache.add(lock_key, 'other caller')
+
+        def other_caller_finishes(seconds):
+            # the other caller reserves its request, then lets go of the lock
+            cache.set(bucket.cache_key, dict(cache.get(bucket.cache_key), remaining=599.0))
+            cache.delete(lock_key)
+        m_time.sleep.side_effect = other_caller_finishes
+
+        bucket.acquire()
+        self.assertEqual(m_time.sleep.call_count, 1)
+        self.assertEqual(cache.get(bucket.cache_key)['remaining'], 598.0)
+        self.assertIsNone(cache.get(lock_key))
+
+
+@patch('canvas_course_site_wizard.throttling.HTTPAdapter.send')
+class ThrottlingHTTPAdapterTest(TestCase):
+    longMessage = True
+
+    def test_throttled_requests_are_retried(self, m_send):
+        """ a request throttled by Canvas should be retried after backing off """
+        throttled = Mock(status_code=403, text='403 Forbidden (Rate Limit Exceeded)', headers={})
+        ok = Mock(status_code=200, text='{}', headers={'X-Rate-Limit-Remaining': '100'})
+        m_send.side_effect = [throttled, ok]
+        bucket = Mock()
+        adapter = ThrottlingHTTPAdapter(bucket, max_retries=3)
+        self.assertEqual(adapter.send(Mock()), ok)
+        self.assertEqual(bucket.acquire.call_count, 2)
+        bucket.exhausted.assert_called_once_with()
+        bucket.update.assert_called_with(ok.headers)
+
+    def test_gives_up_after_max_retries(self, m_send):
+        """ the throttled response should be returned once the retries are used up """
+        throttled = Mock(status_code=403, text='403 Forbidden (Rate Limit Exceeded)', headers={})
+        m_send.return_value = throttled
+        adapter = ThrottlingHTTPAdapter(Mock(), max_retries=2)
+        self.assertEqual(adapter.send(Mock()), throttled)
+        self.assertEqual(m_send.call_count, 3)
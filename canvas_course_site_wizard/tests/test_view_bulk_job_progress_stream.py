@@ -0,0 +1,110 @@
+import json
+
+from django.core.cache import cache
+from django.http import Http404
+from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings
+from mock import patch, Mock
+
+from canvas_course_site_wizard.models import BulkCanvasCourseCreationJob as BulkJob
+from canvas_course_site_wizard.views import BulkJobProgressStreamView, _bulk_job_progress_events
+
+
+def parse_events(chunks):
+    """ returns the (event, data) pairs in the stream, leaving out comments and the retry interval """
+    events = []
+    for chunk in chunks:
+        if chunk.startswith('event:'):
+            event_line, data_line = chunk.strip().split('\n')
+            events.append((event_line[len('event: '):], json.loads(data_line[len('data: '):])))
+    return events
+
+
+@override_settings(BULK_COURSE_CREATION={'progress_stream_check_interval': 1,
+                                         'progress_stream_fallback_interval': 10,
+                                         'progress_stream_max_duration': 30})
+@patch('canvas_course_site_wizard.views.time')
+@patch('canvas_course_site_wizard.views.get_bulk_job_progress_version')
+class BulkJobProgressStreamTest(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        cache.clear()
+        self.bulk_job = Mock(pk=1)
+        self.progress = {'status': BulkJob.STATUS_PENDING, 'finished': False, 'subjobs_total': 2,
+                         'subjobs_in_flight': 2}
+        self.bulk_job.get_progress.return_value = self.progress
+        self.clock = [0]
+        self.sleeps = []
+
+    def _run(self, m_time, max_checks=100):
+        m_time.monotonic.side_effect = lambda: self.clock[0]
+
+        def sleep(seconds):
+            # each sleep moves the clock on
+            self.clock[0] += seconds
+            self.sleeps.append(seconds)
+            if len(self.sleeps) > max_checks:
+                raise AssertionError('stream did not end')
+        m_time.sleep.side_effect = sleep
+        return list(_bulk_job_progress_events(self.bulk_job))
+
+    def test_progress_is_only_read_again_when_version_changes(self, m_version, m_time):
+        """ the subjobs should only be counted again when the progress version has changed """
+        versions = iter([1, 1, 1, 2, 2])
+        finished = dict(self.progress, status=BulkJob.STATUS_NOTIFICATION_SUCCESSFUL, finished=True)
+        self.bulk_job.get_progress.side_effect = [self.progress, finished]
+        m_version.side_effect = lambda pk: next(versions)
+        events = parse_events(self._run(m_time))
+        self.assertEqual(self.bulk_job.get_progress.call_count, 2)
+        self.assertEqual([event for event, _ in events], ['progress', 'progress', 'done'])
+
+    def test_falls_back_to_reading_progress_periodically_without_version(self, m_version, m_time):
+        """ without a version in the cache the progress should be read every fallback interval """
+        m_version.return_value = None
+        events = parse_events(self._run(m_time))
+        # read at 0, 10 and 20 seconds, and the stream ends after 30 seconds
+        self.assertEqual(self.bulk_job.get_progress.call_count, 4)
+        # unchanged progress is only sent once
+        self.assertEqual(len(events), 1)
+
+    def test_stream_releases_its_slot(self, m_version, m_time):
+        """ a stream should give up its slot once it ends, so that another stream can use it """
+        m_version.return_value = 1
+        with self.settings(BULK_COURSE_CREATION={'progress_stream_check_interval': 1,
+                                                 'progress_stream_max_duration': 3,
+                                                 'progress_stream_max_concurrent': 1}):
+            self._run(m_time)
+            self.sleeps = []
+            self._run(m_time)
+        # the second stream was a full one, which checked the progress until it ended
+        self.assertEqual(len(self.sleeps), 3)
+
+    def test_streams_beyond_the_limit_send_progress_once(self, m_version, m_time):
+        """ once the limit on open streams is reached, the progress should be sent once and the stream ended """
+        m_version.return_value = 1
+        with self.settings(BULK_COURSE_CREATION={'progress_stream_fallback_interval': 10,
+                                                 'progress_stream_max_concurrent': 1}):
+            open_stream = _bulk_job_progress_events(Mock(pk=2))
+            next(open_stream)
+            chunks = self._run(m_time)
+            open_stream.close()
+        self.assertEqual(chunks[0], 'retry: 10000\n\n')
+        self.assertEqual(parse_events(chunks), [('progress', self.progress)])
+        self.assertEqual(self.sleeps, [])
+
+    def test_view_streams_events(self, m_version, m_time):
+        """ the view should return an event stream for the bulk job """
+        request = RequestFactory().get('/bulk_jobs/1/progress')
+        request.user = Mock(is_authenticated=True)
+        with patch('canvas_course_site_wizard.views.BulkCanvasCourseCreationJob.objects.get') as m_get:
+            m_get.return_value = self.bulk_job
+            response = BulkJobProgressStreamView.as_view()(request, pk='1')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+
+    def test_view_unknown_bulk_job(self, m_version, m_time):
+        """ a bulk job which doesn't exist should give a 404 """
+        request = RequestFactory().get('/bulk_jobs/0/progress')
+        request.user = Mock(is_authenticated=True)
+        self.assertRaises(Http404, BulkJobProgressStreamView.as_view(), request, pk='0')
@@ -0,0 +1,65 @@
+import json
+
+from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings
+from mock import Mock
+
+from canvas_course_site_wizard.models import CanvasCourseGenerationJob
+from canvas_course_site_wizard.views import CanvasCourseSiteStatusJsonView
+
+
+@override_settings(CANVAS_SITE_SETTINGS={'base_url': 'https://canvas.example.edu/'})
+class CanvasCourseSiteStatusJsonViewTest(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.view = CanvasCourseSiteStatusJsonView.as_view()
+        self.job = CanvasCourseGenerationJob.objects.create(sis_course_id='12345', created_by_user_id='123',
+                                                            canvas_course_id=678,
+                                                            workflow_state=CanvasCourseGenerationJob.STATUS_RUNNING)
+
+    def _get(self, path='/status/json', data=None, **kwargs):
+        etag = kwargs.pop('etag', None)
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        request = self.factory.get(path, data or {}, **headers)
+        request.user = Mock(is_authenticated=True)
+        return self.view(request, **kwargs)
+
+    def test_status_of_one_job(self):
+        """ the status of the job should be returned, along with an ETag """
+        response = self._get(pk=str(self.job.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['ETag'])
+        job_status, = json.loads(response.content.decode())['jobs']
+        self.assertEqual(job_status['id'], self.job.pk)
+        self.assertEqual(job_status['workflow_state'], CanvasCourseGenerationJob.STATUS_RUNNING)
+        self.assertEqual(job_status['status_display_name'], 'Running')
+        self.assertIn('678', job_status['canvas_course_url'])
+        self.assertFalse(job_status['complete'])
+
+    def test_unchanged_status_is_not_modified(self):
+        """ a request with the current ETag should get a 304 until the job's state changes """
+        etag = self._get(pk=str(self.job.pk))['ETag']
+        response = self._get(pk=str(self.job.pk), etag=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        self.job.update_workflow_state(CanvasCourseGenerationJob.STATUS_FINALIZED)
+        response = self._get(pk=str(self.job.pk), etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertTrue(json.loads(response.content.decode())['jobs'][0]['complete'])
+
+    def test_status_of_several_jobs(self):
+        """ the status of each of the jobs in job_ids should be returned """
+        other_job = CanvasCourseGenerationJob.objects.create(sis_course_id='23456', created_by_user_id='123')
+        response = self._get(data={'job_ids': '%s,%s' % (self.job.pk, other_job.pk)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([job['id'] for job in json.loads(response.content.decode())['jobs']],
+                         [self.job.pk, other_job.pk])
+
+    def test_bad_job_ids(self):
+        """ job_ids which aren't a list of ids should be rejected """
+        self.assertEqual(self._get(data={'job_ids': 'abc'}).status_code, 400)
+        self.assertEqual(self._get().status_code, 400)
@@ -0,0 +1,201 @@
+"""
+Throttling for Canvas API traffic, driven by the rate limit headers Canvas sends with every response.
+
+Canvas rate limits each access token with a leaky bucket: every request costs some quota (reported in the
+X-Request-Cost header), the remaining quota is reported in X-Rate-Limit-Remaining, and the bucket refills at a
+steady rate. Once the quota is used up Canvas responds with 403 Forbidden (Rate Limit Exceeded).
+
+ThrottledRequestContext is a drop-in replacement for the SDK request context that routes every request through
+a CanvasRateLimitBucket. The bucket's state is kept in the Django cache, so it is shared by every process using
+the same cache (use a shared backend such as the database or memcached cache when running several processes);
+each read-modify-write of the state is done under a lock taken with cache.add(), so that concurrent callers
+don't overwrite each other's reservations.
+Callers are slowed down gradually as the remaining quota falls below a threshold, so that bulk runs go at close
+to the rate Canvas allows without going over it.
+
+Settings (all optional) are read from the CANVAS_RATE_LIMIT dict:
+    capacity: the size of the Canvas bucket (default 700)
+    leak_rate: the quota Canvas restores each second (default 10)
+    slowdown_threshold: the fraction of capacity below which callers are slowed down (default 0.5)
+    max_retries: the number of times a throttled request is retried (default 3)
+    enabled: set to False to turn throttling off (default True)
+"""
+import hashlib
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+
+from icommons_common.canvas_utils import SessionInactivityExpirationRC
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CAPACITY = 700
+DEFAULT_LEAK_RATE = 10
+DEFAULT_SLOWDOWN_THRESHOLD = 0.5
+DEFAULT_MAX_RETRIES = 3
+# Cost assumed for a request until Canvas has reported one
+DEFAULT_REQUEST_COST = 1.0
+# How long the shared bucket state is kept once nobody is using it
+BUCKET_STATE_CACHE_TIMEOUT = 60 * 60
+# Seconds the lock on the shared bucket state is held at most (if its holder dies), and how often it is retried
+BUCKET_LOCK_TIMEOUT = 5
+BUCKET_LOCK_RETRY_INTERVAL = 0.01
+
+
+def _get_rate_limit_setting(name, default):
+    return getattr(settings, 'CANVAS_RATE_LIMIT', {}).get(name, default)
+
+
+class CanvasRateLimitBucket(object):
+    """
+    Client side model of the Canvas rate limit bucket for one access token, kept in the cache so it is shared
+    between processes. The state is refreshed from the headers of each response, and between responses the
+    remaining quota is estimated from the Canvas leak rate.
+    """
+
+    def __init__(self, key):
+        self.cache_key = 'canvas_course_site_wizard:canvas_rate_limit:%s' % key
+        self.capacity = float(_get_rate_limit_setting('capacity', DEFAULT_CAPACITY))
+        self.leak_rate = float(_get_rate_limit_setting('leak_rate', DEFAULT_LEAK_RATE))
+        self.slowdown_threshold = self.capacity * _get_rate_limit_setting('slowdown_threshold',
+                                                                          DEFAULT_SLOWDOWN_THRESHOLD)
+
+    @contextmanager
+    def _lock(self):
+        """
+        Holds a lock on the shared bucket state, taken with cache.add() (which only succeeds if the key isn't set).
+        The lock expires after BUCKET_LOCK_TIMEOUT seconds, so if it can't be had by then its holder has died.
+        """
+        lock_key = '%s:lock' % self.cache_key
+        token = uuid.uuid4().hex
+        give_up_at = time.time() + BUCKET_LOCK_TIMEOUT
+        while not cache.add(lock_key, token, BUCKET_LOCK_TIMEOUT):
+            if time.time() >= give_up_at:
+                logger.warning('Canvas rate limit: gave up waiting for the lock on %s', self.cache_key)
+                break
+            time.sleep(BUCKET_LOCK_RETRY_INTERVAL)
+        try:
+            yield
+        finally:
+            # leave the lock alone if it expired and was taken by another caller
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+
+    def _get_state(self, now):
+        """ returns the estimated remaining quota at `now`, and the expected cost of a request """
+        state = cache.get(self.cache_key)
+        if state is None:
+            return self.capacity, DEFAULT_REQUEST_COST
+        remaining = min(self.capacity, state['remaining'] + (now - state['updated_at']) * self.leak_rate)
+        return remaining, state['cost']
+
+    def _set_state(self, remaining, cost, now):
+        cache.set(self.cache_key, {'remaining': remaining, 'cost': cost, 'updated_at': now},
+                  BUCKET_STATE_CACHE_TIMEOUT)
+
+    def get_delay(self, remaining, cost):
+        """
+        Returns how long a request of the given cost should wait with the given quota remaining: nothing above the
+        slowdown threshold, then rising linearly to the time Canvas takes to restore one request's cost as the
+        quota runs out, and beyond that long enough for the quota to be restored.
+        """
+        if remaining >= self.slowdown_threshold:
+            return 0.0
+        if remaining >= 0:
+            return (cost / self.leak_rate) * (self.slowdown_threshold - remaining) / self.slowdown_threshold
+        return (cost - remaining) / self.leak_rate
+
+    def acquire(self):
+        """
+        Reserves the expected cost of a request from the shared bucket, sleeping first if the quota is running low.
+        Returns the number of seconds slept.
+        """
+        with self._lock():
+            now = time.time()
+            remaining, cost = self._get_state(now)
+            remaining -= cost
+            delay = self.get_delay(remaining, cost)
+            self._set_state(remaining, cost, now)
+        if delay:
+            logger.debug('Canvas rate limit: %.1f of %.0f remaining, waiting %.2fs', remaining, self.capacity, delay)
+            time.sleep(delay)
+        return delay
+
+    def update(self, headers):
+        """ Refreshes the shared bucket from the rate limit headers of a Canvas response """
+        remaining = headers.get('X-Rate-Limit-Remaining')
+        if remaining is None:
+            return
+        with self._lock():
+            now = time.time()
+            _, cost = self._get_state(now)
+            request_cost = headers.get('X-Request-Cost')
+            if request_cost is not None:
+                # smooth the expected cost of a request, as costs vary between endpoints
+                cost = 0.8 * cost + 0.2 * float(request_cost)
+            self._set_state(float(remaining), cost, now)
+
+    def exhausted(self):
+        """ Records that Canvas has throttled a request, so that every caller backs off """
+        with self._lock():
+            now = time.time()
+            _, cost = self._get_state(now)
+            self._set_state(0.0, cost, now)
+
+
+class ThrottlingHTTPAdapter(HTTPAdapter):
+    """
+    requests transport adapter which waits on the CanvasRateLimitBucket before each request, updates it from each
+    response, and retries requests that Canvas throttled
+    """
+
+    def __init__(self, bucket, max_retries=None, **kwargs):
+        super(ThrottlingHTTPAdapter, self).__init__(**kwargs)
+        self.bucket = bucket
+        if max_retries is None:
+            max_retries = _get_rate_limit_setting('max_retries', DEFAULT_MAX_RETRIES)
+        self.throttle_retries = max_retries
+
+    def send(self, request, **kwargs):
+        for attempt in range(self.throttle_retries + 1):
+            self.bucket.acquire()
+            response = super(ThrottlingHTTPAdapter, self).send(request, **kwargs)
+            self.bucket.update(response.headers)
+            if not _is_throttled(response):
+                break
+            # Canvas rejects throttled requests without acting on them, so they can safely be retried
+            logger.warning('Canvas throttled %s %s (attempt %d)', request.method, request.url, attempt + 1)
+            self.bucket.exhausted()
+        return response
+
+
+def _is_throttled(response):
+    return response.status_code == 403 and 'Rate Limit Exceeded' in (response.text or '')
+
+
+class ThrottledRequestContext(SessionInactivityExpirationRC):
+    """
+    SDK request context whose session sends every Canvas request through a ThrottlingHTTPAdapter. The adapter is
+    mounted on each new session, as the session is replaced after a period of inactivity.
+    """
+
+    @property
+    def session(self):
+        session = super(ThrottledRequestContext, self).session
+        if _get_rate_limit_setting('enabled', True) and not getattr(session, '_canvas_throttled', False):
+            adapter = ThrottlingHTTPAdapter(CanvasRateLimitBucket(self._rate_limit_key()))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session._canvas_throttled = True
+        return session
+
+    def _rate_limit_key(self):
+        """ Canvas limits each access token separately; key the bucket by host and (a hash of) the token """
+        token_hash = hashlib.sha1(str(self.auth_token).encode()).hexdigest()[:12]
+        return '%s:%s' % (urlparse(self.base_api_url).netloc, token_hash)
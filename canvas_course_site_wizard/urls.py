@@ -1,9 +1,13 @@
 from django.conf.urls import patterns, url
 
-from .views import (CanvasCourseSiteCreateView, CanvasCourseSiteStatusView)
+from .views import (CanvasCourseSiteCreateView, CanvasCourseSiteStatusView, CanvasCourseSiteStatusJsonView,
+                    BulkJobProgressStreamView)
 
 urlpatterns = patterns(
     '',
     url(r'^courses/(?P<pk>\d+)/create$', CanvasCourseSiteCreateView.as_view(), name='ccsw-create'),
-    url(r'^status/(?P<pk>\d+)$', CanvasCourseSiteStatusView.as_view(), name='ccsw-status')
+    url(r'^status/(?P<pk>\d+)$', CanvasCourseSiteStatusView.as_view(), name='ccsw-status'),
+    url(r'^status/(?P<pk>\d+)/json$', CanvasCourseSiteStatusJsonView.as_view(), name='ccsw-status-json'),
+    url(r'^status/json$', CanvasCourseSiteStatusJsonView.as_view(), name='ccsw-status-json-multiple'),
+    url(r'^bulk_jobs/(?P<pk>\d+)/progress$', BulkJobProgressStreamView.as_view(), name='ccsw-bulk-job-progress')
 )
@@ -1,5 +1,12 @@
+import hashlib
+import json
 import logging
-from django.views.generic.base import TemplateView
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.views.generic.base import TemplateView, View
 from django.views.generic.detail import DetailView
 from django.shortcuts import redirect
 from .controller import (
@@ -11,11 +18,25 @@ from .controller import (
 from .mixins import CourseSiteCreationAllowedMixin
 from icommons_ui.mixins import CustomErrorPageMixin
 from .exceptions import NoTemplateExistsForSchool
-from .models import CanvasCourseGenerationJob
+from .models import (BulkCanvasCourseCreationJob, CanvasCourseGenerationJob,
+                     get_bulk_job_progress_version)
 from braces.views import LoginRequiredMixin
 
 logger = logging.getLogger(__name__)
 
+# Default number of seconds between checks of a job's progress on the status page
+STATUS_POLL_INTERVAL = 10
+# Maximum number of jobs which can be checked in one call to the JSON status endpoint
+STATUS_MAX_JOB_IDS = 100
+
+# Defaults for the BULK_COURSE_CREATION progress stream settings (see BulkJobProgressStreamView), in seconds
+PROGRESS_STREAM_CHECK_INTERVAL = 2
+PROGRESS_STREAM_FALLBACK_INTERVAL = 15
+PROGRESS_STREAM_KEEPALIVE_INTERVAL = 15
+PROGRESS_STREAM_MAX_DURATION = 30
+# Default maximum number of progress streams open at once, across all server processes sharing the cache
+PROGRESS_STREAM_MAX_CONCURRENT = 10
+
 class CanvasCourseSiteCreateView(LoginRequiredMixin, CourseSiteCreationAllowedMixin, CustomErrorPageMixin, TemplateView):
     """
     Serves up the canvas course site creation wizard on GET and creates the
@@ -68,4 +89,161 @@ class CanvasCourseSiteStatusView(LoginRequiredMixin, DetailView):
             CanvasCourseGenerationJob.STATUS_FINALIZE_FAILED
         ]
         context['job_succeeded'] = self.object.workflow_state in [CanvasCourseGenerationJob.STATUS_FINALIZED]
+        context['status_poll_interval'] = getattr(settings, 'CANVAS_COURSE_SITE_STATUS_POLL_INTERVAL',
+                                                  STATUS_POLL_INTERVAL)
         return context
+
+
+class CanvasCourseSiteStatusJsonView(LoginRequiredMixin, View):
+    """
+    Returns the status of one course creation job (given by pk), or of several (given as a comma separated list in
+    the job_ids query parameter), as JSON. The response carries an ETag derived from the jobs' states, and a request
+    whose If-None-Match matches it gets an empty 304 Not Modified response, so pages can poll it cheaply.
+    """
+    def get(self, request, *args, **kwargs):
+        if 'pk' in kwargs:
+            job_ids = [kwargs['pk']]
+        else:
+            try:
+                job_ids = [int(job_id) for job_id in request.GET.get('job_ids', '').split(',') if job_id]
+            except ValueError:
+                return HttpResponseBadRequest('job_ids must be a comma separated list of job ids')
+            if not job_ids or len(job_ids) > STATUS_MAX_JOB_IDS:
+                return HttpResponseBadRequest('between 1 and %d job ids are required' % STATUS_MAX_JOB_IDS)
+
+        jobs = list(CanvasCourseGenerationJob.objects.filter(pk__in=job_ids).order_by('pk').values_list(
+            'pk', 'workflow_state', 'canvas_course_id'))
+        etag = get_job_status_etag(jobs)
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = JsonResponse({'jobs': [_get_job_status(*job) for job in jobs]})
+        response['ETag'] = etag
+        # make browsers check back with us (sending If-None-Match) rather than reuse their copy
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+def get_job_status_etag(jobs):
+    """ builds a (quoted) ETag from the (pk, workflow_state, canvas_course_id) tuples of the given jobs """
+    state = ';'.join('%s:%s:%s' % job for job in jobs)
+    return '"%s"' % hashlib.md5(state.encode()).hexdigest()
+
+
+def _get_job_status(pk, workflow_state, canvas_course_id):
+    return {
+        'id': pk,
+        'workflow_state': workflow_state,
+        'status_display_name': CanvasCourseGenerationJob.STATUS_DISPLAY_NAMES[workflow_state],
+        'canvas_course_url': get_canvas_course_url(canvas_course_id=canvas_course_id),
+        'complete': workflow_state not in CanvasCourseGenerationJob.INTERMEDIATE_STATES,
+    }
+
+
+class BulkJobProgressStreamView(LoginRequiredMixin, View):
+    """
+    Streams the progress of a bulk job (its status and subjob counters, see BulkCanvasCourseCreationJob.get_progress)
+    as server-sent events. A 'progress' event is sent straight away and
+    then whenever the progress changes, and a 'done' event once the bulk job has finished.
+
+    Rather than each client reading the bulk job over and over, the stream checks the bulk job's progress version
+    in the cache (see get_bulk_job_progress_version), which changes whenever the bulk job or one of its subjobs
+    changes state; the bulk job is only read again when it has changed. If the version isn't in the cache the
+    stream falls back to reading it every progress_stream_fallback_interval seconds.
+
+    Each open stream ties up a server worker (a whole process or thread under WSGI) for as long as it lasts, so
+    streams are kept short: they end after progress_stream_max_duration seconds, and browsers then reconnect by
+    themselves. At most progress_stream_max_concurrent streams are open at once (counted through the cache, so
+    across server processes sharing it); beyond that the current progress is sent straight away and the stream
+    ends, and the browser checks back after progress_stream_fallback_interval seconds. Keep the limit well below
+    the number of server workers. Set it to None to remove the limit.
+    """
+    def get(self, request, *args, **kwargs):
+        try:
+            bulk_job = BulkCanvasCourseCreationJob.objects.get(pk=kwargs['pk'])
+        except BulkCanvasCourseCreationJob.DoesNotExist:
+            raise Http404('Bulk job %s does not exist' % kwargs['pk'])
+
+        response = StreamingHttpResponse(_bulk_job_progress_events(bulk_job), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # stop nginx from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+def _get_progress_stream_setting(name, default):
+    return getattr(settings, 'BULK_COURSE_CREATION', {}).get(name, default)
+
+
+def _bulk_job_progress_events(bulk_job):
+    """ generates the server-sent events for BulkJobProgressStreamView """
+    check_interval = _get_progress_stream_setting('progress_stream_check_interval', PROGRESS_STREAM_CHECK_INTERVAL)
+    fallback_interval = _get_progress_stream_setting('progress_stream_fallback_interval',
+                                                     PROGRESS_STREAM_FALLBACK_INTERVAL)
+    keepalive_interval = _get_progress_stream_setting('progress_stream_keepalive_interval',
+                                                      PROGRESS_STREAM_KEEPALIVE_INTERVAL)
+    max_duration = _get_progress_stream_setting('progress_stream_max_duration', PROGRESS_STREAM_MAX_DURATION)
+    max_concurrent = _get_progress_stream_setting('progress_stream_max_concurrent', PROGRESS_STREAM_MAX_CONCURRENT)
+
+    slot_key = None
+    if max_concurrent is not None:
+        # the slot is held a little longer than the stream can last, in case the stream isn't closed properly
+        slot_key = _take_progress_stream_slot(max_concurrent, max_duration + check_interval + keepalive_interval)
+        if slot_key is None:
+            # too many streams are open; send the progress once, and have the browser check back later
+            yield 'retry: %d\n\n' % (fallback_interval * 1000)
+            progress = bulk_job.get_progress()
+            yield _server_sent_event('progress', progress)
+            if progress['finished']:
+                yield _server_sent_event('done', progress)
+            return
+
+    try:
+        start = last_read = last_sent = time.monotonic()
+        last_version = last_progress = None
+        yield 'retry: %d\n\n' % (check_interval * 1000)
+        while True:
+            now = time.monotonic()
+            # the version is read before the progress, so that a change made while the progress is being read is
+            # picked up on the next check
+            version = get_bulk_job_progress_version(bulk_job.pk)
+            if (last_progress is None or version != last_version
+                    or (version is None and now - last_read >= fallback_interval)):
+                last_version = version
+                last_read = now
+                bulk_job.refresh_from_db()
+                progress = bulk_job.get_progress()
+                if progress != last_progress:
+                    yield _server_sent_event('progress', progress)
+                    last_sent = now
+                    last_progress = progress
+                if progress['finished']:
+                    yield _server_sent_event('done', progress)
+                    return
+
+            if now - start >= max_duration:
+                return
+            if now - last_sent >= keepalive_interval:
+                # a comment, which lets the server notice (when it fails to write it) that the client has gone away
+                yield ': keepalive\n\n'
+                last_sent = now
+            time.sleep(check_interval)
+    finally:
+        if slot_key is not None:
+            cache.delete(slot_key)
+
+
+def _take_progress_stream_slot(max_concurrent, timeout):
+    """
+    takes one of the max_concurrent progress stream slots, each a cache key set with cache.add() (which only
+    succeeds if the key isn't set), for at most timeout seconds; returns its key, or None if they are all taken
+    """
+    for slot in range(max_concurrent):
+        slot_key = 'canvas_course_site_wizard:progress_stream_slot:%d' % slot
+        if cache.add(slot_key, True, timeout):
+            return slot_key
+    return None
+
+
+def _server_sent_event(event, data):
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))